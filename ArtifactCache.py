@@ -0,0 +1,95 @@
+"""Reuse outputs of steps with the same inputs.
+
+Bulk resubmissions, the publication jobs and overlapping children run steps
+(blast, alignment, RNAcode) on the same inputs again. The key of a step is the
+hash of its wrapper script, the content of its input files and the versions of
+the tools it calls. Thread counts are masked in the script, they do not change
+the output. The outputs of a finished step are hard linked into
+
+    <cache_dir>/<key[:2]>/<key>/<i>     i-th output, a file or a directory
+
+and linked back into the work dir of the next step with the same key. Linked
+files share their content, so outputs must be replaced, not changed in place.
+Files are copied if the cache is on another file system.
+"""
+
+import os
+import re
+import shutil
+import hashlib
+
+# Options of the tools which only set the number of threads
+THREAD_OPTIONS = re.compile(r"(-num_threads|--threads?|--cpus)[ =]+[0-9]+")
+
+
+def _hash_file(hash_obj, path):
+    with open(path, "rb") as f_handle:
+        for block in iter(lambda: f_handle.read(1 << 20), b""):
+            hash_obj.update(block)
+
+
+def step_key(script, input_paths, versions):
+    """Return key of a step with wrapper script, input files and tool versions."""
+    hash_obj = hashlib.sha256()
+    hash_obj.update(THREAD_OPTIONS.sub(r"\1 N", script).encode("UTF-8"))
+    for version in versions:
+        hash_obj.update(f"\n{version}".encode("UTF-8"))
+    for path in input_paths:
+        hash_obj.update(f"\n{os.path.basename(path)}\n".encode("UTF-8"))
+        _hash_file(hash_obj, path)
+    return hash_obj.hexdigest()
+
+
+def entry_dir(cache_dir, key):
+    """Return dir of the entry of key."""
+    return os.path.join(cache_dir, key[:2], key)
+
+
+def _link(source, target):
+    """Hard link file or directory source to target, copy across file systems."""
+    if os.path.isdir(source):
+        os.makedirs(target, exist_ok=True)
+        for name in os.listdir(source):
+            _link(os.path.join(source, name), os.path.join(target, name))
+        return
+    if os.path.lexists(target):
+        os.remove(target)
+    try:
+        os.link(source, target)
+    except OSError:
+        shutil.copy2(source, target)
+
+
+def fetch(cache_dir, key, output_paths):
+    """Link the cached outputs of key to output_paths.
+
+    Returns False if there is no entry.
+    """
+    directory = entry_dir(cache_dir, key)
+    if not os.path.isdir(directory):
+        return False
+    for i, output_path in enumerate(output_paths):
+        if os.path.isdir(output_path):
+            shutil.rmtree(output_path)
+        _link(os.path.join(directory, str(i)), output_path)
+    return True
+
+
+def store(cache_dir, key, output_paths):
+    """Put outputs of a finished step into the cache.
+
+    The entry is built in a temporary dir and renamed, so a step never sees
+    half an entry. Missing outputs are not cached.
+    """
+    directory = entry_dir(cache_dir, key)
+    if os.path.isdir(directory) or not all(os.path.exists(path) for path in output_paths):
+        return
+    tmp_dir = f"{directory}.{os.getpid()}.tmp"
+    os.makedirs(tmp_dir)
+    try:
+        for i, output_path in enumerate(output_paths):
+            _link(output_path, os.path.join(tmp_dir, str(i)))
+        os.rename(tmp_dir, directory)
+    except OSError:
+        # An other step stored the same entry meanwhile
+        shutil.rmtree(tmp_dir, ignore_errors=True)
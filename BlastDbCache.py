@@ -0,0 +1,186 @@
+"""Keep the volumes of the blast dbs in the page cache.
+
+Blast reads every volume of the db for every search. Searches of neighbouring
+jobs and of the children of a parent use the same volumes within minutes, so
+the volumes are worth keeping in memory. Before a search the wrapper calls
+
+    python3 BlastDbCache.py warm <state_dir> <blast_db_path> <db>
+
+on the node of the search. This measures which part of the volumes is already
+in the page cache (mincore) and asks the kernel to read the rest ahead
+(posix_fadvise WILLNEED), up to a share of the available memory of the node.
+The read ahead runs in a background process, so the search starts right away
+and reads what is not yet in memory itself. Warming is per search, there is no
+process keeping volumes warm between searches.
+
+    python3 BlastDbCache.py stats <state_dir>
+
+prints the hit rate, the share of the db which was in the page cache when a
+search started. A low hit rate means blast waits for the disk.
+"""
+
+import os
+import sys
+import json
+import mmap
+import fcntl
+import ctypes
+import ctypes.util
+from glob import glob
+
+from BlastSearch import db_volumes
+
+STATS_FILE = "stats.json"
+LOCK_FILE = "cache.lock"
+
+# Share of the available memory of the node used for warming
+MEMORY_SHARE = 0.5
+# mincore sets bit 0 of a page if it is resident, the other bits are reserved
+_RESIDENT_BIT = bytes(value & 1 for value in range(256))
+
+_LIBC = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+_LIBC.mmap.restype = ctypes.c_void_p
+_LIBC.mmap.argtypes = [
+    ctypes.c_void_p,
+    ctypes.c_size_t,
+    ctypes.c_int,
+    ctypes.c_int,
+    ctypes.c_int,
+    ctypes.c_long,
+]
+_LIBC.munmap.argtypes = [ctypes.c_void_p, ctypes.c_size_t]
+_LIBC.mincore.argtypes = [ctypes.c_void_p, ctypes.c_size_t, ctypes.POINTER(ctypes.c_ubyte)]
+
+
+def resident_bytes(path):
+    """Return number of bytes of file which are in the page cache."""
+    size = os.path.getsize(path)
+    if size == 0:
+        return 0
+    page_size = mmap.PAGESIZE
+    num_pages = (size + page_size - 1) // page_size
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        addr = _LIBC.mmap(None, size, mmap.PROT_READ, mmap.MAP_SHARED, fd, 0)
+        if addr in (None, ctypes.c_void_p(-1).value):
+            return 0
+        try:
+            vec = (ctypes.c_ubyte * num_pages)()
+            if _LIBC.mincore(addr, size, vec) != 0:
+                return 0
+            resident_pages = bytes(vec).translate(_RESIDENT_BIT).count(1)
+        finally:
+            _LIBC.munmap(addr, size)
+    finally:
+        os.close(fd)
+    return min(size, resident_pages * page_size)
+
+
+def advise_willneed(path):
+    """Ask the kernel to read file into the page cache in the background."""
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_WILLNEED)
+    finally:
+        os.close(fd)
+
+
+def volume_files(blast_db_path, volume):
+    """Return files of a db volume."""
+    return [path for path in glob(os.path.join(blast_db_path, f"{volume}.*")) if os.path.isfile(path)]
+
+
+def available_memory():
+    """Return available memory of the node in bytes."""
+    with open("/proc/meminfo", "r", encoding="UTF-8") as f_handle:
+        for line in f_handle:
+            if line.startswith("MemAvailable:"):
+                return int(line.split()[1]) * 1024
+    return 0
+
+
+def _update_json(state_dir, file_name, update):
+    """Update json file in state_dir under the lock of the cache."""
+    os.makedirs(state_dir, exist_ok=True)
+    path = os.path.join(state_dir, file_name)
+    with open(os.path.join(state_dir, LOCK_FILE), "a", encoding="UTF-8") as lock_handle:
+        fcntl.flock(lock_handle, fcntl.LOCK_EX)
+        try:
+            with open(path, "r", encoding="UTF-8") as f_handle:
+                content = json.load(f_handle)
+        except (FileNotFoundError, json.decoder.JSONDecodeError):
+            content = {}
+        update(content)
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, "w", encoding="UTF-8") as f_handle:
+            json.dump(content, f_handle, indent=4)
+        os.replace(tmp_path, path)
+    return content
+
+
+def warm(state_dir, blast_db_path, volumes):
+    """Warm volumes up to the memory budget of the node.
+
+    The files are read ahead by a forked process, which outlives the call.
+    Returns [bytes of the volumes, bytes already in the page cache], both are
+    added to the hit rate counters.
+    """
+    budget = available_memory() * MEMORY_SHARE
+    total = 0
+    resident = 0
+    read_ahead = []
+    for volume in volumes:
+        for path in volume_files(blast_db_path, volume):
+            size = os.path.getsize(path)
+            in_cache = resident_bytes(path)
+            total += size
+            resident += in_cache
+            missing = size - in_cache
+            if missing > 0 and missing <= budget:
+                read_ahead.append(path)
+                budget -= missing
+
+    def update(stats):
+        stats["searches"] = stats.get("searches", 0) + 1
+        stats["bytes_total"] = stats.get("bytes_total", 0) + total
+        stats["bytes_resident"] = stats.get("bytes_resident", 0) + resident
+
+    _update_json(state_dir, STATS_FILE, update)
+
+    # WILLNEED can block until the reads are queued, which takes a while for
+    # large volumes
+    if read_ahead and os.fork() == 0:
+        try:
+            for path in read_ahead:
+                advise_willneed(path)
+        finally:
+            os._exit(0)
+    return [total, resident]
+
+
+def stats(state_dir):
+    """Return hit rate counters."""
+    content = _update_json(state_dir, STATS_FILE, lambda stats: None)
+    bytes_total = content.get("bytes_total", 0)
+    content["hit_rate"] = content.get("bytes_resident", 0) / bytes_total if bytes_total else None
+    return content
+
+
+def main():
+    """Command line interface."""
+    command = sys.argv[1]
+    state_dir = sys.argv[2]
+    if command == "warm":
+        blast_db_path = sys.argv[3]
+        volumes = db_volumes(blast_db_path, " ".join(sys.argv[4:]))
+        total, resident = warm(state_dir, blast_db_path, volumes)
+        print(f"Blast db in page cache: {resident}/{total} bytes")
+    elif command == "stats":
+        print(json.dumps(stats(state_dir), indent=4))
+    else:
+        print(f"Unknown command {command}", file=sys.stderr)
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
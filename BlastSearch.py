@@ -0,0 +1,314 @@
+"""Helpers for blast searches.
+
+Large NCBI databases (nt, the refseq representative genomes) consist of many
+volumes, listed in the DBLIST line of their alias file (.nal). A sharded search
+runs one blastn per group of volumes, e.g. as tasks of a job array, and merges
+the results afterwards.
+
+All shards search with the size of the whole database (-dbsize), so the
+e-values of the shards are the same as for a single search and can be merged
+directly. The merge keeps the max_target_seqs best hits by e-value.
+
+Emulate narrower searches on the hits of one sensitive search. A search with a
+larger word size or a taxid restriction finds a subset of the hits of a search
+with the smallest word size and no restriction, see filter_hits().
+
+The hits of a search tell how to set up the next one, see hit_stats().
+
+The search of a long query serves all windows of it, clip_hits() cuts its hits
+to a window. The other way round a long query can be searched in overlapping
+chunks, merge_chunk_results() joins their hits.
+"""
+
+import os
+import re
+import shlex
+import subprocess
+
+SHARD_SUFFIX = ".shard_{}"
+CHUNK_SUFFIX = ".chunk_{}"
+
+
+def db_volumes(blast_db_path, db_names):
+    """Return the volumes of the databases db_names (space separated).
+
+    A database without alias file is a single volume.
+    """
+    volumes = []
+    for db_name in db_names.split():
+        alias_path = os.path.join(blast_db_path, f"{db_name}.nal")
+        if not os.path.isfile(alias_path):
+            volumes.append(db_name)
+            continue
+        with open(alias_path, "r", encoding="UTF-8") as f_handle:
+            for line in f_handle:
+                if line.startswith("DBLIST"):
+                    volumes += shlex.split(line[len("DBLIST"):])
+                    break
+            else:
+                volumes.append(db_name)
+    return volumes
+
+
+def db_size(db_names, env=None):
+    """Return total number of bases of the databases db_names."""
+    total_bases = 0
+    for db_name in db_names.split():
+        completed_process = subprocess.run(
+            ["blastdbcmd", "-db", db_name, "-info"],
+            capture_output=True,
+            text=True,
+            check=True,
+            env=env,
+        )
+        match = re.search(r"([\d,]+) total bases", completed_process.stdout)
+        total_bases += int(match.group(1).replace(",", ""))
+    return total_bases
+
+
+def group_volumes(volumes, num_shards):
+    """Split volumes into at most num_shards groups of about the same size."""
+    num_shards = max(1, min(num_shards, len(volumes)))
+    return [volumes[i::num_shards] for i in range(num_shards)]
+
+
+def shard_paths(result_path, num_shards):
+    """Return result paths of the shards of a search."""
+    return [result_path + SHARD_SUFFIX.format(i) for i in range(num_shards)]
+
+
+def merge_results(result_path, num_shards, max_target_seqs):
+    """Merge shard results into result_path and remove the shard results.
+
+    The results must be tabular with e-value, bit score, pident and subject id
+    in the first four columns. Hits are sorted by e-value and bit score, only the
+    first max_target_seqs subjects are kept.
+    """
+    hits = []
+    for shard_path in shard_paths(result_path, num_shards):
+        with open(shard_path, "r", encoding="UTF-8") as f_handle:
+            hits += [line for line in f_handle if line.strip() != ""]
+    hits.sort(key=lambda line: (float(line.split("\t")[0]), -float(line.split("\t")[1])))
+
+    subjects = set()
+    with open(result_path, "w", encoding="UTF-8") as f_handle:
+        for line in hits:
+            # sseqid, one line per subject as blast runs with -max_hsps 1
+            subject = line.split("\t")[3]
+            if subject not in subjects and len(subjects) >= max_target_seqs:
+                continue
+            subjects.add(subject)
+            f_handle.write(line)
+
+    for shard_path in shard_paths(result_path, num_shards):
+        os.remove(shard_path)
+
+
+def query_chunks(seq_len, chunk_length, overlap):
+    """Return [start, stop] of overlapping chunks of a query of length seq_len."""
+    chunks = []
+    for start in range(0, seq_len, chunk_length - overlap):
+        chunks.append([start, min(start + chunk_length, seq_len)])
+        if start + chunk_length >= seq_len:
+            break
+    return chunks
+
+
+def chunk_paths(result_path, num_chunks):
+    """Return result paths of the chunks of a search."""
+    return [result_path + CHUNK_SUFFIX.format(i) for i in range(num_chunks)]
+
+
+def merge_chunk_results(result_path, chunks, outfmt, max_target_seqs):
+    """Merge results of query chunks into result_path and remove them.
+
+    Query positions are shifted from the chunk to the whole query. Hits of
+    neighbouring chunks on the same subject and strand with overlapping
+    subject positions are the same region, only the best is kept. The chunks
+    must be searched with the search space of the whole query (-searchsp), so
+    the e-values are comparable. The max_target_seqs best subjects are kept.
+    """
+    fields = outfmt.split()[1:]
+    col = {field: i for i, field in enumerate(fields)}
+
+    # [sseqid, strand] -> list of [evalue, -bitscore, subject start, subject end, line]
+    regions = {}
+    for [chunk_start, _chunk_stop], chunk_path in zip(chunks, chunk_paths(result_path, len(chunks))):
+        with open(chunk_path, "r", encoding="UTF-8") as f_handle:
+            for line in f_handle:
+                columns = line.rstrip("\n").split("\t")
+                if len(columns) < len(fields):
+                    continue
+                columns[col["qstart"]] = str(int(columns[col["qstart"]]) + chunk_start)
+                columns[col["qend"]] = str(int(columns[col["qend"]]) + chunk_start)
+                sstart, send = sorted([int(columns[col["sstart"]]), int(columns[col["send"]])])
+                hit = [
+                    float(columns[col["evalue"]]),
+                    -float(columns[col["bitscore"]]),
+                    sstart,
+                    send,
+                    "\t".join(columns) + "\n",
+                ]
+                key = (columns[col["sseqid"]], columns[col["sframe"]])
+                same_region = [
+                    other for other in regions.get(key, []) if other[2] <= send and sstart <= other[3]
+                ]
+                if any(other[:2] <= hit[:2] for other in same_region):
+                    continue
+                regions[key] = [other for other in regions.get(key, []) if other not in same_region]
+                regions[key].append(hit)
+
+    hits = sorted((hit for region_hits in regions.values() for hit in region_hits), key=lambda hit: hit[:2])
+    subjects = set()
+    with open(result_path, "w", encoding="UTF-8") as f_handle:
+        for hit in hits:
+            subject = hit[4].split("\t")[col["sseqid"]]
+            if subject not in subjects and len(subjects) >= max_target_seqs:
+                continue
+            subjects.add(subject)
+            f_handle.write(hit[4])
+
+    for chunk_path in chunk_paths(result_path, len(chunks)):
+        os.remove(chunk_path)
+
+
+def longest_identical_run(qseq, sseq):
+    """Return length of the longest run of identical bases in an alignment."""
+    longest = 0
+    current = 0
+    for q_base, s_base in zip(qseq.upper(), sseq.upper()):
+        if q_base == s_base and q_base != "-":
+            current += 1
+            longest = max(longest, current)
+        else:
+            current = 0
+    return longest
+
+
+def filter_hits(hits_path, result_path, outfmt, word_size, taxids, max_target_seqs):
+    """Write hits of a sensitive search, which a narrower search would find.
+
+    A hit is kept if its alignment contains an exact match of word_size bases,
+    the seed a search with this word size needs, and if one of its taxids is in
+    taxids (None keeps all). outfmt is the -outfmt of the search and must
+    contain evalue, qseq, sseq and staxid. The max_target_seqs hits with the
+    best e-value are written to result_path.
+    """
+    fields = outfmt.split()[1:]
+    evalue_col = fields.index("evalue")
+    qseq_col = fields.index("qseq")
+    sseq_col = fields.index("sseq")
+    staxid_col = fields.index("staxid")
+
+    hits = []
+    with open(hits_path, "r", encoding="UTF-8") as f_handle:
+        for line in f_handle:
+            columns = line.rstrip("\n").split("\t")
+            if len(columns) < len(fields):
+                continue
+            if taxids is not None and not set(columns[staxid_col].split(";")) & taxids:
+                continue
+            if longest_identical_run(columns[qseq_col], columns[sseq_col]) < word_size:
+                continue
+            hits.append([float(columns[evalue_col]), line])
+    hits.sort(key=lambda hit: hit[0])
+
+    # result_path can be hits_path, which can be linked to other files
+    tmp_path = f"{result_path}.{os.getpid()}.tmp"
+    with open(tmp_path, "w", encoding="UTF-8") as f_handle:
+        for _evalue, line in hits[:max_target_seqs]:
+            f_handle.write(line)
+    os.replace(tmp_path, result_path)
+    return min(len(hits), max_target_seqs)
+
+
+def hit_stats(result_path, outfmt):
+    """Return number of hits and median percent identity of a tabular result.
+
+    The median is None if there are no hits.
+    """
+    pident_col = outfmt.split()[1:].index("pident")
+    identities = []
+    with open(result_path, "r", encoding="UTF-8") as f_handle:
+        for line in f_handle:
+            columns = line.rstrip("\n").split("\t")
+            if len(columns) > pident_col:
+                identities.append(float(columns[pident_col]))
+    if len(identities) == 0:
+        return [0, None]
+    identities.sort()
+    return [len(identities), identities[len(identities) // 2]]
+
+
+def _clip_alignment(columns, col, start, stop):
+    """Return columns of hit clipped to query positions start to stop or None."""
+    q_pos = int(columns[col["qstart"]])
+    s_pos = int(columns[col["sstart"]])
+    s_step = 1 if int(columns[col["send"]]) >= s_pos else -1
+    # [query position, subject position, query base, subject base]
+    kept = []
+    for q_base, s_base in zip(columns[col["qseq"]], columns[col["sseq"]]):
+        if start <= q_pos <= stop:
+            kept.append([q_pos, s_pos, q_base, s_base])
+        if q_base != "-":
+            q_pos += 1
+        if s_base != "-":
+            s_pos += s_step
+    # An alignment starts and ends without gap
+    while kept and "-" in kept[0][2:]:
+        kept.pop(0)
+    while kept and "-" in kept[-1][2:]:
+        kept.pop()
+    if len(kept) == 0:
+        return None
+
+    identical = sum(1 for column in kept if column[2].upper() == column[3].upper())
+    clipped = list(columns)
+    clipped[col["qstart"]] = str(kept[0][0] - start + 1)
+    clipped[col["qend"]] = str(kept[-1][0] - start + 1)
+    clipped[col["sstart"]] = str(kept[0][1])
+    clipped[col["send"]] = str(kept[-1][1])
+    clipped[col["pident"]] = f"{100 * identical / len(kept):.3f}"
+    clipped[col["qseq"]] = "".join(column[2] for column in kept)
+    clipped[col["sseq"]] = "".join(column[3] for column in kept)
+    return clipped
+
+
+def clip_hits(hits_path, result_path, outfmt, start, stop, word_size, taxids, max_target_seqs):
+    """Write hits of a search with a longer query, clipped to a query window.
+
+    start and stop are the 1 based query positions of the window, the written
+    hits have query positions relative to the window. A hit is kept if its
+    clipped alignment contains an exact match of word_size bases and if one of
+    its taxids is in taxids (None keeps all). e-value and bit score are the ones
+    of the whole hit. Per subject the best hit is kept, like with -max_hsps 1,
+    and the max_target_seqs best subjects are written.
+    """
+    fields = outfmt.split()[1:]
+    col = {field: i for i, field in enumerate(fields)}
+
+    best_hits = {}
+    with open(hits_path, "r", encoding="UTF-8") as f_handle:
+        for line in f_handle:
+            columns = line.rstrip("\n").split("\t")
+            if len(columns) < len(fields):
+                continue
+            if int(columns[col["qend"]]) < start or int(columns[col["qstart"]]) > stop:
+                continue
+            if taxids is not None and not set(columns[col["staxid"]].split(";")) & taxids:
+                continue
+            clipped = _clip_alignment(columns, col, start, stop)
+            if clipped is None:
+                continue
+            if longest_identical_run(clipped[col["qseq"]], clipped[col["sseq"]]) < word_size:
+                continue
+            evalue = float(columns[col["evalue"]])
+            subject = columns[col["sseqid"]]
+            if subject not in best_hits or evalue < best_hits[subject][0]:
+                best_hits[subject] = [evalue, "\t".join(clipped) + "\n"]
+    hits = sorted(best_hits.values(), key=lambda hit: hit[0])
+
+    with open(result_path, "w", encoding="UTF-8") as f_handle:
+        for _evalue, line in hits[:max_target_seqs]:
+            f_handle.write(line)
+    return min(len(hits), max_target_seqs)
@@ -0,0 +1,145 @@
+"""Share the cores of the cluster between concurrently running blast searches.
+
+The state of the cluster (idle cores, pending jobs) is taken from a snapshot
+which is cached in a file and refreshed at most every ttl seconds, so not
+every search calls sinfo and squeue. Every pipeline registers its running
+searches with their expected cost. A new search gets a share of the free cores
+in proportion to its cost, compared to the cost of the searches already
+running. If all searches get cores in proportion to their cost, they finish at
+about the same time, which keeps the makespan small.
+
+The cache directory holds:
+
+    cache_dir/snapshot.json            cached cluster snapshot
+    cache_dir/running/<job_name>.json  running searches with cost and cores
+"""
+
+import os
+import json
+import time
+import fcntl
+import subprocess
+
+SNAPSHOT_FILE = "snapshot.json"
+RUNNING_DIR = "running"
+LOCK_FILE = "snapshot.lock"
+
+
+def _write_json(path, content):
+    """Write json file atomically."""
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, "w", encoding="UTF-8") as f_handle:
+        json.dump(content, f_handle)
+    os.replace(tmp_path, path)
+
+
+def _read_json(path):
+    with open(path, "r", encoding="UTF-8") as f_handle:
+        return json.load(f_handle)
+
+
+def query_cluster(partition):
+    """Return idle cores, total cores and number of pending jobs from SLURM."""
+    call_str = "sinfo -a --format=%C"
+    completed_process = subprocess.run(
+        call_str.split(), capture_output=True, text=True, check=True
+    )
+    # Format is allocated/idle/other/total
+    cores = completed_process.stdout.split("\n")[1].split("/")
+    call_str = f"squeue -h -t PD -p {partition} --format=%i"
+    completed_process = subprocess.run(
+        call_str.split(), capture_output=True, text=True, check=True
+    )
+    pending = len([line for line in completed_process.stdout.split("\n") if line.strip()])
+    return {
+        "idle": int(cores[1]),
+        "total": int(cores[3]),
+        "pending": pending,
+        "time": time.time(),
+    }
+
+
+def cluster_snapshot(cache_dir, ttl, partition):
+    """Return cached snapshot of the cluster, refreshed if older than ttl.
+
+    If SLURM can not be asked, a stale snapshot is used if there is one.
+    """
+    os.makedirs(os.path.join(cache_dir, RUNNING_DIR), exist_ok=True)
+    snapshot_path = os.path.join(cache_dir, SNAPSHOT_FILE)
+    with open(os.path.join(cache_dir, LOCK_FILE), "a", encoding="UTF-8") as lock_handle:
+        # Only one pipeline refreshes the snapshot, the others wait for it
+        fcntl.flock(lock_handle, fcntl.LOCK_EX)
+        try:
+            snapshot = _read_json(snapshot_path)
+        except (FileNotFoundError, json.decoder.JSONDecodeError):
+            snapshot = None
+        if snapshot is not None and time.time() - snapshot["time"] < ttl:
+            return snapshot
+        try:
+            snapshot = query_cluster(partition)
+        except subprocess.CalledProcessError:
+            if snapshot is None:
+                raise
+            return snapshot
+        _write_json(snapshot_path, snapshot)
+    return snapshot
+
+
+def register(cache_dir, job_name, cost, cores):
+    """Register running search."""
+    os.makedirs(os.path.join(cache_dir, RUNNING_DIR), exist_ok=True)
+    _write_json(
+        os.path.join(cache_dir, RUNNING_DIR, f"{job_name}.json"),
+        {"cost": cost, "cores": cores, "time": time.time()},
+    )
+
+
+def unregister(cache_dir, job_name):
+    """Remove search from the running searches."""
+    try:
+        os.remove(os.path.join(cache_dir, RUNNING_DIR, f"{job_name}.json"))
+    except FileNotFoundError:
+        pass
+
+
+def running_searches(cache_dir, max_age):
+    """Return list of [cost, cores] of the running searches.
+
+    Entries older than max_age seconds are left overs of killed pipelines and
+    are removed.
+    """
+    running_dir = os.path.join(cache_dir, RUNNING_DIR)
+    searches = []
+    for file_name in os.listdir(running_dir):
+        if not file_name.endswith(".json"):
+            continue
+        path = os.path.join(running_dir, file_name)
+        try:
+            search = _read_json(path)
+        except (FileNotFoundError, json.decoder.JSONDecodeError):
+            continue
+        if time.time() - search["time"] > max_age:
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            continue
+        searches.append([search["cost"], search["cores"]])
+    return searches
+
+
+def allocate(cost, snapshot, running, min_cores, max_cores, cost_per_core):
+    """Return number of cores for a search with cost.
+
+    The cores held by the running searches plus the idle cores are shared in
+    proportion to the cost. Pending jobs of the queue keep one core each. The
+    result never exceeds the idle cores and a search gets at most one core per
+    cost_per_core, more threads do not pay off for small searches.
+    """
+    idle = max(0, snapshot["idle"] - snapshot["pending"])
+    budget = idle + sum(cores for _cost, cores in running)
+    total_cost = cost + sum(other_cost for other_cost, _cores in running)
+    share = int(budget * cost / total_cost) if total_cost > 0 else min_cores
+    worth = int(-(-cost // cost_per_core))
+    cores = min(share, idle, worth, max_cores)
+    return max(min_cores, cores)
@@ -0,0 +1,244 @@
+"""Keep built custom blast dbs for later parents.
+
+Users resubmit the same genome region with other pair distances or submit
+overlapping regions. The custom db of a parent only depends on its sequence,
+the db type (nt, refseq) and the version of the blast db, so a built db is
+moved into an entry of the cache, keyed by the hash of the three.
+
+    <cache_dir>/<key>/meta.json     sequence, db type, version, dbs, last use
+    <cache_dir>/<key>/db/           files of the dbs (makeblastdb -out)
+    <cache_dir>/<key>/refs/<job>    one file per job using the entry
+
+A job uses an entry through alias files (.nal) in its own blast_db dir, which
+point to the dbs of the entry. So the children of a parent find the db where
+they always did. An entry is also used by a parent whose sequence is part of
+the sequence of the entry, the regions of the db then cover the parent.
+
+A reference counts as long as the work dir of its job exists. Entries without
+references are evicted least recently used first once the cache is larger
+than its limit. A job finds an entry and takes its reference under the lock of
+the cache (acquire(), store()), so an entry can not be evicted in between.
+
+    python3 CustomDbCache.py stats <cache_dir> <work_dir>
+    python3 CustomDbCache.py evict <cache_dir> <work_dir> <max_bytes>
+"""
+
+import os
+import sys
+import json
+import time
+import fcntl
+import hashlib
+from glob import glob
+from shutil import move, rmtree
+
+META_FILE = "meta.json"
+LOCK_FILE = "cache.lock"
+DB_DIR = "db"
+REFS_DIR = "refs"
+
+ALIAS_TEMPLATE = "#\n# Alias file of RNAcode web, points to the custom db cache\n#\nTITLE {}\nDBLIST {}\n"
+
+
+def entry_key(sequence, db_type, db_version):
+    """Return key of the entry for a parent."""
+    content = f"{db_type}\n{db_version}\n{sequence.upper()}"
+    return hashlib.sha256(content.encode("UTF-8")).hexdigest()
+
+
+def _lock(cache_dir):
+    os.makedirs(cache_dir, exist_ok=True)
+    lock_handle = open(os.path.join(cache_dir, LOCK_FILE), "a", encoding="UTF-8")
+    fcntl.flock(lock_handle, fcntl.LOCK_EX)
+    return lock_handle
+
+
+def _read_meta(entry_dir):
+    """Return meta data of entry or None if it is incomplete."""
+    try:
+        with open(os.path.join(entry_dir, META_FILE), "r", encoding="UTF-8") as f_handle:
+            return json.load(f_handle)
+    except (FileNotFoundError, json.decoder.JSONDecodeError):
+        return None
+
+
+def _write_meta(entry_dir, meta):
+    path = os.path.join(entry_dir, META_FILE)
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, "w", encoding="UTF-8") as f_handle:
+        json.dump(meta, f_handle, indent=4)
+    os.replace(tmp_path, path)
+
+
+def _entries(cache_dir):
+    """Return [entry dir, meta data] of all complete entries."""
+    entries = []
+    for entry_dir in glob(os.path.join(cache_dir, "*", "")):
+        meta = _read_meta(entry_dir)
+        if meta is not None:
+            entries.append([entry_dir.rstrip("/"), meta])
+    return entries
+
+
+def _lookup(cache_dir, sequence, db_type, db_version):
+    """Return [entry dir, exact] of an entry covering sequence or None.
+
+    exact is True if the entry was built for the same sequence. Otherwise the
+    shortest entry containing sequence is returned. Needs the lock of the
+    cache.
+    """
+    entry_dir = os.path.join(cache_dir, entry_key(sequence, db_type, db_version))
+    if _read_meta(entry_dir) is not None:
+        return [entry_dir, True]
+    sequence = sequence.upper()
+    covering = [
+        [len(meta["sequence"]), entry_dir]
+        for entry_dir, meta in _entries(cache_dir)
+        if meta["db_type"] == db_type and meta["db_version"] == db_version and sequence in meta["sequence"]
+    ]
+    if len(covering) == 0:
+        return None
+    return [min(covering)[1], False]
+
+
+def acquire(cache_dir, sequence, db_type, db_version, db_dir, job_id):
+    """Let job use an entry covering sequence, see _lookup() and _link().
+
+    Sub dbs are only linked if the entry was built for the same sequence.
+    Returns [entry dir, exact, meta data] or None if there is no entry.
+    """
+    with _lock(cache_dir):
+        found = _lookup(cache_dir, sequence, db_type, db_version)
+        if found is None:
+            return None
+        entry_dir, exact = found
+        return [entry_dir, exact, _link(entry_dir, db_dir, job_id, sub_dbs=exact)]
+
+
+def store(cache_dir, sequence, db_type, db_version, db_dir, db_names, num_seqs, job_id):
+    """Move the dbs db_names in db_dir into a new entry used by job_id.
+
+    The first db is the whole custom db, the others are its sub dbs. They are
+    linked back into db_dir, see _link(). Returns the entry dir, None if an
+    other job stored the same entry meanwhile.
+    """
+    entry_dir = os.path.join(cache_dir, entry_key(sequence, db_type, db_version))
+    with _lock(cache_dir):
+        if _read_meta(entry_dir) is not None:
+            return None
+        if os.path.isdir(entry_dir):
+            # Left over of a failed store
+            rmtree(entry_dir)
+        os.makedirs(os.path.join(entry_dir, DB_DIR))
+        os.makedirs(os.path.join(entry_dir, REFS_DIR))
+        for db_name in db_names:
+            for path in glob(os.path.join(db_dir, f"{db_name}.*")):
+                move(path, os.path.join(entry_dir, DB_DIR, os.path.basename(path)))
+        _write_meta(
+            entry_dir,
+            {
+                "sequence": sequence.upper(),
+                "db_type": db_type,
+                "db_version": db_version,
+                "dbs": db_names,
+                "num_seqs": num_seqs,
+                "created": time.time(),
+                "last_used": time.time(),
+            },
+        )
+        _link(entry_dir, db_dir, job_id)
+    return entry_dir
+
+
+def _link(entry_dir, db_dir, job_id, sub_dbs=True):
+    """Let job use the entry.
+
+    Writes alias files to db_dir, the whole custom db gets the name job_id, a
+    sub db <name>_<suffix> gets job_id_<suffix>. Without sub_dbs only the
+    whole db is linked. Returns the meta data of the entry. Needs the lock of
+    the cache.
+    """
+    meta = _read_meta(entry_dir)
+    db_names = meta["dbs"] if sub_dbs else meta["dbs"][:1]
+    origin = meta["dbs"][0]
+    for db_name in db_names:
+        alias_name = job_id + db_name[len(origin):]
+        db_path = os.path.abspath(os.path.join(entry_dir, DB_DIR, db_name))
+        with open(os.path.join(db_dir, f"{alias_name}.nal"), "w", encoding="UTF-8") as f_handle:
+            f_handle.write(ALIAS_TEMPLATE.format(alias_name, db_path))
+    with open(os.path.join(entry_dir, REFS_DIR, job_id), "w", encoding="UTF-8") as f_handle:
+        f_handle.write("")
+    meta["last_used"] = time.time()
+    _write_meta(entry_dir, meta)
+    return meta
+
+
+def live_refs(entry_dir, work_dir):
+    """Return jobs using the entry, dead references are removed."""
+    refs = []
+    for ref_path in glob(os.path.join(entry_dir, REFS_DIR, "*")):
+        job_id = os.path.basename(ref_path)
+        if os.path.isdir(os.path.join(work_dir, job_id)):
+            refs.append(job_id)
+        else:
+            os.remove(ref_path)
+    return refs
+
+
+def entry_size(entry_dir):
+    """Return bytes of the files of an entry."""
+    return sum(os.path.getsize(path) for path in glob(os.path.join(entry_dir, DB_DIR, "*")))
+
+
+def evict(cache_dir, work_dir, max_bytes):
+    """Remove unused entries, least recently used first, down to max_bytes.
+
+    Returns the keys of the removed entries.
+    """
+    removed = []
+    with _lock(cache_dir):
+        entries = sorted(_entries(cache_dir), key=lambda entry: entry[1]["last_used"])
+        total = sum(entry_size(entry_dir) for entry_dir, _meta in entries)
+        for entry_dir, _meta in entries:
+            if total <= max_bytes:
+                break
+            if live_refs(entry_dir, work_dir):
+                continue
+            total -= entry_size(entry_dir)
+            rmtree(entry_dir)
+            removed.append(os.path.basename(entry_dir))
+    return removed
+
+
+def stats(cache_dir, work_dir):
+    """Return size and references of the entries."""
+    return {
+        os.path.basename(entry_dir): {
+            "db_type": meta["db_type"],
+            "db_version": meta["db_version"],
+            "length": len(meta["sequence"]),
+            "bytes": entry_size(entry_dir),
+            "refs": live_refs(entry_dir, work_dir),
+            "last_used": meta["last_used"],
+        }
+        for entry_dir, meta in _entries(cache_dir)
+    }
+
+
+def main():
+    """Command line interface."""
+    command = sys.argv[1]
+    cache_dir = sys.argv[2]
+    work_dir = sys.argv[3]
+    if command == "stats":
+        print(json.dumps(stats(cache_dir, work_dir), indent=4))
+    elif command == "evict":
+        for key in evict(cache_dir, work_dir, int(sys.argv[4])):
+            print(f"Removed {key}")
+    else:
+        print(f"Unknown command {command}", file=sys.stderr)
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
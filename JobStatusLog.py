@@ -0,0 +1,170 @@
+"""Status of a job as event log with snapshot.
+
+Every status change of a step used to rewrite job_status.json, so a reader
+(cat over ssh) could get half a file. Now a change is one line appended to
+
+    job_status.json.log     {"base": B} then {"seq": n, "key": step, "status": s}
+
+and the state at seq B is the snapshot job_status.json, a dict step -> status
+as before. The snapshot is only written by atomic rename, when the log is
+compacted: after COMPACT_EVENTS events and when fullJob changes. So readers of
+the snapshot alone never see half a file, they only lag behind. Readers of the
+log take a shared lock, writers an exclusive one.
+
+Sequence numbers grow over resets of a job: a reset starts at the time in
+milliseconds or after the last number, whichever is larger. A reader keeps the
+last number it saw and asks for the events since then:
+
+    python3 JobStatusLog.py since <job_status.json> <seq>
+
+prints {"seq": last seq, "reset": bool, "status": {...}}. If the reader is
+behind the snapshot (or the job has no log, as jobs of older versions) reset is
+true and status is the whole state, else status holds the changed steps, None
+for removed ones. A job with neither log nor snapshot, e.g. one whose status is
+not yet written, exits with an error like cat of a missing file.
+"""
+
+import os
+import sys
+import json
+import time
+import fcntl
+
+LOG_SUFFIX = ".log"
+LOCK_SUFFIX = ".lock"
+COMPACT_EVENTS = 200
+
+
+def _write_atomic(path, content):
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, "w", encoding="UTF-8") as f_handle:
+        f_handle.write(content)
+    os.replace(tmp_path, path)
+
+
+def _lock(status_path, operation=fcntl.LOCK_EX):
+    lock_handle = open(status_path + LOCK_SUFFIX, "a", encoding="UTF-8")
+    fcntl.flock(lock_handle, operation)
+    return lock_handle
+
+
+def _read_log(status_path):
+    """Return [base, events] of the log, None if there is no log.
+
+    A torn last line, left by a crashed writer, is left out.
+    """
+    try:
+        with open(status_path + LOG_SUFFIX, "r", encoding="UTF-8") as f_handle:
+            lines = f_handle.read().split("\n")
+    except FileNotFoundError:
+        return None
+    base = json.loads(lines[0])["base"]
+    events = []
+    for line in lines[1:]:
+        try:
+            events.append(json.loads(line))
+        except json.decoder.JSONDecodeError:
+            break
+    return [base, events]
+
+
+def _read_snapshot(status_path):
+    try:
+        with open(status_path, "r", encoding="UTF-8") as f_handle:
+            return json.load(f_handle)
+    except FileNotFoundError:
+        return {}
+
+
+def _apply(state, events):
+    for event in events:
+        if event["status"] is None:
+            state.pop(event["key"], None)
+        else:
+            state[event["key"]] = event["status"]
+    return state
+
+
+def _compact(status_path, state, seq):
+    """Write state as snapshot at seq and start a new log."""
+    _write_atomic(status_path, json.dumps(state, indent=4))
+    _write_atomic(status_path + LOG_SUFFIX, json.dumps({"base": seq}) + "\n")
+
+
+def reset(status_path, state):
+    """Start the status of a job with state, e.g. when the pipeline starts."""
+    with _lock(status_path):
+        log = _read_log(status_path)
+        last_seq = 0
+        if log is not None:
+            last_seq = log[1][-1]["seq"] if log[1] else log[0]
+        _compact(status_path, state, max(last_seq + 1, int(time.time() * 1000)))
+
+
+def append(status_path, key, status):
+    """Record that step key has status now, None removes the step.
+
+    Returns the seq of the event.
+    """
+    with _lock(status_path):
+        log = _read_log(status_path)
+        if log is None:
+            # Status file of an older version
+            reset_state = _read_snapshot(status_path)
+            seq = max(1, int(time.time() * 1000))
+            _compact(status_path, reset_state, seq)
+            log = [seq, []]
+        base, events = log
+        seq = (events[-1]["seq"] if events else base) + 1
+        event = {"seq": seq, "key": key, "status": status}
+        with open(status_path + LOG_SUFFIX, "a", encoding="UTF-8") as f_handle:
+            f_handle.write(json.dumps(event) + "\n")
+        if key == "fullJob" or len(events) + 1 >= COMPACT_EVENTS:
+            _compact(status_path, _apply(_read_snapshot(status_path), events + [event]), seq)
+    return seq
+
+
+def read(status_path):
+    """Return the current state of the job."""
+    return since(status_path, -1)["status"]
+
+
+def since(status_path, seq):
+    """Return the changes after seq, see module doc.
+
+    Raises FileNotFoundError if the job has no status.
+    """
+    with _lock(status_path, fcntl.LOCK_SH):
+        log = _read_log(status_path)
+        if log is None and not os.path.isfile(status_path):
+            raise FileNotFoundError(f"No status {status_path}")
+        state = _read_snapshot(status_path)
+    if log is None:
+        return {"seq": 0, "reset": True, "status": state}
+    base, events = log
+    last_seq = events[-1]["seq"] if events else base
+    if seq < base:
+        return {"seq": last_seq, "reset": True, "status": _apply(state, events)}
+    changes = {event["key"]: event["status"] for event in events if event["seq"] > seq}
+    return {"seq": last_seq, "reset": False, "status": changes}
+
+
+def main():
+    """Command line interface."""
+    command = sys.argv[1]
+    status_path = sys.argv[2]
+    try:
+        if command == "since":
+            print(json.dumps(since(status_path, int(sys.argv[3]))))
+        elif command == "show":
+            print(json.dumps(read(status_path), indent=4))
+        else:
+            print(f"Unknown command {command}", file=sys.stderr)
+            sys.exit(1)
+    except FileNotFoundError as exc:
+        print(exc, file=sys.stderr)
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -14,6 +14,7 @@ from time import sleep
 import re
 import subprocess
 import getpass
+import logging
 
 from filelock import FileLock
 from coolname import generate_slug
@@ -28,10 +29,35 @@ from RNAcodeWebCore import ALIGN_PATH_TEMPLATE
 from RNAcodeWebCore import ALIGN_PLOT_PATH_TEMPLATE
 from RNAcodeWebCore import WORK_DIR
 from RNAcodeWebCore import CURRENT_WORK_DIR_TEMPLATE
+from RNAcodeWebCore import CHILD_LENGTH
+from RNAcodeWebCore import child_windows
+
+import WebLog
 
 
 # Level of how much stuff should be logged. Either 0, 1, 2, 3.
 VERBOSE_LEVEL = 3
+# Only every n-th message of a verbose level is written to the log file, all
+# are kept for error reports, see WebLog.py.
+LOG_SAMPLE_RATES = {3: 10}
+LOGGER_NAME = "JobSubmission"
+for _level in range(1, 4):
+    logging.addLevelName(logging.INFO - _level, f"V{_level}")
+
+
+def _logger():
+    """Return the logger of the frontend, one log file per process."""
+    logger = logging.getLogger(LOGGER_NAME)
+    if not logger.handlers:
+        WebLog.setup(
+            LOGGER_NAME,
+            f"{LOG_DIR}/{{pid}}.log",
+            level=logging.INFO - VERBOSE_LEVEL,
+            rates={logging.INFO - level: rate for level, rate in LOG_SAMPLE_RATES.items()},
+        )
+    return logger
+
+
 def vprint(msg, verbose_level=0):
     """Print to verbose."""
 
@@ -40,10 +66,8 @@ def vprint(msg, verbose_level=0):
         raise ValueError("verbose level must be an integer")
     if 0 > verbose_level > 3:
         raise ValueError("verbose level must be between 0 and 3")
-    msg = datetime.datetime.today().strftime("[%d/%b/%Y %H:%M:%S] - - ") + str(msg)
     if verbose_level <= VERBOSE_LEVEL:
-        with open(f"{LOG_DIR}/{os.getpid()}.log", "a", encoding="UTF-8") as f_handle:
-            print(msg, file=f_handle, flush=True)
+        _logger().log(logging.INFO - verbose_level, str(msg))
 
 
 # Parameters
@@ -83,6 +107,7 @@ ALIG_FASTA_PATH_TEMPLATE = f"{RESULT_DIR}/{{}}_aln.fasta"
 ALIG_INFO_CHILD_PATH_TEMPLATE = f"{RESULT_DIR}/{{}}_alignment_info_children.tsv"
 HSS_TABLE_PATH_TEMPLATE = f"{RESULT_DIR}/{{}}_HSS_table.tsv"
 PROTEIN_LIST_PATH_TEMPLATE = f"{RESULT_DIR}/{{}}_Protein_list.csv"
+PACK_SPEC_PATH_TEMPLATE = f"{RESULT_DIR}/{{}}_children.tsv"
 
 # Default parameters for the jobs
 MIN_PAIR_DIST_DEFAULT = "10.0"
@@ -91,13 +116,20 @@ MAX_PAIR_DIST_DEFAULT = "60.0"
 DATE_FORMATION = "%B %d, %Y"
 
 IUPAC_ALPHABET = set("ACGTRYSWKMBDHVN")
-# Window size into which a child process will be cut from its parent job.
-CHILD_LENGTH = 1000
 
 # Every job with an input sequence greater than MAX_LEN_NO_SPLIT will be be
 # split up into multiple child jobs.
 MAX_LEN_NO_SPLIT = CHILD_LENGTH * 2
 
+# If True the children of a parent job are send to the backend in one go and
+# run packed in a job array, see RNAcodeWebCore_packed.py.
+PACK_CHILDREN = False
+
+# If True the children of a NCBI db parent get the parent sequence. The backend
+# then searches the parent once per taxonomic range and splits the hits into
+# the windows of the children.
+PARENT_LEVEL_SEARCH = False
+
 # Length below a job will use the standard NCBI DB. Every length above will
 # build its custom database.
 MIN_INPUT_LEN = 30
@@ -157,6 +189,7 @@ def blank_job_submission():
             "fullJob": ["R", 0],
             "jobStatus": ["R", 0],
         },
+        "status_seq": 0,
         "error_out": "",
         "input_check_dic": {
             "input_seq_nuc": "",
@@ -264,6 +297,10 @@ def read_bulk_json(f_handle):
 
 
 def _read_from_json(job_submission_path):
+    """Return attributes of a job submission file.
+
+    Attributes missing in files of older versions get their default.
+    """
     for _i in range(0, 3):
         with open(job_submission_path, "r", encoding="UTF-8") as f_handle:
             try:
@@ -276,7 +313,7 @@ def _read_from_json(job_submission_path):
     else:
         vprint(f"Persistent JSONDecodeError with file {job_submission_path}")
         raise JobNotFoundException
-    return attributes
+    return {**ATTRIBUTE_DEFAULTS, **attributes}
 
 
 def generate_bulk_submission_example():
@@ -400,6 +437,8 @@ def _build_r_table(segments):
 
 
 PUBLIC_ATTR = blank_job_submission().keys()
+# Attributes added after jobs were stored
+ATTRIBUTE_DEFAULTS = {"status_seq": 0}
 
 
 class NoSaveException(Exception):
@@ -498,8 +537,11 @@ class JobSubmission:
         """Safe job submission to file."""
         vprint(f"Save submission {self.job_id}", verbose_level=2)
         attributes = self.get_attributes()
-        with open(self.path, "w", encoding="UTF-8") as f_handle:
+        # Readers without lock must not see half a file
+        tmp_path = f"{self.path}.{os.getpid()}.tmp"
+        with open(tmp_path, "w", encoding="UTF-8") as f_handle:
             json.dump(attributes, f_handle, indent=4)
+        os.replace(tmp_path, self.path)
 
     def delete(self, backend=True, recursive=True):
         """Remove job submission file."""
@@ -661,12 +703,8 @@ class JobSubmission:
             self.job_hierarchy = "parent"
             self.status_dic = {}
             self.status_dic["jobStatus"] = ["R", 0]
-            for iterator, start in enumerate(
-                range(0, len(self.input_seq_nuc), int(CHILD_LENGTH / 2))
-            ):
+            for iterator, _window in enumerate(child_windows(len(self.input_seq_nuc))):
                 self.status_dic[f"{self.job_id}-child_{iterator+1}"] = ["NS", 0]
-                if start + CHILD_LENGTH >= len(self.input_seq_nuc):
-                    break
 
         if len(self.input_seq_nuc) > LENGTH_NO_CUSTOM:
             self.custom_db = True
@@ -679,9 +717,14 @@ class JobSubmission:
         else:
             self.custom_db = False
 
-    def submit(self):
+    def submit(self, pack_list=None, parent_seq_nuc=None):
         """Submit job to backend.
 
+        If pack_list is given the job is not send to the backend but appended
+        to pack_list, the parent then submits all its children packed. If
+        parent_seq_nuc is given it is passed to the NCBI db pipeline of a child
+        for the parent level search.
+
         This method needs that the job submission is locked, hence should be
         used with 'with ... as ...' syntax.
         """
@@ -720,42 +763,61 @@ class JobSubmission:
 
         if self.job_hierarchy == "parent":
             vprint(f"Job {self.job_id} is long will be split up", verbose_level=2)
-            len_parent_seq = len(self.input_seq_nuc)
-            for iterator, start in enumerate(
-                range(0, len_parent_seq, int(CHILD_LENGTH / 2))
-            ):
-                self._spawn_child(iterator, start)
-                if start + CHILD_LENGTH >= len_parent_seq:
-                    break
+            pack_list = [] if PACK_CHILDREN else None
+            for iterator, (start, _stop) in enumerate(child_windows(len(self.input_seq_nuc))):
+                self._spawn_child(iterator, start, pack_list)
+            if PACK_CHILDREN:
+                self._submit_packed(pack_list)
             vprint("All children submitted", verbose_level=3)
         else:
             if self.custom_db:
-                call_str = (
-                    "ssh-scp-api/submit_job_custom_db.sh "
-                    f"{self.job_id} "
-                    f"{self.min_pair_dist} "
-                    f"{self.max_pair_dist} "
-                    f"{self.genome_start} "
-                    f"{self.input_seq_nuc}"
-                )
+                pipeline = "custom_DB"
+                arguments = [
+                    self.job_id,
+                    self.min_pair_dist,
+                    self.max_pair_dist,
+                    self.genome_start,
+                    self.input_seq_nuc,
+                ]
             else:
-                call_str = (
-                    "ssh-scp-api/submit_job_ncbi_db.sh "
-                    f"{self.job_id} "
-                    f"{self.min_pair_dist} "
-                    f"{self.max_pair_dist} "
-                    f"{self.genome_start} "
-                    f"{self.db_type} "
-                    f"{self.input_seq_nuc}"
-                )
+                pipeline = "NCBI_DB"
+                arguments = [
+                    self.job_id,
+                    self.min_pair_dist,
+                    self.max_pair_dist,
+                    self.genome_start,
+                    self.db_type,
+                    self.input_seq_nuc,
+                ]
+                if parent_seq_nuc is not None:
+                    arguments.append(parent_seq_nuc)
 
-            vprint(call_str, verbose_level=3)
-            out = _ssh_call(call_str)
-            vprint(out, verbose_level=3)
+            if pack_list is not None:
+                # Parent sends all children to the backend at once
+                pack_list.append([pipeline] + [str(arg) for arg in arguments])
+            else:
+                call_str = f"ssh-scp-api/submit_job_{pipeline.lower()}.sh " + " ".join(
+                    str(arg) for arg in arguments
+                )
+                vprint(call_str, verbose_level=3)
+                out = _ssh_call(call_str)
+                vprint(out, verbose_level=3)
 
         self.submitted = True
 
-    def _spawn_child(self, iterator, start):
+    def _submit_packed(self, pack_list):
+        """Send children of parent to backend to run them packed."""
+        pack_spec_path = PACK_SPEC_PATH_TEMPLATE.format(self.job_id)
+        with open(pack_spec_path, "w", encoding="UTF-8") as f_handle:
+            for child in pack_list:
+                f_handle.write("\t".join(child) + "\n")
+        call_str = f"ssh-scp-api/submit_packed_children.sh {self.job_id} {pack_spec_path}"
+        vprint(call_str, verbose_level=3)
+        out = _ssh_call(call_str)
+        vprint(out, verbose_level=3)
+        os.remove(pack_spec_path)
+
+    def _spawn_child(self, iterator, start, pack_list=None):
         attributes = self.get_attributes()
         len_parent_seq = len(self.input_seq_nuc)
 
@@ -788,8 +850,9 @@ class JobSubmission:
         attributes["genome_start"] = start
         attributes["genome_stop"] = stop
         attributes["input_seq_nuc"] = self.input_seq_nuc[start:stop]
+        parent_seq_nuc = self.input_seq_nuc if PARENT_LEVEL_SEARCH else None
         with JobSubmission(attributes=attributes) as child_job:
-            child_job.submit()
+            child_job.submit(pack_list=pack_list, parent_seq_nuc=parent_seq_nuc)
 
     def _get_results(self):
         """Copy RNAcode results into results folder."""
@@ -907,20 +970,39 @@ class JobSubmission:
             "NS": "NS",
             "E": "E",
         }
-        call_str = f"ssh-scp-api/check_status.sh {JOB_STATUS_FILE_TEMPLATE.format(self.job_id)}"
+        # Only the changes since the last call are sent, see JobStatusLog.py
+        call_str = (
+            f"ssh-scp-api/check_status.sh {JOB_STATUS_FILE_TEMPLATE.format(self.job_id)} "
+            f"{self.status_seq}"
+        )
         vprint(call_str, verbose_level=3)
         out = _ssh_call(call_str)
         try:
-            status_dic = {k: [state_map[v[0]], v[1]] for k, v in json.loads(out).items()}
+            reply = json.loads(out)
         except json.decoder.JSONDecodeError:
             vprint("Json decoder Error!")
             vprint(out)
             raise
-        vprint(f"Backend status is:\n{json.dumps(status_dic, indent=2)}", verbose_level=3)
+        changes = {
+            k: None if v is None else [state_map[v[0]], v[1]] for k, v in reply["status"].items()
+        }
+        vprint(f"Backend status changes:\n{json.dumps(changes, indent=2)}", verbose_level=3)
         if self.custom_db and self.job_hierarchy == "parent":
-            self.status_dic["customDB"] = status_dic
+            if reply["reset"] or "customDB" not in self.status_dic:
+                self.status_dic["customDB"] = {}
+            status_dic = self.status_dic["customDB"]
         else:
-            self.status_dic.update(status_dic)
+            status_dic = self.status_dic
+            if reply["reset"]:
+                for key in list(status_dic):
+                    if key != "jobStatus":
+                        status_dic.pop(key)
+        for key, status in changes.items():
+            if status is None:
+                status_dic.pop(key, None)
+            else:
+                status_dic[key] = status
+        self.status_seq = reply["seq"]
 
     def check_status(self):
         """Check status of job.
@@ -0,0 +1,329 @@
+"""Pilot jobs for short pipeline steps.
+
+A pilot is a long lived SLURM allocation which pulls tasks from a shared queue
+and runs them right away. Short steps (sequence selection, alignment, RNAcode
+on a child window) therefore do not wait in the SLURM queue for every single
+step.
+
+The queue is a directory on the shared file system:
+
+    queue_dir/pending/<task_id>.json   waiting tasks
+    queue_dir/running/<task_id>.json   task claimed by a pilot
+    queue_dir/done/<task_id>.json      finished task with exit code
+    queue_dir/pilots/<slurm_id>.out    stdout/ stderr of the pilots
+
+Tasks are claimed with os.rename(), which is atomic on the same file system.
+So a task is only ever taken by one pilot. A pilot runs tasks as long as the
+cores they request fit into its cores, in the order they were submitted.
+
+Started as a script the module runs a pilot:
+
+    python3 PilotPool.py <queue_dir> <idle_timeout> <max_time> <cores>
+"""
+
+import os
+import sys
+import json
+import time
+import fcntl
+import signal
+import subprocess
+
+PENDING_DIR = "pending"
+RUNNING_DIR = "running"
+DONE_DIR = "done"
+PILOTS_DIR = "pilots"
+LOCK_FILE = "pool.lock"
+
+# Seconds a pilot waits between looking for new tasks.
+POLL_INTERVAL = 2
+# A pilot stops taking tasks if less than this many seconds are left of its
+# allocation.
+END_MARGIN = 10 * 60
+
+
+def init_queue(queue_dir):
+    """Create the directory structure of the queue."""
+    for sub_dir in [PENDING_DIR, RUNNING_DIR, DONE_DIR, PILOTS_DIR]:
+        os.makedirs(os.path.join(queue_dir, sub_dir), exist_ok=True)
+
+
+def _task_path(queue_dir, state, task_id):
+    return os.path.join(queue_dir, state, f"{task_id}.json")
+
+
+def _write_json(path, content):
+    """Write json file atomically."""
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, "w", encoding="UTF-8") as f_handle:
+        json.dump(content, f_handle)
+    os.replace(tmp_path, path)
+
+
+def _read_json(path):
+    with open(path, "r", encoding="UTF-8") as f_handle:
+        return json.load(f_handle)
+
+
+def submit_task(queue_dir, task_id, script_path, work_dir, output, error, env, max_time, cores=1):
+    """Put a task in the queue.
+
+    The task_id must be unique in the queue, the SLURM job name of the step is
+    used. env holds the environment variables which will be set for the
+    script. The script is killed after max_time seconds. cores is the number
+    of cores the script uses.
+    """
+    init_queue(queue_dir)
+    for state in [RUNNING_DIR, DONE_DIR]:
+        if os.path.isfile(_task_path(queue_dir, state, task_id)):
+            os.remove(_task_path(queue_dir, state, task_id))
+    task = {
+        "task_id": task_id,
+        "script_path": script_path,
+        "work_dir": work_dir,
+        "output": output,
+        "error": error,
+        "env": env,
+        "max_time": max_time,
+        "cores": cores,
+        "submit_time": time.time(),
+    }
+    _write_json(_task_path(queue_dir, PENDING_DIR, task_id), task)
+
+
+def task_state(queue_dir, task_id):
+    """Return state of task in SLURM notation or None if task is gone.
+
+    A task that finished or that was never submitted is gone, like a job that
+    is not listed by squeue anymore.
+    """
+    if os.path.isfile(_task_path(queue_dir, PENDING_DIR, task_id)):
+        return "PD"
+    if os.path.isfile(_task_path(queue_dir, RUNNING_DIR, task_id)):
+        return "R"
+    return None
+
+
+def task_exit_code(queue_dir, task_id):
+    """Return exit code of a finished task or None."""
+    done_path = _task_path(queue_dir, DONE_DIR, task_id)
+    if not os.path.isfile(done_path):
+        return None
+    return _read_json(done_path)["exit_code"]
+
+
+def cancel_task(queue_dir, task_id):
+    """Remove a task which is not yet running from the queue."""
+    try:
+        os.remove(_task_path(queue_dir, PENDING_DIR, task_id))
+    except FileNotFoundError:
+        pass
+
+
+def live_pilots(pilot_name):
+    """Return SLURM job ids of all pilots which are pending or running."""
+    call_str = f"squeue --name={pilot_name} -h --format=%i"
+    completed_process = subprocess.run(
+        call_str.split(), capture_output=True, text=True, check=True
+    )
+    return [line.strip() for line in completed_process.stdout.split("\n") if line.strip()]
+
+
+def _requeue_orphaned(queue_dir, pilot_ids):
+    """Put tasks back in the queue whose pilot died while running them."""
+    running_dir = os.path.join(queue_dir, RUNNING_DIR)
+    for file_name in os.listdir(running_dir):
+        if not file_name.endswith(".json"):
+            continue
+        running_path = os.path.join(running_dir, file_name)
+        try:
+            task = _read_json(running_path)
+        except (FileNotFoundError, json.decoder.JSONDecodeError):
+            continue
+        if task.get("pilot") in pilot_ids:
+            continue
+        # Just claimed, the pilot did not yet write its id
+        if "pilot" not in task and time.time() - _mtime(running_path) < 60:
+            continue
+        # The pending task must not carry the id of the dead pilot, else it is
+        # taken as orphaned again right after the next pilot claimed it. The
+        # file is written while still running, no pilot can claim it then.
+        task.pop("pilot", None)
+        _write_json(running_path, task)
+        try:
+            os.rename(running_path, os.path.join(queue_dir, PENDING_DIR, file_name))
+        except FileNotFoundError:
+            continue
+
+
+def ensure_pilots(queue_dir, pilot_name, num_pilots, sbatch_args, idle_timeout, max_time, cores):
+    """Start pilots until num_pilots are alive.
+
+    sbatch_args are additional arguments for sbatch (partition, export).
+    Tasks whose pilot is gone are put back in the queue. The pool lock makes
+    sure concurrent pipelines do not start too many pilots.
+    """
+    init_queue(queue_dir)
+    with open(os.path.join(queue_dir, LOCK_FILE), "a", encoding="UTF-8") as lock_handle:
+        fcntl.flock(lock_handle, fcntl.LOCK_EX)
+        pilot_ids = live_pilots(pilot_name)
+        _requeue_orphaned(queue_dir, pilot_ids)
+        pending = os.listdir(os.path.join(queue_dir, PENDING_DIR))
+        if len(pending) == 0:
+            return pilot_ids
+        pilot_output = os.path.join(queue_dir, PILOTS_DIR, "%j.out")
+        wrap = (
+            f"{sys.executable} {os.path.abspath(__file__)} "
+            f"{queue_dir} {idle_timeout} {max_time} {cores}"
+        )
+        for _i in range(num_pilots - len(pilot_ids)):
+            call = [
+                "sbatch",
+                f"--job-name={pilot_name}",
+                f"--output={pilot_output}",
+                f"--time={max(1, max_time // 60)}",
+                f"--cpus-per-task={cores}",
+                *sbatch_args,
+                f"--wrap={wrap}",
+            ]
+            completed_process = subprocess.run(
+                call, capture_output=True, text=True, check=True
+            )
+            pilot_ids.append(completed_process.stdout.split()[-1])
+    return pilot_ids
+
+
+class Pilot:
+    """Worker inside a pilot allocation."""
+
+    def __init__(self, queue_dir, idle_timeout, max_time, cores):
+        """Set up pilot for queue."""
+        self.queue_dir = queue_dir
+        self.idle_timeout = idle_timeout
+        self.end_time = time.time() + max_time
+        self.cores = cores
+        self.pilot_id = os.environ.get("SLURM_JOB_ID", str(os.getpid()))
+        # task_id -> [Popen, task, start time]
+        self.running = {}
+
+    def free_cores(self):
+        """Return cores not used by running tasks."""
+        return self.cores - sum(self.task_cores(task) for _process, task, _start in self.running.values())
+
+    def task_cores(self, task):
+        """Return cores of task, at most the cores of the pilot."""
+        return min(max(1, task.get("cores", 1)), self.cores)
+
+    def claim_task(self):
+        """Move the oldest pending task to running. Return task or None.
+
+        None is also returned if the oldest task needs more cores than are
+        free, so it is not overtaken by smaller tasks.
+        """
+        pending_dir = os.path.join(self.queue_dir, PENDING_DIR)
+        file_names = [f for f in os.listdir(pending_dir) if f.endswith(".json")]
+        file_names.sort(key=lambda f: _mtime(os.path.join(pending_dir, f)))
+        for file_name in file_names:
+            pending_path = os.path.join(pending_dir, file_name)
+            try:
+                if self.task_cores(_read_json(pending_path)) > self.free_cores():
+                    return None
+            except (FileNotFoundError, json.decoder.JSONDecodeError):
+                # Another pilot was faster
+                continue
+            running_path = os.path.join(self.queue_dir, RUNNING_DIR, file_name)
+            try:
+                os.rename(pending_path, running_path)
+            except FileNotFoundError:
+                # Another pilot was faster
+                continue
+            try:
+                task = _read_json(running_path)
+            except (FileNotFoundError, json.decoder.JSONDecodeError):
+                # Put back in the queue meanwhile
+                continue
+            task["pilot"] = self.pilot_id
+            _write_json(running_path, task)
+            return task
+        return None
+
+    def start_task(self, task):
+        """Run task script in the background."""
+        env = os.environ.copy()
+        env.update(task["env"])
+        with open(task["output"], "w", encoding="UTF-8") as out_handle, open(
+            task["error"], "w", encoding="UTF-8"
+        ) as err_handle:
+            process = subprocess.Popen(
+                ["bash", task["script_path"]],
+                cwd=task["work_dir"],
+                stdout=out_handle,
+                stderr=err_handle,
+                env=env,
+                start_new_session=True,
+            )
+        self.running[task["task_id"]] = [process, task, time.time()]
+
+    def finish_task(self, task_id, exit_code):
+        """Mark task as done."""
+        _process, task, start_time = self.running.pop(task_id)
+        task["exit_code"] = exit_code
+        task["run_time"] = time.time() - start_time
+        _write_json(_task_path(self.queue_dir, DONE_DIR, task_id), task)
+        try:
+            os.remove(_task_path(self.queue_dir, RUNNING_DIR, task_id))
+        except FileNotFoundError:
+            pass
+
+    def check_running(self):
+        """Collect finished tasks and kill tasks over their time limit."""
+        for task_id, (process, task, start_time) in list(self.running.items()):
+            exit_code = process.poll()
+            if exit_code is not None:
+                self.finish_task(task_id, exit_code)
+                continue
+            if time.time() - start_time > task["max_time"]:
+                os.killpg(process.pid, signal.SIGKILL)
+                process.wait()
+                # Same message as SLURM, so the pipeline handles it the same way
+                with open(task["error"], "a", encoding="UTF-8") as err_handle:
+                    err_handle.write(f"*** JOB {task_id} CANCELLED DUE TO TIME LIMIT ***\n")
+                self.finish_task(task_id, process.returncode)
+
+    def run(self):
+        """Pull tasks until idle for too long or the allocation ends."""
+        last_busy = time.time()
+        while True:
+            self.check_running()
+            accept_tasks = time.time() < self.end_time - END_MARGIN
+            while accept_tasks and self.free_cores() > 0:
+                task = self.claim_task()
+                if task is None:
+                    break
+                self.start_task(task)
+            if self.running:
+                last_busy = time.time()
+            elif not accept_tasks or time.time() - last_busy > self.idle_timeout:
+                break
+            time.sleep(POLL_INTERVAL)
+
+
+def _mtime(path):
+    try:
+        return os.path.getmtime(path)
+    except FileNotFoundError:
+        return float("inf")
+
+
+def main():
+    """Run pilot."""
+    queue_dir = sys.argv[1]
+    idle_timeout = int(sys.argv[2])
+    max_time = int(sys.argv[3])
+    cores = int(sys.argv[4])
+    init_queue(queue_dir)
+    Pilot(queue_dir, idle_timeout, max_time, cores).run()
+
+
+if __name__ == "__main__":
+    main()
@@ -11,23 +11,37 @@ RNAcodeWeb_build_db
 
 import json
 import sys
+import logging
 import os
 import urllib.request
+import socket
 import subprocess
 import re
 import time
+import threading
 import traceback
+import functools
 from glob import glob
+from shutil import rmtree
 from collections import defaultdict
 
-from ete3 import Tree
-
 import jinja2
 
 import SeqSelection
 from SeqSelection import MIN_NUM_SEQ
 from SeqSelection import collect_sequences
 
+import PilotPool
+import StepExecutor
+import CoreAllocator
+import ResourcePredictor
+import BlastSearch
+import BlastDbCache
+import ArtifactCache
+import TreePlot
+import JobStatusLog
+import WebLog
+
 with open("./parameters_backend_local.json", "r", encoding="UTF-8") as file_handle:
     PARAMETERS_BACKEND = json.load(file_handle)
 
@@ -49,23 +63,140 @@ PATH = ":".join(
 )
 
 PYTHON_ENV_SEQSEL_PATH = PARAMETERS_BACKEND["python_env_seqSel_path"]
-BLAST_DB_PATH = PARAMETERS_BACKEND["blast_db"]
+# The blast db is a symlink to the active version, see
+# system_setup/update_blast_db.sh. A pipeline resolves it once, so it stays
+# on the version it started with while the db is updated.
+BLAST_DB_PATH = os.path.realpath(PARAMETERS_BACKEND["blast_db"])
+try:
+    with open(BLAST_DB_PATH + "/VERSION", "r", encoding="UTF-8") as file_handle:
+        DB_VERSION = file_handle.read().strip()
+except OSError:
+    DB_VERSION = "unversioned"
+# Pipelines mark the version they use, old versions in use are not removed.
+DB_IN_USE_DIR = BLAST_DB_PATH + "/.in_use"
 WORK_DIR = PARAMETERS_BACKEND["work_dir"]
 
-# Depending on number of idle cores (range) allow n cores. For blast
-CORE_USE_DIC = {
-    range(0, 11): 1,
-    range(11, 21): 2,
-    range(21, 31): 3,
-    range(31, 41): 4,
-    range(41, 161): 5,
+# Cores for blast are shared between the running searches by their expected
+# cost, see CoreAllocator.py. The cluster state is cached for
+# CLUSTER_SNAPSHOT_TTL seconds.
+CORE_ALLOCATOR_DIR = WORK_DIR + "/.core_allocator"
+CLUSTER_SNAPSHOT_TTL = 60
+MIN_BLAST_CORES = 1
+MAX_BLAST_CORES = 16
+# A search gets one core per this much cost. A query of 1000 nt against nt
+# with word size 11 has a cost of 1000.
+BLAST_COST_PER_CORE = 250
+# Relative size of the blast dbs.
+DB_COST_FACTOR_DIC = {
+    "nt": 1.0,
+    "refseq": 0.4,
+    "custom": 0.02,
 }
 
 P_THRESHOLD = 0.05
+# Block RNAcode. An alignment longer than RNACODE_BLOCK_LENGTH columns is cut
+# into blocks, which overlap by RNACODE_BLOCK_OVERLAP columns. RNAcode runs on
+# the blocks as job array, see rnacode_blocks().
+BLOCK_RNACODE = False
+RNACODE_BLOCK_LENGTH = 3000
+RNACODE_BLOCK_OVERLAP = 300
+# Tries of a block, RNAcode segfaults now and then
+RNACODE_BLOCK_TRIES = 2
+# Aligner of the alignment step, "clustalo", "mafft" or "auto". auto takes mafft
+# for at least MAFFT_MIN_SEQS sequences or sequences of at least MAFFT_MIN_LEN
+# bases, see auxilary_scripts/benchmark_aligners.py. Threads grow with the
+# number of sequences, one per ALIGN_SEQS_PER_THREAD up to ALIGN_MAX_THREADS.
+ALIGNER = "clustalo"
+MAFFT_MIN_SEQS = 200
+MAFFT_MIN_LEN = 4000
+ALIGN_SEQS_PER_THREAD = 50
+ALIGN_MAX_THREADS = 8
+# Two stage RNAcode. A screen with RNACODE_SCREEN_SAMPLES samples keeps HSS with
+# p below RNACODE_SCREEN_P, only the columns of these HSS, padded by
+# RNACODE_REFINE_PADDING columns, are scored again with the default number of
+# samples and plotted, see rnacode_two_stage().
+TWO_STAGE_RNACODE = False
+RNACODE_SCREEN_SAMPLES = 20
+RNACODE_SCREEN_P = 4 * P_THRESHOLD
+RNACODE_REFINE_PADDING = 150
+
+# Window size into which a child process will be cut from its parent job.
+CHILD_LENGTH = 1000
+
+# Where the steps are executed. "slurm" uses STEP_EXECUTOR_DIC, "local" runs
+# every step as sub process on this machine. Local is used on a single
+# workstation and inside the allocation of packed child jobs, see
+# RNAcodeWebCore_packed.py.
+EXECUTION_MODE = os.environ.get("RNACODE_WEB_EXECUTION", "slurm")
+# Number of cores a pipeline may use in local mode.
+LOCAL_CORES = int(os.environ.get("RNACODE_WEB_LOCAL_CORES", str(os.cpu_count() or 1)))
+# Executor for each step type, see StepExecutor.py. "slurm", "local", "pilot"
+# or "auto". Auto sends short steps to the pilots in pilot mode and everything
+# else to SLURM.
+STEP_EXECUTOR_DIC = {
+    "blastn": "slurm",
+    "seqSel": "auto",
+    "alignment": "auto",
+    "RNAcode": "auto",
+    "buildDB": "slurm",
+    "pack": "slurm",
+}
+SLURM_PARTITION = "main"
+# Sharded blast. Searches against nt and refseq are split over groups of db
+# volumes, which run as tasks of a job array, see BlastSearch.py.
+SHARDED_BLAST = False
+NUM_BLAST_SHARDS = 8
+# Db of the blast call in the wrapper of a shard
+SHARD_DB = "${SHARDS[$SLURM_ARRAY_TASK_ID]}"
+
+# Before a search the volumes of the blast db are warmed into the page cache
+# of the node, see BlastDbCache.py. Off until the hit rate shows it helps.
+WARM_BLAST_DB = False
+BLAST_DB_CACHE_DIR = WORK_DIR + "/.blast_db_cache/" + DB_VERSION
+
+# Time limit in seconds and memory limit in MB of steps. The requested time
+# and memory of a step are predicted from the history of earlier steps, see
+# ResourcePredictor.py. Without enough history MAX_STEP_TIME and no memory
+# limit is requested.
+MAX_STEP_TIME = 10 * 60 * 60
+MIN_STEP_TIME = 10 * 60
+MAX_STEP_MEM = 64000
+MIN_STEP_MEM = 1000
+RESOURCE_HISTORY_PATH = WORK_DIR + "/.resource_history.jsonl"
+RESOURCE_QUANTILE = 0.95
+RESOURCE_SAFETY_FACTOR = 1.5
+RESOURCE_MIN_RECORDS = 20
+# A step which ran out of time or memory is retried with
+# RESOURCE_ESCALATION_FACTOR times more of it. A step without memory limit
+# gets MAX_STEP_MEM.
+MAX_RESOURCE_RETRIES = 2
+RESOURCE_ESCALATION_FACTOR = 2
+
+# Pilot mode. Short steps are not submitted with sbatch but are run by a few
+# long lived SLURM allocations (pilots), which pull them from a shared queue.
+PILOT_MODE = False
+PILOT_QUEUE_DIR = WORK_DIR + "/.pilot_queue"
+PILOT_JOB_NAME = "RNAcodeWeb_pilot"
+NUM_PILOTS = 2
+PILOT_CORES = 4
+# Pilots end after this many seconds without a task, or after max time.
+PILOT_IDLE_TIMEOUT = 15 * 60
+PILOT_MAX_TIME = 4 * 60 * 60
+# Steps with a smaller expected run time in seconds are send to a pilot.
+PILOT_MAX_COST = 5 * 60
+# Rough run time in seconds per nucleotide of the input for each step type.
+STEP_COST_DIC = {
+    "blastn": 2.0,
+    "seqSel": 0.1,
+    "alignment": 0.02,
+    "RNAcode": 0.05,
+    "buildDB": 0.5,
+}
 
 # Should be set in sub modules in get_arguments()
 JOB_ID = None
 GENOME_START = None
+INPUT_SEQ_LEN = None
 DB_TYPE = None
 BLAST_DB = None
 VERBOSE = True
@@ -73,10 +204,15 @@ REFERENCE_SPECIES = None
 ANCESTORS = []
 NCBI = None
 ALL_TAXIDS_BLAST_DB = None
+# Set by --resume, see take_resume_flag()
+RESUME = False
 
 # general structure
 STDOUT_FILE_PATH = "./logs/{}.out"
 STDERR_FILE_PATH = "./logs/{}.err"
+# Log files the logger writes to, see _logger()
+LOGGER_NAME = "RNAcodeWebCore"
+_LOG_SETUP = None
 
 CURRENT_WORK_DIR_TEMPLATE = WORK_DIR + "/{}"
 SLURM_OUTPUT_TEMPLATE = CURRENT_WORK_DIR_TEMPLATE + "/{}.out"
@@ -95,6 +231,13 @@ INPUT_FILE_PATH_TEMPLATE = (
     CURRENT_WORK_DIR_TEMPLATE + "/" + SeqSelection.INPUT_FILE_PATH
 )
 TAXIDS_PATH_TEMPLATE = CURRENT_WORK_DIR_TEMPLATE + "/{}_taxid_list.txt"
+# Taxid list of the taxonomic range without exclusion of selected species
+RANK_TAXIDS_PATH_TEMPLATE = CURRENT_WORK_DIR_TEMPLATE + "/{}_rank_taxid_list.txt"
+SENSITIVE_BLAST_RESULT_PATH_TEMPLATE = CURRENT_WORK_DIR_TEMPLATE + "/sensitive_blastn.tsv"
+# Parent level search, the search dir is in the work dir of the parent
+PARENT_INPUT_FILE_PATH_TEMPLATE = CURRENT_WORK_DIR_TEMPLATE + "/parent_input.fasta"
+PARENT_BLAST_RESULT_PATH_TEMPLATE = CURRENT_WORK_DIR_TEMPLATE + "/{}_parent_blastn.tsv"
+PARENT_SEARCH_DIR_TEMPLATE = CURRENT_WORK_DIR_TEMPLATE + "/parent_search"
 BLAST_WRAPPER_PATH_TEMPLATE = CURRENT_WORK_DIR_TEMPLATE + "/{}_blastn.sh"
 GI_LIST_PATH_TEMPLATE = CURRENT_WORK_DIR_TEMPLATE + "/{}_gilist.txt"
 # sequence selection
@@ -119,12 +262,38 @@ ALIGN_PLOT_PATH_TEMPLATE = CURRENT_WORK_DIR_TEMPLATE + "/alignment.svg"
 # RNAcode
 RNACODE_SCRIPT_PATH_TEMPLATE = CURRENT_WORK_DIR_TEMPLATE + "/RNAcode.sh"
 RNACODE_RESULT_PATH_TEMPLATE = CURRENT_WORK_DIR_TEMPLATE + "/rnacode_result.tsv"
+RNACODE_SCREEN_SCRIPT_PATH_TEMPLATE = CURRENT_WORK_DIR_TEMPLATE + "/RNAcode_screen.sh"
+RNACODE_SCREEN_RESULT_PATH_TEMPLATE = CURRENT_WORK_DIR_TEMPLATE + "/rnacode_screen.tsv"
 EPS_PATH_TEMPLATE = CURRENT_WORK_DIR_TEMPLATE + "/eps"
+RNACODE_BLOCK_DIR_TEMPLATE = CURRENT_WORK_DIR_TEMPLATE + "/rnacode_blocks"
+RNACODE_BLOCK_SCRIPT_PATH_TEMPLATE = CURRENT_WORK_DIR_TEMPLATE + "/RNAcode_blocks.sh"
 # Build DB
 # This is only path that is relative not absolute
 CUSTOM_DB_PATH = "blast_db"
+# Built custom dbs are kept for later parents with the same or a covering
+# sequence, see CustomDbCache.py. Unused dbs are evicted above the size limit.
+CUSTOM_DB_CACHE = True
+CUSTOM_DB_CACHE_DIR = WORK_DIR + "/.custom_db_cache"
+CUSTOM_DB_CACHE_SIZE = 200 * 1024**3
+# Outputs of blast, alignment and RNAcode are reused for steps with the same
+# inputs and tool versions, see ArtifactCache.py and run_step().
+ARTIFACT_CACHE = True
+ARTIFACT_CACHE_DIR = WORK_DIR + "/.artifact_cache"
+# Finished steps leave a marker with the hash of their inputs. A pipeline
+# started with --resume keeps its work dir and skips steps with a valid
+# marker, see step_done().
+CHECKPOINT_DIR_TEMPLATE = CURRENT_WORK_DIR_TEMPLATE + "/.checkpoints"
+# Optional sub dbs of the custom db, one per segment of the parent, see
+# custom_db_name()
+CUSTOM_DB_SEGMENT_LENGTH = 20 * CHILD_LENGTH
+CUSTOM_DB_SEGMENT_TEMPLATE = "{}_segment_{}"
 BLAST_DB_FASTA_PATH_TEMPLATE = CURRENT_WORK_DIR_TEMPLATE + "/blast_db.fasta"
 BUILD_DB_WRAPPER_PATH_TEMPLATE = CURRENT_WORK_DIR_TEMPLATE + "/build_db.sh"
+QUERY_CHUNK_PATH_TEMPLATE = CURRENT_WORK_DIR_TEMPLATE + "/query_chunk_{}.fasta"
+# Search of all children against the custom db, in the work dir of the parent
+CHILD_BLAST_DIR = "child_blast"
+CHILD_BLAST_WRAPPER_PATH_TEMPLATE = CURRENT_WORK_DIR_TEMPLATE + "/child_blastn.sh"
+CHILD_BLAST_RESULT_PATH_TEMPLATE = CURRENT_WORK_DIR_TEMPLATE + f"/{CHILD_BLAST_DIR}/{{}}.tsv"
 
 OUTFMT = (
     "6 evalue bitscore pident sseqid slen sstart send sframe qstart "
@@ -142,14 +311,54 @@ CLUSTALO_WRAPPER_TEMPLATE = (
     "set -e\n\n"
     "clustalo-1.2.4-Ubuntu-x86_64 -i {} -o {} "
     "--output-order=input-order --outfmt=clu --force "
-    "--guidetree-out={}\n"
+    "--guidetree-out={} --threads={}\n"
+)
+
+# FFT-NS-2, the progressive method of mafft which writes its guide tree to
+# <input>.tree. The labels of the tree are <index>_<name>. mafft reports its
+# progress on stderr, which would fail the step.
+MAFFT_WRAPPER_TEMPLATE = (
+    "#!/bin/bash\n\n"
+    "set -e\n\n"
+    "mafft --retree 2 --thread {3} --inputorder --preservecase --clustalout "
+    "--treeout {0} > {1} 2> mafft.log || {{ cat mafft.log >&2; exit 1; }}\n"
+    "sed -E 's/(^|[(,])[0-9]+_/\\1/g' {0}.tree > {2}\n"
+    "rm {0}.tree\n"
 )
 
+ALIGNER_NAMES = {
+    "clustalo": "Clustal Omega",
+    "mafft": "MAFFT",
+}
+
+ALIGN_WRAPPER_TEMPLATES = {
+    "clustalo": CLUSTALO_WRAPPER_TEMPLATE,
+    "mafft": MAFFT_WRAPPER_TEMPLATE,
+}
+
 RNACODE_SCRIPT_TEMPLATE = (
     "#!/bin/bash\n\n"
     f"set -e\n\nRNAcode -o {{}} -t {{}} -p {P_THRESHOLD} -e --eps-dir {{}}\n"
 )
 
+RNACODE_SCREEN_SCRIPT_TEMPLATE = (
+    "#!/bin/bash\n\n"
+    f"set -e\n\nRNAcode -o {{}} -t {{}} -n {RNACODE_SCREEN_SAMPLES} -p {RNACODE_SCREEN_P}\n"
+)
+
+# One task of the job array per block of the alignment, see run_rnacode_blocks().
+# The result is renamed once RNAcode finished, so a crashed block has none.
+RNACODE_BLOCK_SCRIPT_TEMPLATE = (
+    "#!/bin/bash\n\n"
+    "set -e\n\n"
+    "BLOCKS=({})\n"
+    "BLOCK=${{BLOCKS[$SLURM_ARRAY_TASK_ID]}}\n\n"
+    "cd {}\n"
+    "mkdir -p eps_$BLOCK\n"
+    f"RNAcode -o result_$BLOCK.tsv.tmp -t block_$BLOCK.maf -p {P_THRESHOLD} -e --eps-dir eps_$BLOCK\n"
+    "mv result_$BLOCK.tsv.tmp result_$BLOCK.tsv\n"
+)
+
 
 class PipelineFailed(Exception):
     """Exception if pipeline failed before finishing completly."""
@@ -159,22 +368,154 @@ class PipelineError(Exception):
     """Exception if pipeline failed before finishing completly."""
 
 
-def get_number_idles_cpus():
-    """Return number of idle cores."""
-    call_str = "sinfo -a --format='%C'"
+class ResourceLimitExceeded(PipelineError):
+    """Exception if a step ran out of time or memory."""
+
+    def __init__(self, resource):
+        """Set resource, "time" or "mem"."""
+        super().__init__(resource)
+        self.resource = resource
+
+
+class StepCancelled(Exception):
+    """Exception if a step was cancelled by the pipeline, see cancel_step()."""
+
+
+def blast_cost(word_size, db_type):
+    """Return expected cost of a blast search of the input sequence.
+
+    The cost grows with the length of the query and the size of the db. It
+    roughly doubles with every base the word size is shorter.
+    """
+    query_len = INPUT_SEQ_LEN or 1000
+    return query_len * DB_COST_FACTOR_DIC.get(db_type, 1.0) * 2 ** (11 - word_size)
+
+
+def get_blast_cores(cost):
+    """Return number of cores for a blast search with cost."""
+    if EXECUTION_MODE == "local":
+        worth = int(-(-cost // BLAST_COST_PER_CORE))
+        return max(MIN_BLAST_CORES, min(LOCAL_CORES, worth, MAX_BLAST_CORES))
     try:
-        completed_process = subprocess.run(call_str.split(), capture_output=True, text=True, check=True)
+        snapshot = CoreAllocator.cluster_snapshot(
+            CORE_ALLOCATOR_DIR, CLUSTER_SNAPSHOT_TTL, SLURM_PARTITION
+        )
     except subprocess.CalledProcessError as exc:
         eprint("Error determining free cores")
-        eprint(call_str)
+        eprint(exc.cmd)
         eprint(exc.stdout)
         eprint(exc.stderr)
         raise
-    return int(completed_process.stdout.split("\n")[1].split("/")[1])
+    running = CoreAllocator.running_searches(CORE_ALLOCATOR_DIR, MAX_STEP_TIME)
+    cores = CoreAllocator.allocate(
+        cost, snapshot, running, MIN_BLAST_CORES, MAX_BLAST_CORES, BLAST_COST_PER_CORE
+    )
+    vprint(f"Blast cost {cost:.0f}, {len(running)} searches running, use {cores} cores")
+    return cores
+
+
+_BLAST_SHARDS = {}
+_BLAST_DB_SIZES = {}
+
+
+def blast_db_size(db_names):
+    """Return number of bases of the blast dbs db_names."""
+    if db_names not in _BLAST_DB_SIZES:
+        current_env = os.environ.copy()
+        current_env["PATH"] = PATH
+        current_env["BLASTDB"] = BLAST_DB_PATH
+        try:
+            _BLAST_DB_SIZES[db_names] = BlastSearch.db_size(db_names, env=current_env)
+        except subprocess.CalledProcessError as exc:
+            eprint("Error determining size of blast db")
+            eprint(exc.cmd)
+            eprint(exc.stdout)
+            eprint(exc.stderr)
+            raise
+    return _BLAST_DB_SIZES[db_names]
+
+
+def blast_shards(db_names):
+    """Return [volume groups, size of db] for a sharded search of db_names."""
+    if db_names not in _BLAST_SHARDS:
+        volumes = BlastSearch.db_volumes(BLAST_DB_PATH, db_names)
+        _BLAST_SHARDS[db_names] = [
+            BlastSearch.group_volumes(volumes, NUM_BLAST_SHARDS),
+            blast_db_size(db_names),
+        ]
+    return _BLAST_SHARDS[db_names]
+
+
+def shard_blast_wrapper(blast_wrapper, shards, db_size):
+    """Turn a blast wrapper into the wrapper of the tasks of a sharded search.
+
+    The blastn call must be the last line and search the db SHARD_DB. Every
+    shard searches with the size of the whole db.
+    """
+    header, blast_call = blast_wrapper.rstrip("\n").rsplit("\n", 1)
+    shard_list = " ".join(f'"{" ".join(volumes)}"' for volumes in shards)
+    return f"{header}\nSHARDS=({shard_list})\n\n{blast_call} -dbsize {db_size}\n"
+
+
+def warm_blast_wrapper(blast_wrapper, blast_db):
+    """Add warming of the db volumes into page cache before the blastn call.
+
+    Errors of warming are ignored, the search runs anyway.
+    """
+    if not WARM_BLAST_DB:
+        return blast_wrapper
+    header, blast_call = blast_wrapper.rstrip("\n").rsplit("\n", 1)
+    warm_call = (
+        f"python3 {os.path.abspath(BlastDbCache.__file__)} warm "
+        f'{BLAST_DB_CACHE_DIR} {BLAST_DB_PATH} "{blast_db}" 2> /dev/null || true'
+    )
+    return f"{header}\n{warm_call}\n\n{blast_call}\n"
+
+
+def child_windows(seq_len):
+    """Return [start, stop] of the children of a parent with length seq_len.
+
+    Children overlap by half, the last child ends with the parent.
+    """
+    windows = []
+    for start in range(0, seq_len, int(CHILD_LENGTH / 2)):
+        windows.append([start, min(start + CHILD_LENGTH, seq_len)])
+        if start + CHILD_LENGTH >= seq_len:
+            break
+    return windows
+
+
+def custom_db_name(parent_job_id, genome_start):
+    """Return name of the custom db a child starting at genome_start searches.
+
+    This is the db of the segment of the parent the child starts in, if the
+    parent built segment dbs, else the db of the parent. Paths are relative to
+    the work dir of the child.
+    """
+    segment_db = CUSTOM_DB_SEGMENT_TEMPLATE.format(
+        parent_job_id, genome_start // CUSTOM_DB_SEGMENT_LENGTH
+    )
+    custom_db_dir = f"{CURRENT_WORK_DIR_TEMPLATE.format(parent_job_id)}/{CUSTOM_DB_PATH}"
+    if glob(f"{custom_db_dir}/{segment_db}.n*"):
+        return segment_db
+    return parent_job_id
+
+
+def mark_db_in_use(in_use):
+    """Mark or unmark the blast db version as used by this pipeline."""
+    if not os.path.isdir(DB_IN_USE_DIR):
+        return
+    marker = f"{DB_IN_USE_DIR}/{os.getpid()}@{socket.gethostname()}"
+    if in_use:
+        with open(marker, "w", encoding="UTF-8") as f_handle:
+            f_handle.write(str(JOB_ID))
+    elif os.path.isfile(marker):
+        os.remove(marker)
 
 
 def start_pipeline(main):
     """Start pipeline and handle errors."""
+    mark_db_in_use(True)
     try:
         main()
     except KeyboardInterrupt:
@@ -197,14 +538,22 @@ def start_pipeline(main):
         write_status_file(f"fullJob.{JOB_ID}", ["E", "pipe_broken"])
         notify_frontend(JOB_ID)
         sys.exit(1)
+    finally:
+        mark_db_in_use(False)
 
 
 def notify_frontend(job_id):
-    """Notify frontend that job finished."""
+    """Notify frontend that job finished.
+
+    notify=1 makes the frontend check the status now, even if a visit of the
+    page checked it a moment ago.
+    """
+    # The frontend reads the logs
+    WebLog.flush()
     if PORT_FRONTEND == "None":
-        url = f"http://{IP_FRONTEND}/submission/{job_id}"
+        url = f"http://{IP_FRONTEND}/submission/{job_id}?notify=1"
     else:
-        url = f"http://{IP_FRONTEND}:{PORT_FRONTEND}/submission/{job_id}"
+        url = f"http://{IP_FRONTEND}:{PORT_FRONTEND}/submission/{job_id}?notify=1"
     for i in range(1, 4):
         try:
             urllib.request.urlopen(url)
@@ -218,21 +567,36 @@ def notify_frontend(job_id):
             continue
 
 
+def _logger():
+    """Return the logger of the pipeline, set up for the current log files."""
+    global _LOG_SETUP
+    log_setup = [STDOUT_FILE_PATH or None, STDERR_FILE_PATH or None, JOB_ID or "-"]
+    if log_setup != _LOG_SETUP:
+        WebLog.setup(LOGGER_NAME, log_setup[0], log_setup[1], job_id=log_setup[2])
+        _LOG_SETUP = log_setup
+    return logging.getLogger(LOGGER_NAME)
+
+
+def log_step(job_name, message, duration=None):
+    """Log message of a step with its duration in seconds."""
+    if VERBOSE:
+        _logger().info(message, extra={"step": job_name.split(".")[0], "duration": duration})
+
+
 def eprint(*a, **k):
     """Print to stderr."""
-    if not STDERR_FILE_PATH:
-        print(*a, file=sys.stderr, flush=True, **k)
-    else:
-        with open(STDERR_FILE_PATH, "a", encoding="UTF-8") as f_handle:
-            print(*a, file=f_handle, flush=True, **k)
+    _logger().error(k.get("sep", " ").join(str(arg) for arg in a))
+
 
+def check_process(job_name, out_of_memory=False):
+    """Check how process ended.
 
-def check_process(job_name):
-    """Check how process ended."""
+    out_of_memory is set if SLURM reported the job as out of memory.
+    """
     job_type = job_name.split(".")[0]
     vprint(f"Job {job_type} ended")
     error_file = SLURM_ERROR_TEMPLATE.format(JOB_ID, job_type)
-    normal_jobs = ["blastn", "alignment", "seqSel", "RNAcode", "buildDB"]
+    normal_jobs = ["blastn", "alignment", "seqSel", "RNAcode", "buildDB", "pack"]
 
     with open(error_file, "r", encoding="UTF-8") as f_handle:
         error_content = f_handle.read()
@@ -245,6 +609,10 @@ def check_process(job_name):
             ]
         )
 
+    if out_of_memory:
+        write_status_file(job_name, ["F", "mem"])
+        raise ResourceLimitExceeded("mem")
+
     if job_type == "RNAcode":
         rnacode_result_path = RNACODE_RESULT_PATH_TEMPLATE.format(JOB_ID)
         if not os.path.isfile(rnacode_result_path):
@@ -268,12 +636,12 @@ def check_process(job_name):
         vprint(error_content)
         if "DUE TO TIME LIMIT" in error_content:
             write_status_file(job_name, ["F", "time"])
-            raise PipelineError
-        # this should catch the oom killer, but this is fairly generic. Yet
-        # SLURM does not give any better option at the moment.
-        if "Killed" in error_content:
+            raise ResourceLimitExceeded("time")
+        # Fall back for the oom killer if sacct did not report it, this is
+        # fairly generic.
+        if "Killed" in error_content or "oom-kill" in error_content:
             write_status_file(job_name, ["F", "mem"])
-            raise PipelineError
+            raise ResourceLimitExceeded("mem")
 
         write_status_file(job_name, ["F", 1])
         raise PipelineError
@@ -283,73 +651,348 @@ def check_process(job_name):
     raise PipelineError
 
 
-def slurm_listen(job_name):
-    """Listen to SLURM batch and updating status_file.
+def slurm_listen(job_name, executor=None, features=None):
+    """Listen to step and update status_file.
 
-    Afterwards check output of script with check_process().
+    Afterwards record used resources with the features of the step and check
+    output of script with check_process(). By default the step is a SLURM job.
     """
-    call_str = f"squeue --name={job_name} -h"
+    if executor is None:
+        executor = get_executor("slurm")
+    start = time.time()
     while True:
         try:
-            completed_process = subprocess.run(
-                call_str.split(), capture_output=True, text=True, check=True
-            )
+            status = executor.state(job_name)
         except subprocess.CalledProcessError as exc:
-            eprint("Error listening to slurm job")
-            eprint(call_str)
+            eprint(f"Error listening to {executor.name} job")
+            eprint(exc.cmd)
             eprint(exc.stdout)
             eprint(exc.stderr)
             write_status_file(job_name, ["F", 1])
             raise
-        if completed_process.stdout == "":
+        if job_name in _CANCELLED_STEPS:
+            executor.cancel(job_name)
+            raise StepCancelled(job_name)
+        if status is None:
             break
-        status = re.split(" +", completed_process.stdout)[5]
         write_status_file(job_name, [status, 0])
-        time.sleep(30)
+        time.sleep(executor.poll_interval)
+
+    log_step(job_name, f"Step {job_name} ended", duration=time.time() - start)
+    time.sleep(executor.settle_time)
+    usage = executor.usage(job_name)
+    if usage is not None:
+        ResourcePredictor.record(RESOURCE_HISTORY_PATH, {**(features or {}), **usage})
+    out_of_memory = usage is not None and usage["state"] == "OUT_OF_MEMORY"
+    return check_process(job_name, out_of_memory=out_of_memory)
+
+
+def expected_cost(job_type):
+    """Return expected run time in seconds for a step of the pipeline."""
+    step = job_type.split("_")[0]
+    if step not in STEP_COST_DIC or INPUT_SEQ_LEN is None:
+        return float("inf")
+    return STEP_COST_DIC[step] * INPUT_SEQ_LEN
+
+
+def ensure_pilots():
+    """Start pilots if there are not enough for the queue."""
+    sbatch_args = [
+        f"--partition={SLURM_PARTITION}",
+        f"--export=ALL,PATH={PATH},BLASTDB={BLAST_DB_PATH},PYTHON_ENV={PYTHON_ENV_SEQSEL_PATH}",
+    ]
+    try:
+        PilotPool.ensure_pilots(
+            PILOT_QUEUE_DIR,
+            PILOT_JOB_NAME,
+            NUM_PILOTS,
+            sbatch_args,
+            PILOT_IDLE_TIMEOUT,
+            PILOT_MAX_TIME,
+            PILOT_CORES,
+        )
+    except subprocess.CalledProcessError as exc:
+        eprint("Error starting pilots")
+        eprint(exc.cmd)
+        eprint(exc.stdout)
+        eprint(exc.stderr)
+        raise
 
-    time.sleep(4)
-    return check_process(job_name)
 
+_EXECUTORS = {}
+# Job names of steps cancelled by the pipeline
+_CANCELLED_STEPS = set()
+# Steps may run in threads, e.g. speculative searches
+_STATUS_LOCK = threading.Lock()
 
-def slurm_batch(script_path, job_type, cores=1):
-    """Submit SLURM job, listens to job with slurm_listen().
 
-    Checks if job finished normally with check_process().
+def get_executor(name):
+    """Return executor by name, executors are created once per process."""
+    if name not in _EXECUTORS:
+        if name == "slurm":
+            _EXECUTORS[name] = StepExecutor.SlurmExecutor(SLURM_PARTITION)
+        elif name == "local":
+            _EXECUTORS[name] = StepExecutor.LocalExecutor(LOCAL_CORES)
+        elif name == "pilot":
+            _EXECUTORS[name] = StepExecutor.PilotExecutor(PILOT_QUEUE_DIR, ensure_pilots)
+        else:
+            eprint("Unknown executor: " + name)
+            raise PipelineError
+    return _EXECUTORS[name]
+
+
+def cancel_step(job_type):
+    """Cancel step, its slurm_batch() raises StepCancelled.
+
+    The step is removed from the status file and later status updates of it
+    are ignored.
     """
     job_name = job_type + "." + JOB_ID
-    current_work_dir = CURRENT_WORK_DIR_TEMPLATE.format(JOB_ID)
-    output = SLURM_OUTPUT_TEMPLATE.format(JOB_ID, job_type)
-    error = SLURM_ERROR_TEMPLATE.format(JOB_ID, job_type)
-    jobs = ["blastn", "seqSel", "alignment", "RNAcode", "buildDB"]
-    if any(job in job_type for job in jobs):
-        max_time = str(10 * 60 * 60)
-        partition = "main"
-    else:
+    with _STATUS_LOCK:
+        _CANCELLED_STEPS.add(job_name)
+    for executor in list(_EXECUTORS.values()):
+        executor.cancel(job_name)
+    write_status_file(job_name, None)
+
+
+def choose_executor(job_type, cores=1, array=None):
+    """Return executor for step by STEP_EXECUTOR_DIC."""
+    if EXECUTION_MODE == "local":
+        return get_executor("local")
+    name = STEP_EXECUTOR_DIC.get(job_type.split("_")[0], "slurm")
+    if name == "auto":
+        short_step = cores <= PILOT_CORES and expected_cost(job_type) <= PILOT_MAX_COST
+        name = "pilot" if PILOT_MODE and short_step else "slurm"
+    # Pilots run single steps only
+    if name == "pilot" and array is not None:
+        name = "slurm"
+    return get_executor(name)
+
+
+def step_features(job_type, cores, cost=None, features=None):
+    """Return features of a step for the resource prediction."""
+    step, _sep, iteration = job_type.partition("_")
+    all_features = {
+        "step": step,
+        "iteration": int(iteration) if iteration.isdigit() else None,
+        "query_len": INPUT_SEQ_LEN,
+        "db_type": DB_TYPE,
+        "cores": cores,
+        "cost": cost,
+        "job_name": job_type + "." + JOB_ID,
+        "date": time.time(),
+    }
+    if step == "seqSel" and iteration.isdigit():
+        blast_result_path = BLAST_RESULT_PATH_TEMPLATE.format(JOB_ID, iteration)
+        if os.path.isfile(blast_result_path):
+            with open(blast_result_path, "r", encoding="UTF-8") as f_handle:
+                all_features["hits"] = sum(1 for _line in f_handle)
+    all_features.update(features or {})
+    return all_features
+
+
+def predict_resources(features):
+    """Return [time in seconds, memory in MB or None] to request for a step."""
+    max_time, mem = ResourcePredictor.predict(
+        RESOURCE_HISTORY_PATH,
+        features,
+        RESOURCE_QUANTILE,
+        RESOURCE_SAFETY_FACTOR,
+        RESOURCE_MIN_RECORDS,
+    )
+    if max_time is None:
+        max_time = MAX_STEP_TIME
+    max_time = min(MAX_STEP_TIME, max(MIN_STEP_TIME, max_time))
+    if mem is not None:
+        mem = min(MAX_STEP_MEM, max(MIN_STEP_MEM, mem))
+    return [max_time, mem]
+
+
+def escalate_resources(resource, max_time, mem):
+    """Return [time, memory] for the retry of a step which ran out of resource."""
+    if resource == "time":
+        return [min(MAX_STEP_TIME, max_time * RESOURCE_ESCALATION_FACTOR), mem]
+    if mem is None:
+        return [max_time, MAX_STEP_MEM]
+    return [max_time, min(MAX_STEP_MEM, mem * RESOURCE_ESCALATION_FACTOR)]
+
+
+def slurm_batch(script_path, job_type, cores=1, array=None, cost=None, features=None):
+    """Run step with its executor, listens to step with slurm_listen().
+
+    Checks if step finished normally with check_process(). Every step used to
+    be a SLURM job, the executor is chosen by choose_executor(). If array is
+    given the step runs as array with that many tasks, all tasks write to the
+    same output and error file. Steps with a cost are registered as running
+    for the core allocation. Time and memory are predicted from the features
+    of the step, see step_features().
+    """
+    job_name = job_type + "." + JOB_ID
+    jobs = ["blastn", "seqSel", "alignment", "RNAcode", "buildDB", "pack"]
+    if not any(job in job_type for job in jobs):
         eprint("Unknown jobtype: " + job_type)
         eprint("slurm_batch()")
         raise PipelineError
+    executor = choose_executor(job_type, cores, array)
+    features = step_features(job_type, cores, cost, features)
+    resources = predict_resources(features)
+    vprint(f"Run {job_name} with {executor.name} executor on {cores} cores")
 
-    call_str = (
-        f"sbatch --job-name={job_name} --output={output} --error={error} "
-        f"--time={max_time} --partition={partition} --chdir={current_work_dir} "
-        f"--cpus-per-task={cores} "
-        f"--export=ALL,PATH={PATH},BLASTDB={BLAST_DB_PATH},PYTHON_ENV={PYTHON_ENV_SEQSEL_PATH} "
-        f"{script_path}"
-    )
-    vprint(call_str)
+    if cost is not None and executor.name != "local":
+        CoreAllocator.register(CORE_ALLOCATOR_DIR, job_name, cost, cores)
+        try:
+            return _run_step(executor, job_name, script_path, cores, array, resources, features)
+        finally:
+            CoreAllocator.unregister(CORE_ALLOCATOR_DIR, job_name)
+    return _run_step(executor, job_name, script_path, cores, array, resources, features)
+
+
+def take_resume_flag():
+    """Remove --resume from the arguments and set RESUME."""
+    global RESUME
+    if "--resume" in sys.argv:
+        sys.argv.remove("--resume")
+        RESUME = True
+
+
+def _checkpoint(job_type, script_path, input_paths, output_paths):
+    """Return path of the marker of a step and the key of its inputs."""
+    marker_name = f"{job_type}-{os.path.basename(output_paths[0])}.json"
+    marker_path = f"{CHECKPOINT_DIR_TEMPLATE.format(JOB_ID)}/{marker_name}"
+    with open(script_path, "r", encoding="UTF-8") as f_handle:
+        script = f_handle.read()
+    existing_inputs = [path for path in input_paths if os.path.exists(path)]
+    return [marker_path, ArtifactCache.step_key(script, existing_inputs, [])]
+
+
+def step_done(job_type, script_path, input_paths, output_paths):
+    """Return True if the step can be skipped when resuming.
+
+    The step is done if it has a marker with the key of its script and inputs
+    and its outputs exist. Files the step changed, the state_paths given to
+    mark_step_done() (e.g. the selected species), are set to their content
+    after the step.
+    """
+    if not RESUME:
+        return False
+    marker_path, key = _checkpoint(job_type, script_path, input_paths, output_paths)
+    try:
+        with open(marker_path, "r", encoding="UTF-8") as f_handle:
+            marker = json.load(f_handle)
+    except (FileNotFoundError, json.decoder.JSONDecodeError):
+        return False
+    if marker["key"] != key or not all(os.path.exists(path) for path in marker["outputs"]):
+        return False
+    for path, content in marker["state"].items():
+        with open(path, "w", encoding="UTF-8") as f_handle:
+            f_handle.write(content)
+    vprint(f"Resume: {job_type} is done")
+    write_status_file(f"{job_type}.{JOB_ID}", ["CD", "resumed"])
+    return True
+
+
+def mark_step_done(job_type, script_path, input_paths, output_paths, state_paths=()):
+    """Write marker of a finished step, see step_done().
+
+    Outputs which the step did not write are not required when resuming.
+    state_paths are files the step changes, their content is kept in the
+    marker.
+    """
+    marker_path, key = _checkpoint(job_type, script_path, input_paths, output_paths)
+    state = {}
+    for path in state_paths:
+        with open(path, "r", encoding="UTF-8") as f_handle:
+            state[path] = f_handle.read()
+    marker = {
+        "key": key,
+        "outputs": [path for path in output_paths if os.path.exists(path)],
+        "state": state,
+    }
+    os.makedirs(os.path.dirname(marker_path), exist_ok=True)
+    tmp_path = f"{marker_path}.tmp"
+    with open(tmp_path, "w", encoding="UTF-8") as f_handle:
+        json.dump(marker, f_handle, indent=4)
+    os.replace(tmp_path, marker_path)
+
+
+def run_step(script_path, job_type, input_paths, output_paths, programs, **kwargs):
+    """Run step with slurm_batch() unless its outputs are in the artifact cache.
+
+    The key of the step are its script, the content of input_paths and the
+    versions of programs. On a hit the cached outputs are linked to
+    output_paths and the step is marked as done. kwargs go to slurm_batch().
+    """
+    if not ARTIFACT_CACHE:
+        return slurm_batch(script_path, job_type, **kwargs)
+    with open(script_path, "r", encoding="UTF-8") as f_handle:
+        script = f_handle.read()
+    key = ArtifactCache.step_key(script, input_paths, [get_version(program) for program in programs])
+    if ArtifactCache.fetch(ARTIFACT_CACHE_DIR, key, output_paths):
+        vprint(f"Took {job_type} from artifact cache")
+        write_status_file(f"{job_type}.{JOB_ID}", ["CD", "cached"])
+        return True
+    if not slurm_batch(script_path, job_type, **kwargs):
+        return False
+    try:
+        ArtifactCache.store(ARTIFACT_CACHE_DIR, key, output_paths)
+    except OSError:
+        eprint(f"Could not cache outputs of {job_type}")
+    return True
 
+
+def _run_step(executor, job_name, script_path, cores, array, resources, features):
+    """Run step, retry with more time or memory if it ran out of it."""
+    max_time, mem = resources
+    for attempt in range(MAX_RESOURCE_RETRIES + 1):
+        try:
+            return _submit_and_listen(
+                executor, job_name, script_path, cores, array, max_time, mem, features
+            )
+        except ResourceLimitExceeded as exc:
+            # Only SLURM enforces memory
+            if exc.resource == "mem" and executor.name != "slurm":
+                raise
+            new_resources = escalate_resources(exc.resource, max_time, mem)
+            if attempt == MAX_RESOURCE_RETRIES or new_resources == [max_time, mem]:
+                raise
+            max_time, mem = new_resources
+            vprint(f"{job_name} ran out of {exc.resource}, retry with {max_time}s and {mem}MB")
+
+
+def _submit_and_listen(executor, job_name, script_path, cores, array, max_time, mem, features):
+    job_type = job_name.split(".")[0]
+    current_work_dir = CURRENT_WORK_DIR_TEMPLATE.format(JOB_ID)
+    output = SLURM_OUTPUT_TEMPLATE.format(JOB_ID, job_type)
+    error = SLURM_ERROR_TEMPLATE.format(JOB_ID, job_type)
+    env = {
+        "PATH": PATH,
+        "BLASTDB": BLAST_DB_PATH,
+        "PYTHON_ENV": PYTHON_ENV_SEQSEL_PATH,
+    }
     for i in range(4):
+        if job_name in _CANCELLED_STEPS:
+            raise StepCancelled(job_name)
         try:
-            completed_process = subprocess.run(call_str.split(), capture_output=True, text=True, check=True)
+            out = executor.submit(
+                job_name,
+                script_path,
+                current_work_dir,
+                output,
+                error,
+                env,
+                cores=cores,
+                max_time=max_time,
+                array=array,
+                mem=mem,
+            )
         except subprocess.CalledProcessError as exc:
-            eprint("error submitting slurm job")
+            eprint(f"error submitting {executor.name} job")
             eprint(exc.stdout)
             eprint(exc.stderr)
             raise
-        vprint(completed_process.stdout)
-        time.sleep(3)
+        vprint(out)
         try:
-            return slurm_listen(job_name)
+            return slurm_listen(job_name, executor, features)
         # Sometimes slurm does not start the job
         except FileNotFoundError:
             vprint("Slurm did not execute the job. Try again.")
@@ -359,32 +1002,25 @@ def slurm_batch(script_path, job_type, cores=1):
             continue
 
 
-def write_status_file(job_name, status):
-    """Write status file for job."""
-    job_type = job_name.split(".")[0]
-    job_status_file = JOB_STATUS_FILE_TEMPLATE.format(JOB_ID)
-    try:
-        with open(job_status_file, "r", encoding="UTF-8") as f_handle:
-            content = f_handle.read()
-            job_status = json.loads(content)
-    except json.decoder.JSONDecodeError:
-        eprint("JSONDDecoderError!")
-        eprint(content)
-        eprint(traceback.format_exc())
-        raise PipelineError
+def write_status_file(job_name, status, job_id=None):
+    """Write status file for job.
 
-    job_status[job_type] = status
-    with open(job_status_file, "w", encoding="UTF-8") as f_handle:
-        json.dump(job_status, f_handle, indent=4)
+    By default the status file of the current job is written. A status of None
+    removes the job. Status of cancelled steps is not written. The change is
+    appended to the status log, see JobStatusLog.py.
+    """
+    job_type = job_name.split(".")[0]
+    job_status_file = JOB_STATUS_FILE_TEMPLATE.format(job_id or JOB_ID)
+    with _STATUS_LOCK:
+        if status is not None and job_name in _CANCELLED_STEPS:
+            return
+        JobStatusLog.append(job_status_file, job_type, status)
 
 
 def vprint(*a, **k):
     """Print verbose."""
-    if VERBOSE and not STDOUT_FILE_PATH:
-        print(*a, **k, flush=True)
-    elif VERBOSE and STDOUT_FILE_PATH:
-        with open(STDOUT_FILE_PATH, "a", encoding="UTF-8") as f_handle:
-            print(*a, file=f_handle, flush=True, **k)
+    if VERBOSE:
+        _logger().info(k.get("sep", " ").join(str(arg) for arg in a))
 
 
 def check_num_seq(iteration):
@@ -418,8 +1054,31 @@ def concat_sequences_fasta(iteration):
             db_handle.write(f">{accession}\n{print_seq}\n")
 
 
-def clustalo():
-    """3. Step in analysis. Align sequence previously selected."""
+def choose_aligner(num_seqs, max_len):
+    """Return [aligner, threads] for sequences to align."""
+    aligner = ALIGNER
+    if aligner == "auto":
+        if num_seqs >= MAFFT_MIN_SEQS or max_len >= MAFFT_MIN_LEN:
+            aligner = "mafft"
+        else:
+            aligner = "clustalo"
+    threads = min(ALIGN_MAX_THREADS, max(1, num_seqs // ALIGN_SEQS_PER_THREAD))
+    return [aligner, threads]
+
+
+def aligners():
+    """Return aligners the alignment step can choose from."""
+    if ALIGNER == "auto":
+        return list(ALIGN_WRAPPER_TEMPLATES)
+    return [ALIGNER]
+
+
+def align():
+    """3. Step in analysis. Align sequence previously selected.
+
+    The aligner is chosen by choose_aligner(). Every aligner writes a clustal
+    alignment and a newick guide tree with the names of the sequences.
+    """
     job_type = "alignment"
     align_script_path = ALIGN_SCRIPT_PATH_TEMPLATE.format(JOB_ID)
     error_file = SLURM_ERROR_TEMPLATE.format(JOB_ID, job_type)
@@ -427,20 +1086,42 @@ def clustalo():
     align_path = ALIGN_PATH_TEMPLATE.format(JOB_ID)
     align_tree_path = ALIGN_TREE_PATH_TEMPLATE.format(JOB_ID)
 
-    align_wrapper = CLUSTALO_WRAPPER_TEMPLATE.format(
+    seq_lens = []
+    with open(align_fasta, "r", encoding="UTF-8") as f_handle:
+        for line in f_handle:
+            if line[0] == ">":
+                seq_lens.append(0)
+            else:
+                seq_lens[-1] += len(line.strip())
+    aligner, threads = choose_aligner(len(seq_lens), max(seq_lens, default=0))
+    vprint(f"Align {len(seq_lens)} sequences with {aligner} on {threads} threads")
+
+    align_wrapper = ALIGN_WRAPPER_TEMPLATES[aligner].format(
         align_fasta.split("/")[-1],
         align_path.split("/")[-1],
         align_tree_path.split("/")[-1],
+        threads,
     )
 
     with open(align_script_path, "w", encoding="UTF-8") as f_handle:
         f_handle.write(align_wrapper)
 
-    if not slurm_batch(align_script_path, job_type):
+    if step_done(job_type, align_script_path, [align_fasta], [align_path, align_tree_path]):
+        return
+    if not run_step(
+        align_script_path,
+        job_type,
+        [align_fasta],
+        [align_path, align_tree_path],
+        [aligner],
+        cores=threads,
+        features={"aligner": aligner, "num_seqs": len(seq_lens), "max_len": max(seq_lens, default=0)},
+    ):
         eprint("Alignment exited with error!")
         with open(error_file, "r", encoding="UTF-8") as f_handle:
             eprint(f_handle.read())
         raise PipelineError
+    mark_step_done(job_type, align_script_path, [align_fasta], [align_path, align_tree_path])
 
 
 def convert_to_maf():
@@ -479,13 +1160,7 @@ def plot_alignment():
     """Plot alignment tree."""
     align_tree_path = ALIGN_TREE_PATH_TEMPLATE.format(JOB_ID)
     align_plot_path = ALIGN_PLOT_PATH_TEMPLATE.format(JOB_ID)
-    with open(align_tree_path, "r", encoding="UTF-8") as f_handle:
-        tree = Tree(f_handle.read())
-
-    for node in tree:
-        node.name = node.name.split("-")[0]
-
-    tree.render(align_plot_path)
+    TreePlot.plot_tree(align_tree_path, align_plot_path, rename=lambda name: name.split("-")[0])
 
 
 def rnacode():
@@ -506,8 +1181,19 @@ def rnacode():
     with open(rnacode_script_path, "w", encoding="UTF-8") as f_handle:
         f_handle.write(rnacode_script)
 
+    if step_done(job_type, rnacode_script_path, [align_path], [rnacode_result_path, eps_path]):
+        return
+    if TWO_STAGE_RNACODE:
+        rnacode_two_stage()
+        mark_step_done(job_type, rnacode_script_path, [align_path], [rnacode_result_path, eps_path])
+        return
+    if BLOCK_RNACODE and rnacode_blocks():
+        mark_step_done(job_type, rnacode_script_path, [align_path], [rnacode_result_path, eps_path])
+        return
     for _i in range(2):
-        if slurm_batch(rnacode_script_path, job_type):
+        if run_step(
+            rnacode_script_path, job_type, [align_path], [rnacode_result_path, eps_path], ["RNAcode"]
+        ):
             error_content = ""
             break
         with open(error_file, "r", encoding="UTF-8") as f_handle:
@@ -518,6 +1204,223 @@ def rnacode():
     if error_content != "":
         eprint("RNAcode exited with error!")
         raise PipelineError
+    mark_step_done(job_type, rnacode_script_path, [align_path], [rnacode_result_path, eps_path])
+
+
+def read_maf():
+    """Return [source, start, size of source, text] of the rows of the alignment."""
+    rows = []
+    with open(ALIGN_MAF_PATH_TEMPLATE.format(JOB_ID), "r", encoding="UTF-8") as f_handle:
+        for line in f_handle:
+            if line[0] != "s":
+                continue
+            _s, src, start, _length, _strand, src_size, text = line.split()
+            rows.append([src, int(start), src_size, text])
+    return rows
+
+
+def split_maf(rows, blocks):
+    """Write column blocks [start, stop] of the alignment rows as MAF files.
+
+    The start of a sequence in a block is its start in the alignment plus its
+    bases left of the block.
+    """
+    block_dir = RNACODE_BLOCK_DIR_TEMPLATE.format(JOB_ID)
+    for i, [column_start, column_stop] in enumerate(blocks):
+        maf_block = [["a", "score=0"]]
+        for src, start, src_size, text in rows:
+            block_text = text[column_start:column_stop]
+            length = len(block_text.replace("-", ""))
+            # RNAcode needs the reference
+            if length == 0 and src != "Target":
+                continue
+            block_start = start + len(text[:column_start].replace("-", ""))
+            maf_block.append(["s", src, str(block_start), str(length), "+", src_size, block_text])
+        with open(f"{block_dir}/block_{i}.maf", "w", encoding="UTF-8") as f_handle:
+            f_handle.write("\n".join([" ".join(entry) for entry in maf_block]) + "\n")
+
+
+def merge_rnacode_blocks(blocks):
+    """Merge the HSS of the blocks into the RNAcode result.
+
+    From and To are alignment columns and shifted by the start column of the
+    block, Start and End are genomic already. An HSS found in two overlapping blocks
+    on the same strand and frame is kept once, with its best score. HSS are
+    numbered by score and their plots renamed. Returns the number of HSS.
+    """
+    block_dir = RNACODE_BLOCK_DIR_TEMPLATE.format(JOB_ID)
+    eps_path = EPS_PATH_TEMPLATE.format(JOB_ID)
+    # [score, block, columns]
+    hss_rows = []
+    for i, [column_start, _column_stop] in enumerate(blocks):
+        with open(f"{block_dir}/result_{i}.tsv", "r", encoding="UTF-8") as f_handle:
+            for line in f_handle:
+                columns = line.rstrip("\n").split("\t")
+                if len(columns) < 11:
+                    continue
+                columns[4] = str(int(columns[4]) + column_start)
+                columns[5] = str(int(columns[5]) + column_start)
+                hss_rows.append([float(columns[9]), i, columns])
+    hss_rows.sort(key=lambda row: -row[0])
+
+    # [strand, frame, start, end]
+    kept_regions = []
+    kept_rows = []
+    for _score, i, columns in hss_rows:
+        start, end = sorted([int(columns[7]), int(columns[8])])
+        strand = columns[1]
+        frame = (end if strand == "-" else start) % 3
+        if any(
+            region[:2] == [strand, frame] and region[2] <= end and start <= region[3]
+            for region in kept_regions
+        ):
+            continue
+        kept_regions.append([strand, frame, start, end])
+        kept_rows.append([i, columns])
+
+    os.makedirs(eps_path, exist_ok=True)
+    # The result may be hard linked into the artifact cache, so it is replaced,
+    # not truncated
+    result_path = RNACODE_RESULT_PATH_TEMPLATE.format(JOB_ID)
+    tmp_path = f"{result_path}.{os.getpid()}.tmp"
+    with open(tmp_path, "w", encoding="UTF-8") as f_handle:
+        for hss_id, [i, columns] in enumerate(kept_rows):
+            block_eps = f"{block_dir}/eps_{i}/hss-{columns[0]}.eps"
+            if os.path.isfile(block_eps):
+                os.replace(block_eps, f"{eps_path}/hss-{hss_id}.eps")
+            columns[0] = str(hss_id)
+            f_handle.write("\t".join(columns) + "\n")
+    os.replace(tmp_path, result_path)
+    return len(kept_rows)
+
+
+def rnacode_blocks():
+    """Run RNAcode on overlapping column blocks of the alignment in parallel.
+
+    Returns False if the alignment is too short for blocks.
+    """
+    rows = read_maf()
+    if len(rows[0][3]) <= RNACODE_BLOCK_LENGTH:
+        return False
+    write_status_file(f"RNAcode.{JOB_ID}", ["R", 0])
+    blocks = BlastSearch.query_chunks(len(rows[0][3]), RNACODE_BLOCK_LENGTH, RNACODE_BLOCK_OVERLAP)
+    run_rnacode_blocks(rows, blocks)
+    return True
+
+
+def screen_regions(screen_result_path, num_columns):
+    """Return merged [start, stop] columns of the HSS of the screen, padded."""
+    regions = []
+    with open(screen_result_path, "r", encoding="UTF-8") as f_handle:
+        for line in f_handle:
+            columns = line.rstrip("\n").split("\t")
+            if len(columns) < 11:
+                continue
+            # From and To are 1 based alignment columns
+            regions.append(
+                [
+                    max(0, int(columns[4]) - 1 - RNACODE_REFINE_PADDING),
+                    min(num_columns, int(columns[5]) + RNACODE_REFINE_PADDING),
+                ]
+            )
+    regions.sort()
+    merged = []
+    for start, stop in regions:
+        if merged and start <= merged[-1][1]:
+            merged[-1][1] = max(merged[-1][1], stop)
+        else:
+            merged.append([start, stop])
+    return merged
+
+
+def rnacode_two_stage():
+    """Run RNAcode with few samples, refine the HSS with the default samples.
+
+    The screen keeps HSS with p below RNACODE_SCREEN_P, which covers HSS near
+    P_THRESHOLD despite the noise of few samples. Only their padded columns
+    run with the default number of samples and produce plots.
+    """
+    job_type = "RNAcodeScreen"
+    screen_script_path = RNACODE_SCREEN_SCRIPT_PATH_TEMPLATE.format(JOB_ID)
+    screen_result_path = RNACODE_SCREEN_RESULT_PATH_TEMPLATE.format(JOB_ID)
+    align_path = ALIGN_MAF_PATH_TEMPLATE.format(JOB_ID)
+    with open(screen_script_path, "w", encoding="UTF-8") as f_handle:
+        f_handle.write(
+            RNACODE_SCREEN_SCRIPT_TEMPLATE.format(
+                screen_result_path.split("/")[-1], align_path.split("/")[-1]
+            )
+        )
+    write_status_file(f"RNAcode.{JOB_ID}", ["R", 0])
+    for i in range(RNACODE_BLOCK_TRIES):
+        try:
+            run_step(screen_script_path, job_type, [align_path], [screen_result_path], ["RNAcode"])
+            break
+        except ResourceLimitExceeded:
+            raise
+        except PipelineError:
+            with open(SLURM_ERROR_TEMPLATE.format(JOB_ID, job_type), "r", encoding="UTF-8") as f_handle:
+                error_content = f_handle.read()
+            if "Segmentation fault" not in error_content or i == RNACODE_BLOCK_TRIES - 1:
+                eprint("RNAcode exited with error!")
+                write_status_file(f"RNAcode.{JOB_ID}", ["F", 1])
+                raise
+
+    rows = read_maf()
+    blocks = screen_regions(screen_result_path, len(rows[0][3]))
+    vprint(f"RNAcode screen found {len(blocks)} regions")
+    if len(blocks) == 0:
+        write_status_file(f"RNAcode.{JOB_ID}", ["F", "no_res"])
+        write_status_file(f"fullJob.{JOB_ID}", ["F", "no_res"])
+        raise PipelineFailed
+    run_rnacode_blocks(rows, blocks)
+
+
+def run_rnacode_blocks(rows, blocks):
+    """Run RNAcode on column blocks of the alignment as job array.
+
+    Blocks without result, e.g. after a segfault, run again, up to
+    RNACODE_BLOCK_TRIES times. The HSS are merged into the RNAcode result.
+    """
+    job_type = "RNAcodeBlocks"
+    block_dir = RNACODE_BLOCK_DIR_TEMPLATE.format(JOB_ID)
+    block_script_path = RNACODE_BLOCK_SCRIPT_PATH_TEMPLATE.format(JOB_ID)
+    # Results of an earlier run must not count as finished blocks
+    rmtree(block_dir, ignore_errors=True)
+    os.makedirs(block_dir)
+
+    split_maf(rows, blocks)
+    vprint(f"RNAcode on {len(blocks)} blocks")
+    pending = list(range(len(blocks)))
+    for _i in range(RNACODE_BLOCK_TRIES):
+        with open(block_script_path, "w", encoding="UTF-8") as f_handle:
+            f_handle.write(
+                RNACODE_BLOCK_SCRIPT_TEMPLATE.format(
+                    " ".join(str(i) for i in pending), block_dir.split("/")[-1]
+                )
+            )
+        # A crashed block fails the step, the result files tell which blocks finished
+        try:
+            slurm_batch(block_script_path, job_type, array=len(pending))
+        except ResourceLimitExceeded:
+            raise
+        except PipelineError:
+            pass
+        pending = [i for i in pending if not os.path.isfile(f"{block_dir}/result_{i}.tsv")]
+        if len(pending) == 0:
+            break
+        vprint(f"RNAcode failed on blocks {pending}")
+    if len(pending) != 0:
+        eprint("RNAcode exited with error!")
+        with open(SLURM_ERROR_TEMPLATE.format(JOB_ID, job_type), "r", encoding="UTF-8") as f_handle:
+            eprint(f_handle.read())
+        write_status_file(f"RNAcode.{JOB_ID}", ["F", 1])
+        raise PipelineError
+
+    if merge_rnacode_blocks(blocks) == 0:
+        write_status_file(f"RNAcode.{JOB_ID}", ["F", "no_res"])
+        write_status_file(f"fullJob.{JOB_ID}", ["F", "no_res"])
+        raise PipelineFailed
+    write_status_file(f"RNAcode.{JOB_ID}", ["CD", 0])
 
 
 def render_jinja(file_name, context, template_dir="./"):
@@ -526,15 +1429,20 @@ def render_jinja(file_name, context, template_dir="./"):
     return env.get_template(file_name).render(context)
 
 
+@functools.lru_cache(maxsize=None)
 def get_version(program):
     """Get version for programm."""
     if program == "blastn":
         call_str = "blastn -version"
     elif program == "clustalo":
         call_str = "clustalo-1.2.4-Ubuntu-x86_64 --version"
+    elif program == "mafft":
+        call_str = "mafft --version"
     elif program == "RNAcode":
         call_str = "RNAcode --version"
     elif program == "blastdb":
+        if DB_VERSION != "unversioned":
+            return DB_VERSION
         call_str = f"stat -c '%y' {BLAST_DB_PATH}/nt.00.nhd"
     else:
         eprint(f"Unknown program {program}")
@@ -558,6 +1466,9 @@ def get_version(program):
         version = out.split("\n", maxsplit=1)[0].split(" ")[1]
     if program == "clustalo":
         version = out
+    if program == "mafft":
+        # mafft prints its version to stderr
+        version = completed_process.stderr.split()[0]
     if program == "RNAcode":
         version = out.split()[2]
     if program == "blastdb":
@@ -617,7 +1528,8 @@ def _build_positive_taxid_list(iteration):
     The taxonomic restricition is based on the iteration. The higher the
     iteration the more species should be included. All previously found species
     will be excluded from the next search, hence removed from the list. The
-    function will return False if no rank ca be assigned to the reference.
+    function will return the taxid of the rank, None if no rank ca be assigned
+    to the reference.
     Further if the DB_TYPE is "refseq" each species must be removed which does
     not belong to the same kingdom as "REFERENCE_SPECIES"
     """
@@ -635,6 +1547,7 @@ def _build_positive_taxid_list(iteration):
         6: "kingdom",
     }
     taxids_path = TAXIDS_PATH_TEMPLATE.format(JOB_ID, iteration)
+    rank_taxids_path = RANK_TAXIDS_PATH_TEMPLATE.format(JOB_ID, iteration)
     selected_species_file_path = SELECTED_SPECIES_FILE_PATH_TEMPLATE.format(JOB_ID)
 
     ancestors = NCBI.get_lineage(REFERENCE_SPECIES)
@@ -652,7 +1565,7 @@ def _build_positive_taxid_list(iteration):
         else:
             break
     else:
-        return False
+        return None
 
     call_str = f"{PARAMETERS_BACKEND['blast_bin']}/get_species_taxids.sh -t {ancestor_threshold} > {taxids_path}"
     try:
@@ -669,13 +1582,18 @@ def _build_positive_taxid_list(iteration):
 
     vprint(call_str)
 
+    with open(taxids_path, "r", encoding="UTF-8") as f_handle:
+        rank_taxid_list = set(line.strip() for line in f_handle)
+    with open(rank_taxids_path, "w", encoding="UTF-8") as f_handle:
+        f_handle.write("\n".join(rank_taxid_list.intersection(ALL_TAXIDS_BLAST_DB)) + "\n")
+
     # Remove from the taxid list all previously selected taxids
     with open(selected_species_file_path, "r", encoding="UTF-8") as f_handle:
         try:
             selected_species = set(line.strip() for line in f_handle)
         except ValueError:
             # if no species had been selected
-            return True
+            return ancestor_threshold
 
     all_taxids = ALL_TAXIDS_BLAST_DB - selected_species
 
@@ -689,7 +1607,7 @@ def _build_positive_taxid_list(iteration):
 
     with open(taxids_path, "w", encoding="UTF-8") as f_handle:
         f_handle.write("\n".join(taxid_list) + "\n")
-    return True
+    return ancestor_threshold
 
 
 def build_taxid_list(iteration):
@@ -698,22 +1616,24 @@ def build_taxid_list(iteration):
     The list contains all sequence that belong to a certain taxonomic rank. But
     excludes all previously found sequences and all taxids which are not present
     in the current data base.
+
+    Returns the taxid of the taxonomic range if the search is restricted to the
+    list, None if the list is empty because there is no restriction.
     """
     taxids_path = TAXIDS_PATH_TEMPLATE.format(JOB_ID, iteration)
     with open(taxids_path, "w", encoding="UTF-8") as f_handle:
         f_handle.write("")
     # First iteration is always with empty restriction
     if iteration == 1:
-        return
+        return None
     # First check if a reference was set if not try to set
     vprint("Set reference species")
     _set_reference_species(iteration)
     # If no reference was set skip
     if REFERENCE_SPECIES is None:
-        return
+        return None
 
     # Build list for species taxid below a certain rank and remove from this
     # list all previously found taxids
     vprint("Build positive taxid list")
-    if not _build_positive_taxid_list(iteration):
-        return
+    return _build_positive_taxid_list(iteration)
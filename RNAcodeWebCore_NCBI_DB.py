@@ -5,8 +5,9 @@ Handles all computation etc.
 import sys
 import os
 import re
-import json
-from shutil import rmtree, copyfile
+import fcntl
+from shutil import rmtree, copyfile, move
+from concurrent.futures import ThreadPoolExecutor
 
 import RNAcodeWebCore
 from RNAcodeWebCore import start_pipeline
@@ -17,7 +18,9 @@ from RNAcodeWebCore import get_version
 from RNAcodeWebCore import render_jinja
 from RNAcodeWebCore import notify_frontend
 from RNAcodeWebCore import check_num_seq
-from RNAcodeWebCore import clustalo
+from RNAcodeWebCore import align
+from RNAcodeWebCore import aligners
+from RNAcodeWebCore import ALIGNER_NAMES
 from RNAcodeWebCore import convert_to_maf
 from RNAcodeWebCore import rnacode
 from RNAcodeWebCore import plot_alignment
@@ -25,6 +28,8 @@ from RNAcodeWebCore import build_taxid_list
 from RNAcodeWebCore import concat_sequences_fasta
 
 import SeqSelection
+import BlastSearch
+import JobStatusLog
 from SeqSelection import collect_sequences
 
 RNAcodeWebCore.VERBOSE = True
@@ -34,18 +39,50 @@ E_VALUE_CUTOFF = 0.01
 
 WORD_SIZE_DIC = {1: 14, 2: 11, 3: 9, 4: 8, 5: 7}
 
+# Adaptive search strategy, see choose_strategy(). Task, word size and number
+# of hits of an iteration are chosen from the hits of the last iteration. The
+# word size of WORD_SIZE_DIC is the most sensitive search of an iteration.
+ADAPTIVE_STRATEGY = True
+# Expected drop of the identity of the hits from one iteration to the next
+IDENTITY_LOSS_PER_ITERATION = 5
+MEGABLAST_MIN_IDENTITY = 90
+MEGABLAST_WORD_SIZE = 28
+DC_MEGABLAST_MIN_IDENTITY = 75
+# dc-megablast only allows 11 or 12
+DC_MEGABLAST_WORD_SIZE = 11
+# Hits per missing sequence are multiplied by this factor
+HIT_BUDGET_FACTOR = 2
+MIN_TARGET_SEQS_BLASTN = 500
+
+# Single pass mode. Instead of one blast search per iteration a single
+# sensitive search without taxonomic restriction is run. The searches of the
+# iterations are emulated on its hits, see BlastSearch.filter_hits().
+SINGLE_PASS = False
+SENSITIVE_MAX_TARGET_SEQS = 50000
+
+# Speculative mode. After the first iteration the searches of all further
+# iterations run at the same time, see speculative_selection().
+SPECULATIVE = False
+
+# Parent level search. A child which gets the sequence of its parent takes its
+# hits from one search of the whole parent per taxonomic range, see
+# parent_level_search().
+PARENT_MAX_HSPS = 50
+
 # Will be set in get_arguments()
 JOB_ID = None
 MIN_PAIR_DIST = None
 MAX_PAIR_DIST = None
 INPUT_SEQ_NUC = None
+PARENT_JOB_ID = None
+PARENT_SEQ_NUC = None
 
 BLAST_WRAPPER_TEMPLATE = (
     "#!/bin/bash\n\n"
     "set -e\n\n"
-    f'blastn -db "{{}}" -query {{}} -max_target_seqs {MAX_TARGET_SEQS_BLASTN} '
+    'blastn -db "{}" -query {} -max_target_seqs {} '
     f'-taxidlist {{}} -outfmt "{RNAcodeWebCore.OUTFMT}" -out {{}} -evalue {E_VALUE_CUTOFF} '
-    "-num_threads {} -max_hsps 1 -task blastn -word_size {}\n"
+    "-num_threads {} -max_hsps {} -task {} -word_size {}\n"
 )
 
 SEQSEL_WRAPPER_TEMPLATE = (
@@ -62,8 +99,9 @@ def make_readme():
     context = {}
     context["blast_version"] = get_version("blastn")
 
-    context["name_aligner"] = "Clustal Omega"
-    context["aligner_version"] = get_version("clustalo")
+    # The aligner is chosen when the sequences are known
+    context["name_aligner"] = " or ".join(ALIGNER_NAMES[aligner] for aligner in aligners())
+    context["aligner_version"] = ", ".join(get_version(aligner) for aligner in aligners())
 
     context["rnacode_version"] = get_version("RNAcode")
 
@@ -93,6 +131,8 @@ def init_work_dir():
     if not os.path.isdir(current_work_dir):
         os.mkdir(current_work_dir)
         os.mkdir(eps_path)
+    elif RNAcodeWebCore.RESUME:
+        vprint("Resume in existing work directory")
     else:
         rmtree(current_work_dir)
         os.mkdir(current_work_dir)
@@ -103,6 +143,13 @@ def init_work_dir():
         seq = "\n".join(re.findall(f".{{1,{line_length}}}", INPUT_SEQ_NUC)) + "\n"
         file_handle.write(seq)
 
+    if PARENT_SEQ_NUC is not None:
+        parent_input_file_path = RNAcodeWebCore.PARENT_INPUT_FILE_PATH_TEMPLATE.format(JOB_ID)
+        with open(parent_input_file_path, "w", encoding="UTF-8") as file_handle:
+            file_handle.write(">Parent\n")
+            seq = "\n".join(re.findall(f".{{1,{line_length}}}", PARENT_SEQ_NUC)) + "\n"
+            file_handle.write(seq)
+
     job_status = {
         "blastn_1": ["R", 0],
         "seqSel_1": ["NS", 0],
@@ -111,8 +158,7 @@ def init_work_dir():
         "fullJob": ["R", 0],
     }
 
-    with open(job_status_file, "w", encoding="UTF-8") as file_handle:
-        json.dump(job_status, file_handle, indent=4)
+    JobStatusLog.reset(job_status_file, job_status)
 
     with open(reference_species_file, "w", encoding="UTF-8") as file_handle:
         file_handle.write("None")
@@ -129,8 +175,9 @@ def init_work_dir():
 
 def get_arguments():
     """Get arguments from sys."""
-    global JOB_ID, MIN_PAIR_DIST, MAX_PAIR_DIST, INPUT_SEQ_NUC
+    global JOB_ID, MIN_PAIR_DIST, MAX_PAIR_DIST, INPUT_SEQ_NUC, PARENT_JOB_ID, PARENT_SEQ_NUC
 
+    RNAcodeWebCore.take_resume_flag()
     JOB_ID = sys.argv[1]
     RNAcodeWebCore.JOB_ID = JOB_ID
 
@@ -151,6 +198,11 @@ def get_arguments():
     RNAcodeWebCore.GENOME_START = int(sys.argv[4])
     RNAcodeWebCore.DB_TYPE = sys.argv[5]
     INPUT_SEQ_NUC = sys.argv[6]
+    RNAcodeWebCore.INPUT_SEQ_LEN = len(INPUT_SEQ_NUC)
+    # Children may get the sequence of their parent for the parent level search
+    if len(sys.argv) > 7:
+        PARENT_SEQ_NUC = sys.argv[7]
+        PARENT_JOB_ID = JOB_ID.rsplit("-child_", 1)[0]
 
     if RNAcodeWebCore.DB_TYPE == "nt":
         RNAcodeWebCore.BLAST_DB = "nt"
@@ -160,42 +212,163 @@ def get_arguments():
     RNAcodeWebCore.NCBI = SeqSelection.load_ncbi()
 
 
-def blastn(iteration):
-    """Call blast."""
+def choose_strategy(iteration, previous, num_seqs):
+    """Return task, word size and max target seqs for the blast of iteration.
+
+    previous is [iteration, number of hits, median identity, number of
+    selected sequences] of the last searched iteration or None, see
+    hit_summary(). The identity of the hits drops with every iteration as the
+    taxonomic range grows. Close hits are
+    found by megablast, distant ones need blastn with the word size of the
+    iteration. The number of hits is limited to what the last iteration needed
+    per selected sequence times the number of sequences still missing.
+    """
+    if not ADAPTIVE_STRATEGY or previous is None:
+        return ["blastn", WORD_SIZE_DIC[iteration], MAX_TARGET_SEQS_BLASTN]
+    previous_iteration, num_hits, identity, num_new_seqs = previous
+    # A search which selected nothing is followed by the most sensitive one
+    if identity is None or num_new_seqs == 0:
+        return ["blastn", WORD_SIZE_DIC[iteration], MAX_TARGET_SEQS_BLASTN]
+
+    expected_identity = identity - IDENTITY_LOSS_PER_ITERATION * (iteration - previous_iteration)
+    if expected_identity >= MEGABLAST_MIN_IDENTITY:
+        task, word_size = "megablast", MEGABLAST_WORD_SIZE
+    elif expected_identity >= DC_MEGABLAST_MIN_IDENTITY:
+        task, word_size = "dc-megablast", DC_MEGABLAST_WORD_SIZE
+    else:
+        task, word_size = "blastn", WORD_SIZE_DIC[iteration]
+
+    missing = SeqSelection.MAX_NUM_SEQ - num_seqs
+    max_target_seqs = int(missing * num_hits / num_new_seqs * HIT_BUDGET_FACTOR)
+    max_target_seqs = min(MAX_TARGET_SEQS_BLASTN, max(MIN_TARGET_SEQS_BLASTN, max_target_seqs))
+    return [task, word_size, max_target_seqs]
+
+
+def read_taxid_list(iteration):
+    """Return taxids of the taxid list of iteration."""
+    taxids_path = RNAcodeWebCore.TAXIDS_PATH_TEMPLATE.format(JOB_ID, iteration)
+    with open(taxids_path, "r", encoding="UTF-8") as file_handle:
+        return set(line.strip() for line in file_handle if line.strip() != "")
+
+
+def blastn(
+    iteration,
+    task="blastn",
+    word_size=None,
+    max_target_seqs=MAX_TARGET_SEQS_BLASTN,
+    blast_result_path=None,
+    query_path=None,
+    taxids_path=None,
+    max_hsps=1,
+):
+    """Call blast.
+
+    By default with the word size, input, taxid list and result path of the
+    iteration. The taxid list of the iteration must be built before.
+    """
     job_type = f"blastn_{iteration}"
-    input_file_path = RNAcodeWebCore.INPUT_FILE_PATH_TEMPLATE.format(JOB_ID)
-    blast_result_path = RNAcodeWebCore.BLAST_RESULT_PATH_TEMPLATE.format(
-        JOB_ID, iteration
-    )
+    if query_path is None:
+        query_path = RNAcodeWebCore.INPUT_FILE_PATH_TEMPLATE.format(JOB_ID)
+    if taxids_path is None:
+        taxids_path = RNAcodeWebCore.TAXIDS_PATH_TEMPLATE.format(JOB_ID, iteration)
+    if word_size is None:
+        word_size = WORD_SIZE_DIC[iteration]
+    if blast_result_path is None:
+        blast_result_path = RNAcodeWebCore.BLAST_RESULT_PATH_TEMPLATE.format(
+            JOB_ID, iteration
+        )
     blast_wrapper_path = RNAcodeWebCore.BLAST_WRAPPER_PATH_TEMPLATE.format(
         JOB_ID, iteration
     )
-    taxids_path = RNAcodeWebCore.TAXIDS_PATH_TEMPLATE.format(JOB_ID, iteration)
 
     error_file = RNAcodeWebCore.SLURM_ERROR_TEMPLATE.format(JOB_ID, job_type)
-    idle_cores = RNAcodeWebCore.get_number_idles_cpus()
-    cores = [v for k, v in RNAcodeWebCore.CORE_USE_DIC.items() if idle_cores in k][0]
-
-    build_taxid_list(iteration)
+    cost = RNAcodeWebCore.blast_cost(word_size, RNAcodeWebCore.DB_TYPE)
+
+    blast_db = RNAcodeWebCore.BLAST_DB
+    blast_out = blast_result_path.split("/")[-1]
+    num_shards = None
+    if RNAcodeWebCore.SHARDED_BLAST:
+        shards, db_size = RNAcodeWebCore.blast_shards(RNAcodeWebCore.BLAST_DB)
+        num_shards = len(shards)
+        blast_db = RNAcodeWebCore.SHARD_DB
+        blast_out += BlastSearch.SHARD_SUFFIX.format("${SLURM_ARRAY_TASK_ID}")
+    cores = RNAcodeWebCore.get_blast_cores(cost / (num_shards or 1))
 
     blast_wrapper = BLAST_WRAPPER_TEMPLATE.format(
-        RNAcodeWebCore.BLAST_DB,
-        input_file_path.split("/")[-1],
+        blast_db,
+        query_path.split("/")[-1],
+        max_target_seqs,
         taxids_path.split("/")[-1],
-        blast_result_path.split("/")[-1],
+        blast_out,
         cores,
-        WORD_SIZE_DIC[iteration],
+        max_hsps,
+        task,
+        word_size,
     )
+    if num_shards is not None:
+        blast_wrapper = RNAcodeWebCore.shard_blast_wrapper(blast_wrapper, shards, db_size)
+    blast_wrapper = RNAcodeWebCore.warm_blast_wrapper(blast_wrapper, blast_db)
 
     with open(blast_wrapper_path, "w", encoding="UTF-8") as file_handle:
         file_handle.write(blast_wrapper)
 
-    if not RNAcodeWebCore.slurm_batch(blast_wrapper_path, job_type, cores=cores):
+    if RNAcodeWebCore.step_done(job_type, blast_wrapper_path, [query_path, taxids_path], [blast_result_path]):
+        return
+    if num_shards is not None:
+        output_paths = BlastSearch.shard_paths(blast_result_path, num_shards)
+    else:
+        output_paths = [blast_result_path]
+    if not RNAcodeWebCore.run_step(
+        blast_wrapper_path,
+        job_type,
+        [query_path, taxids_path],
+        output_paths,
+        ["blastn", "blastdb"],
+        cores=cores,
+        array=num_shards,
+        cost=cost,
+        features={"word_size": word_size, "task": task},
+    ):
         eprint("Blast exited with error!")
         with open(error_file, "r", encoding="UTF-8") as file_handle:
             eprint(file_handle.read())
         raise RNAcodeWebCore.PipelineError
 
+    if num_shards is not None:
+        BlastSearch.merge_results(blast_result_path, num_shards, max_target_seqs)
+    RNAcodeWebCore.mark_step_done(job_type, blast_wrapper_path, [query_path, taxids_path], [blast_result_path])
+
+
+def single_pass_blastn(iteration, taxids):
+    """Emulate blast of iteration on the hits of the sensitive search.
+
+    The sensitive search runs in the first iteration with the smallest word
+    size, every iteration keeps the hits its own search would have found.
+    taxids is the restriction of the iteration, None for no restriction.
+    """
+    sensitive_result_path = RNAcodeWebCore.SENSITIVE_BLAST_RESULT_PATH_TEMPLATE.format(JOB_ID)
+    blast_result_path = RNAcodeWebCore.BLAST_RESULT_PATH_TEMPLATE.format(JOB_ID, iteration)
+
+    if iteration == 1:
+        vprint("Sensitive blast for all iterations")
+        blastn(
+            1,
+            word_size=min(WORD_SIZE_DIC.values()),
+            max_target_seqs=SENSITIVE_MAX_TARGET_SEQS,
+            blast_result_path=sensitive_result_path,
+        )
+
+    num_hits = BlastSearch.filter_hits(
+        sensitive_result_path,
+        blast_result_path,
+        RNAcodeWebCore.OUTFMT,
+        WORD_SIZE_DIC[iteration],
+        taxids,
+        MAX_TARGET_SEQS_BLASTN,
+    )
+    vprint(f"{num_hits} hits for iteration {iteration}")
+    write_status_file(f"blastn_{iteration}.{JOB_ID}", ["CD", 0])
+
 
 def seq_selection(i):
     """2. Step of analysis. Select candidates from blast output."""
@@ -213,44 +386,256 @@ def seq_selection(i):
     with open(seqsel_wrapper_path, "w", encoding="UTF-8") as file_handle:
         file_handle.write(seqsel_wrapper)
 
+    blast_result_path = RNAcodeWebCore.BLAST_RESULT_PATH_TEMPLATE.format(JOB_ID, i)
+    selected_sequences_path = RNAcodeWebCore.SELECTED_SEQUENCES_PATH_TEMPLATE.format(JOB_ID, i)
+    # Selected and reference species are changed by the selection
+    state_paths = [
+        RNAcodeWebCore.SELECTED_SPECIES_FILE_TEMPLATE.format(JOB_ID),
+        RNAcodeWebCore.REFERENCE_SPECIES_FILE_TEMPLATE.format(JOB_ID),
+    ]
+    if RNAcodeWebCore.step_done(job_type, seqsel_wrapper_path, [blast_result_path], [selected_sequences_path]):
+        return
     if not RNAcodeWebCore.slurm_batch(seqsel_wrapper_path, job_type):
         eprint("Sequence selection exited with error!")
         with open(error_file, "r", encoding="UTF-8") as file_handle:
             eprint(file_handle.read())
         raise RNAcodeWebCore.PipelineError
+    RNAcodeWebCore.mark_step_done(
+        job_type, seqsel_wrapper_path, [blast_result_path], [selected_sequences_path], state_paths
+    )
 
 
-def main():
-    """Back end service for RNAcode web. Handles all computation etc."""
-    get_arguments()
+def count_sequences(iteration):
+    """Return number of sequences selected up to iteration."""
+    current_work_dir = RNAcodeWebCore.CURRENT_WORK_DIR_TEMPLATE.format(JOB_ID)
+    return len(collect_sequences(iteration, current_work_dir=current_work_dir))
+
+
+def hit_summary(iteration, num_new_seqs):
+    """Return hits of iteration for choose_strategy()."""
+    blast_result_path = RNAcodeWebCore.BLAST_RESULT_PATH_TEMPLATE.format(JOB_ID, iteration)
+    return [iteration] + BlastSearch.hit_stats(blast_result_path, RNAcodeWebCore.OUTFMT) + [num_new_seqs]
+
+
+def prepare_iteration(iteration, searched_taxids):
+    """Build taxid list of iteration.
+
+    Returns [search, taxids, rank_taxid]. taxids and rank_taxid, the taxid of
+    the taxonomic range, are None if the search is not restricted. search is
+    False if there are no species left in the taxonomic range or the
+    range is the same as the one of the last search (searched_taxids), the
+    iteration can not add new species and is skipped.
+    """
+    write_status_file(f"seqSel_{iteration}.{JOB_ID}", ["NS", "0"])
+    write_status_file(f"blastn_{iteration}.{JOB_ID}", ["NS", "0"])
+    rank_taxid = build_taxid_list(iteration)
+    restricted = rank_taxid is not None
+    taxids = read_taxid_list(iteration) if restricted else None
+    if restricted and (len(taxids) == 0 or taxids == searched_taxids):
+        vprint(f"No new species in taxonomic range, skip iteration {iteration}")
+        write_status_file(f"blastn_{iteration}.{JOB_ID}", ["CD", "skipped"])
+        write_status_file(f"seqSel_{iteration}.{JOB_ID}", ["CD", "skipped"])
+        return [False, taxids, rank_taxid]
+    return [True, taxids, rank_taxid]
+
+
+def parent_level_search(iteration, taxids, rank_taxid):
+    """Take hits of iteration from a search of the whole parent sequence.
+
+    Children overlap by half, searching the parent once per taxonomic range
+    saves the repeated search of every base. The search is shared by all
+    children of the parent with the same range. The first child searches with
+    the most sensitive word size of the iteration and the taxid list of the
+    range without exclusion of selected species, the other children wait for
+    the lock of the search. Each child keeps the hits in its window, clipped to
+    it and restricted to taxids (None for no restriction). rank_taxid is the
+    taxid of the range.
+    """
+    taxon = rank_taxid if taxids is not None else "all"
+    search_dir = RNAcodeWebCore.PARENT_SEARCH_DIR_TEMPLATE.format(PARENT_JOB_ID)
+    shared_result_path = f"{search_dir}/{iteration}_{taxon}_blastn.tsv"
+    os.makedirs(search_dir, exist_ok=True)
+
+    write_status_file(f"blastn_{iteration}.{JOB_ID}", ["PD", 0])
+    with open(shared_result_path + ".lock", "a", encoding="UTF-8") as lock_handle:
+        fcntl.flock(lock_handle, fcntl.LOCK_EX)
+        if not os.path.isfile(shared_result_path):
+            vprint(f"Blast parent {PARENT_JOB_ID} for iteration {iteration}")
+            parent_result_path = RNAcodeWebCore.PARENT_BLAST_RESULT_PATH_TEMPLATE.format(
+                JOB_ID, iteration
+            )
+            taxids_path = None
+            if taxids is not None:
+                taxids_path = RNAcodeWebCore.RANK_TAXIDS_PATH_TEMPLATE.format(JOB_ID, iteration)
+            # Children overlap by half, about two windows per child length
+            num_windows = 2 * -(-len(PARENT_SEQ_NUC) // len(INPUT_SEQ_NUC))
+            blastn(
+                iteration,
+                max_target_seqs=MAX_TARGET_SEQS_BLASTN * num_windows,
+                blast_result_path=parent_result_path,
+                query_path=RNAcodeWebCore.PARENT_INPUT_FILE_PATH_TEMPLATE.format(JOB_ID),
+                taxids_path=taxids_path,
+                max_hsps=PARENT_MAX_HSPS,
+            )
+            move(parent_result_path, shared_result_path + ".tmp")
+            os.replace(shared_result_path + ".tmp", shared_result_path)
+
+    blast_result_path = RNAcodeWebCore.BLAST_RESULT_PATH_TEMPLATE.format(JOB_ID, iteration)
+    num_hits = BlastSearch.clip_hits(
+        shared_result_path,
+        blast_result_path,
+        RNAcodeWebCore.OUTFMT,
+        RNAcodeWebCore.GENOME_START + 1,
+        RNAcodeWebCore.GENOME_START + len(INPUT_SEQ_NUC),
+        WORD_SIZE_DIC[iteration],
+        taxids,
+        MAX_TARGET_SEQS_BLASTN,
+    )
+    vprint(f"{num_hits} hits of the parent search in window")
+    write_status_file(f"blastn_{iteration}.{JOB_ID}", ["CD", 0])
 
-    vprint("Initializing work directory")
-    init_work_dir()
+
+def search(iteration, taxids, rank_taxid, previous, num_seqs):
+    """1. Step of analysis. Search with blast for iteration.
+
+    rank_taxid is the taxid of the taxonomic range of taxids, see
+    prepare_iteration().
+    """
+    if SINGLE_PASS:
+        single_pass_blastn(iteration, taxids)
+        return
+    if PARENT_SEQ_NUC is not None:
+        parent_level_search(iteration, taxids, rank_taxid)
+        return
+    task, word_size, max_target_seqs = choose_strategy(iteration, previous, num_seqs)
+    vprint(f"Blast {iteration} with {task}, word size {word_size}, {max_target_seqs} hits")
+    blastn(iteration, task, word_size, max_target_seqs)
+
+
+def remove_selected_hits(iteration, taxids):
+    """Remove hits of species selected after the taxid list was built."""
+    selected_species_file = RNAcodeWebCore.SELECTED_SPECIES_FILE_TEMPLATE.format(JOB_ID)
+    blast_result_path = RNAcodeWebCore.BLAST_RESULT_PATH_TEMPLATE.format(JOB_ID, iteration)
+    with open(selected_species_file, "r", encoding="UTF-8") as file_handle:
+        selected_species = set(line.strip() for line in file_handle)
+    # Word size 0 keeps all hits of the remaining species
+    BlastSearch.filter_hits(
+        blast_result_path,
+        blast_result_path,
+        RNAcodeWebCore.OUTFMT,
+        0,
+        taxids - selected_species,
+        MAX_TARGET_SEQS_BLASTN,
+    )
+
+
+def iterative_selection():
+    """Search and select sequences iteration by iteration.
+
+    Returns the last iteration.
+    """
+    # Hits of the last searched iteration, see choose_strategy()
+    previous = None
+    num_seqs = 0
+    searched_taxids = None
     for iteration in range(1, 6):
-        write_status_file(f"seqSel_{iteration}.{JOB_ID}", ["NS", "0"])
-        write_status_file(f"blastn_{iteration}.{JOB_ID}", ["NS", "0"])
         vprint(f"{iteration}. Iteration of selection")
+        do_search, taxids, rank_taxid = prepare_iteration(iteration, searched_taxids)
+        if not do_search:
+            continue
+        searched_taxids = taxids
         vprint("Start blast")
-        blastn(iteration)
+        search(iteration, taxids, rank_taxid, previous, num_seqs)
         vprint("Select sequences")
         seq_selection(iteration)
-        num_seqs = len(
-            collect_sequences(
-                iteration,
-                current_work_dir=RNAcodeWebCore.CURRENT_WORK_DIR_TEMPLATE.format(
-                    JOB_ID
-                ),
-            )
-        )
+        previous_num_seqs = num_seqs
+        num_seqs = count_sequences(iteration)
         vprint(f"{num_seqs} sequences found.")
         if num_seqs >= SeqSelection.MAX_NUM_SEQ:
             break
+        previous = hit_summary(iteration, num_seqs - previous_num_seqs)
+    return iteration
+
+
+def speculative_selection():
+    """Search all iterations after the first one at the same time.
+
+    The taxid lists of iterations 2 to 5 only depend on the reference species
+    and the species selected in iteration 1. Their searches run concurrently,
+    the results are used in order. Hits of species selected by an earlier
+    iteration are removed before the sequence selection. Once enough sequences
+    are found, the searches still running are cancelled. Returns the last
+    iteration.
+    """
+    vprint("1. Iteration of selection")
+    _do_search, searched_taxids, rank_taxid = prepare_iteration(1, None)
+    vprint("Start blast")
+    search(1, searched_taxids, rank_taxid, None, 0)
+    vprint("Select sequences")
+    seq_selection(1)
+    num_seqs = count_sequences(1)
+    vprint(f"{num_seqs} sequences found.")
+    if num_seqs >= SeqSelection.MAX_NUM_SEQ:
+        return 1
+    previous = hit_summary(1, num_seqs)
+
+    planned = []
+    for iteration in range(2, 6):
+        do_search, taxids, rank_taxid = prepare_iteration(iteration, searched_taxids)
+        if do_search:
+            planned.append([iteration, taxids, rank_taxid])
+            searched_taxids = taxids
+    if len(planned) == 0:
+        return 1
+
+    vprint(f"Start blast of iterations {', '.join(str(plan[0]) for plan in planned)}")
+    pool = ThreadPoolExecutor(max_workers=len(planned))
+    futures = {
+        iteration: pool.submit(search, iteration, taxids, rank_taxid, previous, num_seqs)
+        for iteration, taxids, rank_taxid in planned
+    }
+    last_iteration = 1
+    try:
+        for iteration, taxids, _rank_taxid in planned:
+            futures[iteration].result()
+            vprint(f"{iteration}. Iteration of selection")
+            if taxids is not None:
+                remove_selected_hits(iteration, taxids)
+            vprint("Select sequences")
+            seq_selection(iteration)
+            last_iteration = iteration
+            num_seqs = count_sequences(iteration)
+            vprint(f"{num_seqs} sequences found.")
+            if num_seqs >= SeqSelection.MAX_NUM_SEQ:
+                break
+    finally:
+        # Searches of iterations which are not used
+        for iteration, _taxids, _rank_taxid in planned:
+            if iteration <= last_iteration:
+                continue
+            futures[iteration].cancel()
+            RNAcodeWebCore.cancel_step(f"blastn_{iteration}")
+            write_status_file(f"seqSel_{iteration}.{JOB_ID}", None)
+        pool.shutdown(wait=False)
+    return last_iteration
+
+
+def main():
+    """Back end service for RNAcode web. Handles all computation etc."""
+    get_arguments()
+
+    vprint("Initializing work directory")
+    init_work_dir()
+    if SPECULATIVE:
+        iteration = speculative_selection()
+    else:
+        iteration = iterative_selection()
 
     # checks if enough candidates had been found
     check_num_seq(iteration)
     concat_sequences_fasta(iteration)
     vprint("Aligne sequences")
-    clustalo()
+    align()
     vprint("Plot tree")
     plot_alignment()
     vprint("Make MAF")
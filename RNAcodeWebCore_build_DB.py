@@ -2,11 +2,13 @@
 import sys
 import os
 import re
-import json
+import traceback
+from glob import glob
 from shutil import rmtree, copyfile
 from time import sleep
 
 import RNAcodeWebCore
+import RNAcodeWebCore_custom_DB
 from RNAcodeWebCore import start_pipeline
 from RNAcodeWebCore import eprint
 from RNAcodeWebCore import vprint
@@ -17,9 +19,14 @@ from RNAcodeWebCore import get_version
 from RNAcodeWebCore import render_jinja
 
 import SeqSelection
+import BlastSearch
+import CustomDbCache
+import JobStatusLog
 from SeqSelection import DB_SIZE
 from SeqSelection import collect_sequences
 from SeqSelection_build_DB import TAXIDMAPFILE_PATH
+from SeqSelection_build_DB import REGION_QUERY_RANGES_PATH
+from SeqSelection_build_DB import region_accession
 
 RNAcodeWebCore.VERBOSE = True
 
@@ -29,6 +36,23 @@ E_VALUE_CUTOFF = 0.01
 # Word size for blast in each iteration.
 WORD_SIZE_DIC = {1: 18, 2: 14, 3: 10, 4: 8, 5: 7}
 
+# Chunked query. A parent longer than QUERY_CHUNK_LENGTH is searched in
+# overlapping chunks as array tasks, see blastn().
+CHUNK_QUERY = True
+QUERY_CHUNK_LENGTH = 20000
+QUERY_CHUNK_OVERLAP = 2000
+
+# Once the db is built the windows of all children are searched against it in
+# one multi query blast, split into array tasks of this many windows. The
+# children start with sequence selection, see search_children().
+SEARCH_CHILDREN = True
+WINDOWS_PER_CHILD_BLAST = 50
+
+# Build a sub db per segment of the parent (RNAcodeWebCore.CUSTOM_DB_SEGMENT_LENGTH)
+# with the regions of the segment. Children search the db of their segment,
+# see segment_db_calls().
+SEGMENT_DBS = False
+
 # will be set in get_arguments()
 JOB_ID = None
 INPUT_SEQ_NUC = None
@@ -38,26 +62,38 @@ BLAST_WRAPPER_TEMPLATE = (
     "set -e\n\n"
     f'blastn -db "{{}}" -query {{}} -max_target_seqs {MAX_TARGET_SEQS_BLASTN} '
     f'-taxidlist {{}} -outfmt "{RNAcodeWebCore.OUTFMT}" -out {{}} -evalue {E_VALUE_CUTOFF} '
-    "-num_threads {} -max_hsps 1 -task blastn -word_size {}\n"
+    "-num_threads {} -task blastn -word_size {}\n"
 )
 
 SEQSEL_WRAPPER_TEMPLATE = (
     "#!/bin/bash\n\n"
     "set -e\n\n"
     "source $PYTHON_ENV/bin/activate\n\n"
-    'python3 SeqSelection_pipeline.py {} "{}"\n'
+    'python3 SeqSelection_pipeline.py {} "{}" {}\n'
 )
 
-BUILD_DB_WRAPPER_TEMPLATE = (
+CHILD_BLAST_WRAPPER_TEMPLATE = (
     "#!/bin/bash\n\n"
     "set -e\n\n"
-    "makeblastdb -in {0} -parse_seqids -dbtype nucl -taxid_map {3} -title {1} -out {2}/{1}\n"
+    "DBS=({})\n\n"
+    'blastn -db "${{DBS[$SLURM_ARRAY_TASK_ID]}}" '
+    f"-query {RNAcodeWebCore.CHILD_BLAST_DIR}/queries_${{{{SLURM_ARRAY_TASK_ID}}}}.fasta "
+    f"-max_target_seqs {DB_SIZE} "
+    f'-outfmt "6 qseqid {RNAcodeWebCore.OUTFMT[2:]}" '
+    f"-out {RNAcodeWebCore.CHILD_BLAST_DIR}/result_${{{{SLURM_ARRAY_TASK_ID}}}}.tsv "
+    f"-evalue {RNAcodeWebCore_custom_DB.E_VALUE_CUTOFF} -num_threads {{}} -max_hsps 1 "
+    f"-task blastn -word_size {RNAcodeWebCore_custom_DB.WORD_SIZE}\n"
 )
 
+MAKEBLASTDB_CALL = "makeblastdb -in {0} -parse_seqids -dbtype nucl -taxid_map {3} -title {1} -out {2}/{1}\n"
+
+BUILD_DB_WRAPPER_TEMPLATE = "#!/bin/bash\n\n" "set -e\n\n" + MAKEBLASTDB_CALL
+
 
 def get_arguments():
     """Get arguments from sys."""
     global JOB_ID, INPUT_SEQ_NUC
+    RNAcodeWebCore.take_resume_flag()
     JOB_ID = sys.argv[1]
     RNAcodeWebCore.JOB_ID = JOB_ID
 
@@ -73,6 +109,7 @@ def get_arguments():
     # RNAcodeWebCore.STDERR_FILE_PATH = None
 
     INPUT_SEQ_NUC = sys.argv[2]
+    RNAcodeWebCore.INPUT_SEQ_LEN = len(INPUT_SEQ_NUC)
     RNAcodeWebCore.DB_TYPE = sys.argv[3]
 
     if RNAcodeWebCore.DB_TYPE == "nt":
@@ -111,6 +148,8 @@ def init_work_dir():
     if not os.path.isdir(current_work_dir):
         os.mkdir(current_work_dir)
         os.mkdir(custom_db_path)
+    elif RNAcodeWebCore.RESUME:
+        vprint("Resume in existing work directory")
     else:
         rmtree(current_work_dir)
         os.mkdir(current_work_dir)
@@ -125,11 +164,11 @@ def init_work_dir():
         "blastn_1": ["R", 0],
         "seqSel_1": ["NS", 0],
         "buildDB": ["NS", 0],
+        "childBlast": ["NS", 0],
         "fullJob": ["R", 0],
     }
 
-    with open(job_status_file, "w", encoding="UTF-8") as file_handle:
-        json.dump(job_status, file_handle, indent=4)
+    JobStatusLog.reset(job_status_file, job_status)
 
     with open(selected_species_file, "w", encoding="UTF-8") as file_handle:
         file_handle.write("None")
@@ -137,14 +176,32 @@ def init_work_dir():
     with open(taxidmapfile_path, "w", encoding="UTF-8") as file_handle:
         file_handle.write("")
 
+    with open(current_work_dir + "/" + REGION_QUERY_RANGES_PATH, "w", encoding="UTF-8") as file_handle:
+        file_handle.write("")
+
     copyfile("./templates/pipeline/python_requirements.txt", python_req_path)
     copyfile("./SeqSelection.py", seq_selection_module_path)
     copyfile("./SeqSelection_build_DB.py", seq_selection_script_path)
     make_readme()
 
 
+def write_query_chunks(chunks):
+    """Write the query chunks as fasta files."""
+    for i, [start, stop] in enumerate(chunks):
+        with open(
+            RNAcodeWebCore.QUERY_CHUNK_PATH_TEMPLATE.format(JOB_ID, i), "w", encoding="UTF-8"
+        ) as file_handle:
+            file_handle.write(f">Target_{start}\n{INPUT_SEQ_NUC[start:stop]}\n")
+
+
 def blastn(iteration):
-    """Call blast."""
+    """Call blast.
+
+    A long parent is searched in chunks if CHUNK_QUERY is set. All chunks use
+    the search space of the whole parent, so their e-values are the same as
+    for a single search, and their hits are merged. Chunks take precedence
+    over shards, both run as job array.
+    """
     job_type = f"blastn_{iteration}"
     input_file_path = RNAcodeWebCore.INPUT_FILE_PATH_TEMPLATE.format(JOB_ID)
     blast_result_path = RNAcodeWebCore.BLAST_RESULT_PATH_TEMPLATE.format(JOB_ID, iteration)
@@ -152,33 +209,76 @@ def blastn(iteration):
     taxids_path = RNAcodeWebCore.TAXIDS_PATH_TEMPLATE.format(JOB_ID, iteration)
 
     error_file = RNAcodeWebCore.SLURM_ERROR_TEMPLATE.format(JOB_ID, job_type)
-    idle_cores = RNAcodeWebCore.get_number_idles_cpus()
-    cores = [v for k, v in RNAcodeWebCore.CORE_USE_DIC.items() if idle_cores in k][0]
+    cost = RNAcodeWebCore.blast_cost(WORD_SIZE_DIC[iteration], RNAcodeWebCore.DB_TYPE)
 
     build_taxid_list(iteration)
 
+    blast_db = RNAcodeWebCore.BLAST_DB
+    blast_query = input_file_path.split("/")[-1]
+    blast_out = blast_result_path.split("/")[-1]
+    num_shards = None
+    chunks = None
+    if CHUNK_QUERY and len(INPUT_SEQ_NUC) > QUERY_CHUNK_LENGTH:
+        chunks = BlastSearch.query_chunks(len(INPUT_SEQ_NUC), QUERY_CHUNK_LENGTH, QUERY_CHUNK_OVERLAP)
+        write_query_chunks(chunks)
+        blast_query = RNAcodeWebCore.QUERY_CHUNK_PATH_TEMPLATE.format(
+            JOB_ID, "${SLURM_ARRAY_TASK_ID}"
+        ).split("/")[-1]
+        blast_out += BlastSearch.CHUNK_SUFFIX.format("${SLURM_ARRAY_TASK_ID}")
+    elif RNAcodeWebCore.SHARDED_BLAST:
+        shards, db_size = RNAcodeWebCore.blast_shards(RNAcodeWebCore.BLAST_DB)
+        num_shards = len(shards)
+        blast_db = RNAcodeWebCore.SHARD_DB
+        blast_out += BlastSearch.SHARD_SUFFIX.format("${SLURM_ARRAY_TASK_ID}")
+    num_tasks = len(chunks) if chunks is not None else num_shards
+    cores = RNAcodeWebCore.get_blast_cores(cost / (num_tasks or 1))
+
     blast_wrapper = BLAST_WRAPPER_TEMPLATE.format(
-        RNAcodeWebCore.BLAST_DB,
-        input_file_path.split("/")[-1],
+        blast_db,
+        blast_query,
         taxids_path.split("/")[-1],
-        blast_result_path.split("/")[-1],
+        blast_out,
         cores,
         WORD_SIZE_DIC[iteration],
     )
+    if num_shards is not None:
+        blast_wrapper = RNAcodeWebCore.shard_blast_wrapper(blast_wrapper, shards, db_size)
+    if chunks is not None:
+        search_space = len(INPUT_SEQ_NUC) * RNAcodeWebCore.blast_db_size(blast_db)
+        blast_wrapper = blast_wrapper.rstrip("\n") + f" -searchsp {search_space}\n"
+    blast_wrapper = RNAcodeWebCore.warm_blast_wrapper(blast_wrapper, blast_db)
 
     with open(blast_wrapper_path, "w", encoding="UTF-8") as file_handle:
         file_handle.write(blast_wrapper)
 
-    if not RNAcodeWebCore.slurm_batch(blast_wrapper_path, job_type, cores=cores):
+    if RNAcodeWebCore.step_done(job_type, blast_wrapper_path, [input_file_path, taxids_path], [blast_result_path]):
+        return
+    if not RNAcodeWebCore.slurm_batch(
+        blast_wrapper_path,
+        job_type,
+        cores=cores,
+        array=num_tasks,
+        cost=cost,
+        features={"word_size": WORD_SIZE_DIC[iteration]},
+    ):
         eprint("Blast exited with error!")
         with open(error_file, "r", encoding="UTF-8") as file_handle:
             eprint(file_handle.read())
         raise RNAcodeWebCore.PipelineError
 
+    if num_shards is not None:
+        BlastSearch.merge_results(blast_result_path, num_shards, MAX_TARGET_SEQS_BLASTN)
+    if chunks is not None:
+        BlastSearch.merge_chunk_results(
+            blast_result_path, chunks, RNAcodeWebCore.OUTFMT, MAX_TARGET_SEQS_BLASTN
+        )
+    RNAcodeWebCore.mark_step_done(job_type, blast_wrapper_path, [input_file_path, taxids_path], [blast_result_path])
+
 
 def build_db():
-    """Build blast db."""
+    """Build blast db and, if SEGMENT_DBS is set, the sub dbs of the segments."""
     job_type = "buildDB"
+    current_work_dir = RNAcodeWebCore.CURRENT_WORK_DIR_TEMPLATE.format(JOB_ID)
     blast_db_fasta_path = RNAcodeWebCore.BLAST_DB_FASTA_PATH_TEMPLATE.format(JOB_ID)
     custom_db_path = RNAcodeWebCore.CUSTOM_DB_PATH
     build_db_wrapper_path = RNAcodeWebCore.BUILD_DB_WRAPPER_PATH_TEMPLATE.format(JOB_ID)
@@ -191,15 +291,219 @@ def build_db():
         custom_db_path,
         TAXIDMAPFILE_PATH,
     )
+    if SEGMENT_DBS:
+        build_db_wrapper += segment_db_calls()
 
     with open(build_db_wrapper_path, "w", encoding="UTF-8") as file_handle:
         file_handle.write(build_db_wrapper)
 
+    input_paths = [blast_db_fasta_path, f"{current_work_dir}/{TAXIDMAPFILE_PATH}"]
+    output_paths = [f"{current_work_dir}/{custom_db_path}/{JOB_ID}.nin"]
+    if RNAcodeWebCore.step_done(job_type, build_db_wrapper_path, input_paths, output_paths):
+        return
     if not RNAcodeWebCore.slurm_batch(build_db_wrapper_path, job_type):
         eprint("makeblastdb exited with error!")
         with open(error_file, "r", encoding="UTF-8") as file_handle:
             eprint(file_handle.read())
         raise RNAcodeWebCore.PipelineError
+    RNAcodeWebCore.mark_step_done(job_type, build_db_wrapper_path, input_paths, output_paths)
+
+
+def read_region_query_ranges():
+    """Return region id -> [query start, query stop] of the selected regions."""
+    current_work_dir = RNAcodeWebCore.CURRENT_WORK_DIR_TEMPLATE.format(JOB_ID)
+    query_ranges = {}
+    with open(f"{current_work_dir}/{REGION_QUERY_RANGES_PATH}", "r", encoding="UTF-8") as file_handle:
+        for line in file_handle:
+            if line.strip() == "":
+                continue
+            region, query_start, query_stop = line.split()
+            query_ranges[region] = [int(query_start), int(query_stop)]
+    return query_ranges
+
+
+def segment_db_calls():
+    """Write the fasta of a sub db for every segment of the parent.
+
+    The sub db of a segment holds the regions whose hits on the parent overlap
+    the windows of the children starting in the segment. Segments without
+    regions get no db, their children search the whole custom db. Returns the
+    makeblastdb calls of the sub dbs.
+    """
+    current_work_dir = RNAcodeWebCore.CURRENT_WORK_DIR_TEMPLATE.format(JOB_ID)
+    blast_db_fasta_path = RNAcodeWebCore.BLAST_DB_FASTA_PATH_TEMPLATE.format(JOB_ID)
+    segment_length = RNAcodeWebCore.CUSTOM_DB_SEGMENT_LENGTH
+
+    query_ranges = read_region_query_ranges()
+    regions = {}
+    region = None
+    with open(blast_db_fasta_path, "r", encoding="UTF-8") as file_handle:
+        for line in file_handle:
+            if line[0] == ">":
+                region = line[1:].split()[0]
+                regions[region] = ""
+            regions[region] += line
+
+    calls = ""
+    num_segments = -(-len(INPUT_SEQ_NUC) // segment_length)
+    for segment in range(num_segments):
+        # Children starting in the segment reach one child window further
+        segment_start = segment * segment_length + 1
+        segment_stop = (segment + 1) * segment_length + RNAcodeWebCore.CHILD_LENGTH
+        segment_regions = [
+            region
+            for region, [query_start, query_stop] in query_ranges.items()
+            if region in regions and query_start <= segment_stop and segment_start <= query_stop
+        ]
+        if len(segment_regions) == 0:
+            continue
+        segment_db = RNAcodeWebCore.CUSTOM_DB_SEGMENT_TEMPLATE.format(JOB_ID, segment)
+        segment_fasta_path = f"{current_work_dir}/{segment_db}.fasta"
+        with open(segment_fasta_path, "w", encoding="UTF-8") as file_handle:
+            file_handle.write("".join(regions[region] for region in segment_regions))
+        calls += MAKEBLASTDB_CALL.format(
+            segment_fasta_path.split("/")[-1],
+            segment_db,
+            RNAcodeWebCore.CUSTOM_DB_PATH,
+            TAXIDMAPFILE_PATH,
+        )
+    return calls
+
+
+def take_cached_db():
+    """Use a cached custom db covering the parent.
+
+    Returns the number of sequences of the db or None if there is none. Sub
+    dbs of segments are only used if the db was built for the same sequence.
+    """
+    if not RNAcodeWebCore.CUSTOM_DB_CACHE:
+        return None
+    custom_db_dir = f"{RNAcodeWebCore.CURRENT_WORK_DIR_TEMPLATE.format(JOB_ID)}/{RNAcodeWebCore.CUSTOM_DB_PATH}"
+    found = CustomDbCache.acquire(
+        RNAcodeWebCore.CUSTOM_DB_CACHE_DIR,
+        INPUT_SEQ_NUC,
+        RNAcodeWebCore.DB_TYPE,
+        RNAcodeWebCore.DB_VERSION,
+        custom_db_dir,
+        JOB_ID,
+    )
+    if found is None:
+        return None
+    entry_dir, _exact, meta = found
+    vprint(f"Using cached custom db {entry_dir}")
+    for job_type in ["blastn_1", "seqSel_1", "buildDB"]:
+        write_status_file(f"{job_type}.{JOB_ID}", ["CD", "cached"])
+    return meta["num_seqs"]
+
+
+def cache_db(num_seqs):
+    """Move the built custom db into the cache and use it from there."""
+    if not RNAcodeWebCore.CUSTOM_DB_CACHE:
+        return
+    custom_db_dir = f"{RNAcodeWebCore.CURRENT_WORK_DIR_TEMPLATE.format(JOB_ID)}/{RNAcodeWebCore.CUSTOM_DB_PATH}"
+    segment_dbs = sorted(
+        os.path.basename(path).split(".")[0]
+        for path in glob(f"{custom_db_dir}/{RNAcodeWebCore.CUSTOM_DB_SEGMENT_TEMPLATE.format(JOB_ID, '*')}.nin")
+    )
+    try:
+        entry_dir = CustomDbCache.store(
+            RNAcodeWebCore.CUSTOM_DB_CACHE_DIR,
+            INPUT_SEQ_NUC,
+            RNAcodeWebCore.DB_TYPE,
+            RNAcodeWebCore.DB_VERSION,
+            custom_db_dir,
+            [JOB_ID] + segment_dbs,
+            num_seqs,
+            JOB_ID,
+        )
+        if entry_dir is None:
+            # An other parent with the same sequence was faster
+            return
+        for key in CustomDbCache.evict(
+            RNAcodeWebCore.CUSTOM_DB_CACHE_DIR, RNAcodeWebCore.WORK_DIR, RNAcodeWebCore.CUSTOM_DB_CACHE_SIZE
+        ):
+            vprint(f"Evicted cached custom db {key}")
+    except OSError:
+        eprint("Could not cache custom db")
+        eprint(traceback.format_exc())
+
+
+def search_children():
+    """Search the windows of all children against the custom db.
+
+    The windows are the queries of one blast, their hits are split by query
+    into one result per child. A child finding its result skips its own blast.
+    Every task searches the windows of one db, the custom db or the sub db of
+    a segment.
+    """
+    job_type = "childBlast"
+    current_work_dir = RNAcodeWebCore.CURRENT_WORK_DIR_TEMPLATE.format(JOB_ID)
+    child_blast_dir = f"{current_work_dir}/{RNAcodeWebCore.CHILD_BLAST_DIR}"
+    child_blast_wrapper_path = RNAcodeWebCore.CHILD_BLAST_WRAPPER_PATH_TEMPLATE.format(JOB_ID)
+    error_file = RNAcodeWebCore.SLURM_ERROR_TEMPLATE.format(JOB_ID, job_type)
+
+    if os.path.isdir(child_blast_dir) and not RNAcodeWebCore.RESUME:
+        rmtree(child_blast_dir)
+    os.makedirs(child_blast_dir, exist_ok=True)
+
+    # db name -> [child job id, start, stop] of the windows searching it
+    db_windows = {}
+    for i, [start, stop] in enumerate(RNAcodeWebCore.child_windows(len(INPUT_SEQ_NUC))):
+        db_name = RNAcodeWebCore.custom_db_name(JOB_ID, start)
+        db_windows.setdefault(db_name, []).append([f"{JOB_ID}-child_{i + 1}", start, stop])
+
+    child_job_ids = []
+    task_dbs = []
+    for db_name, windows in db_windows.items():
+        for i in range(0, len(windows), WINDOWS_PER_CHILD_BLAST):
+            task_id = len(task_dbs)
+            task_dbs.append(f"{RNAcodeWebCore.CUSTOM_DB_PATH}/{db_name}")
+            with open(f"{child_blast_dir}/queries_{task_id}.fasta", "w", encoding="UTF-8") as file_handle:
+                for child_job_id, start, stop in windows[i:i + WINDOWS_PER_CHILD_BLAST]:
+                    child_job_ids.append(child_job_id)
+                    file_handle.write(f">{child_job_id}\n{INPUT_SEQ_NUC[start:stop]}\n")
+    num_tasks = len(task_dbs)
+
+    # Every base is in about two windows
+    cost = 2 * RNAcodeWebCore.blast_cost(RNAcodeWebCore_custom_DB.WORD_SIZE, "custom")
+    cores = RNAcodeWebCore.get_blast_cores(cost / num_tasks)
+    with open(child_blast_wrapper_path, "w", encoding="UTF-8") as file_handle:
+        file_handle.write(
+            CHILD_BLAST_WRAPPER_TEMPLATE.format(" ".join(task_dbs), cores)
+        )
+
+    query_paths = [f"{child_blast_dir}/queries_{task_id}.fasta" for task_id in range(num_tasks)]
+    child_result_paths = [
+        RNAcodeWebCore.CHILD_BLAST_RESULT_PATH_TEMPLATE.format(JOB_ID, child_job_id)
+        for child_job_id in child_job_ids
+    ]
+    if RNAcodeWebCore.step_done(job_type, child_blast_wrapper_path, query_paths, child_result_paths):
+        return
+
+    if not RNAcodeWebCore.slurm_batch(
+        child_blast_wrapper_path,
+        job_type,
+        cores=cores,
+        array=num_tasks,
+        cost=cost,
+        features={"word_size": RNAcodeWebCore_custom_DB.WORD_SIZE},
+    ):
+        eprint("Blast of children exited with error!")
+        with open(error_file, "r", encoding="UTF-8") as file_handle:
+            eprint(file_handle.read())
+        raise RNAcodeWebCore.PipelineError
+
+    child_hits = {child_job_id: [] for child_job_id in child_job_ids}
+    for task_id in range(num_tasks):
+        with open(f"{child_blast_dir}/result_{task_id}.tsv", "r", encoding="UTF-8") as file_handle:
+            for line in file_handle:
+                child_job_id, hit = line.split("\t", 1)
+                child_hits[child_job_id].append(hit)
+    for child_job_id, hits in child_hits.items():
+        child_result_path = RNAcodeWebCore.CHILD_BLAST_RESULT_PATH_TEMPLATE.format(JOB_ID, child_job_id)
+        with open(child_result_path, "w", encoding="UTF-8") as file_handle:
+            file_handle.write("".join(hits))
+    RNAcodeWebCore.mark_step_done(job_type, child_blast_wrapper_path, query_paths, child_result_paths)
 
 
 def seq_selection(iteration):
@@ -209,13 +513,29 @@ def seq_selection(iteration):
     error_file = RNAcodeWebCore.SLURM_ERROR_TEMPLATE.format(JOB_ID, job_type)
 
     with open(seqsel_wrapper_path, "w", encoding="UTF-8") as file_handle:
-        file_handle.write(SEQSEL_WRAPPER_TEMPLATE.format(iteration, RNAcodeWebCore.BLAST_DB))
+        file_handle.write(
+            SEQSEL_WRAPPER_TEMPLATE.format(iteration, RNAcodeWebCore.BLAST_DB, RNAcodeWebCore.CHILD_LENGTH)
+        )
 
+    current_work_dir = RNAcodeWebCore.CURRENT_WORK_DIR_TEMPLATE.format(JOB_ID)
+    blast_result_path = RNAcodeWebCore.BLAST_RESULT_PATH_TEMPLATE.format(JOB_ID, iteration)
+    selected_sequences_path = RNAcodeWebCore.SELECTED_SEQUENCES_PATH_TEMPLATE.format(JOB_ID, iteration)
+    # The selection appends to these files
+    state_paths = [
+        f"{current_work_dir}/{SeqSelection.SELECTED_SPECIES_FILE_PATH}",
+        f"{current_work_dir}/{TAXIDMAPFILE_PATH}",
+        f"{current_work_dir}/{REGION_QUERY_RANGES_PATH}",
+    ]
+    if RNAcodeWebCore.step_done(job_type, seqsel_wrapper_path, [blast_result_path], [selected_sequences_path]):
+        return
     if not RNAcodeWebCore.slurm_batch(seqsel_wrapper_path, job_type):
         eprint("Region selection exited with error!")
         with open(error_file, "r", encoding="UTF-8") as file_handle:
             eprint(file_handle.read())
         raise RNAcodeWebCore.PipelineError
+    RNAcodeWebCore.mark_step_done(
+        job_type, seqsel_wrapper_path, [blast_result_path], [selected_sequences_path], state_paths
+    )
 
 
 def count_last_blast_results(iteration):
@@ -239,12 +559,11 @@ def concat_sequences_fasta(iteration):
                 )
 
 
-def main():
-    """Build custom blast DB for parent jobs."""
-    get_arguments()
-    vprint("Initializing work directory")
-    init_work_dir()
+def select_and_build():
+    """Select sequences in up to five iterations and build the db of them.
 
+    Returns the number of selected sequences.
+    """
     for iteration in range(1, 6):
         write_status_file(f"seqSel_{iteration}.{JOB_ID}", ["NS", "0"])
         write_status_file(f"blastn_{iteration}.{JOB_ID}", ["NS", "0"])
@@ -253,7 +572,15 @@ def main():
         blastn(iteration)
         vprint("Select sequences")
         seq_selection(iteration)
-        num_seqs = len(collect_sequences(iteration + 1, current_work_dir=RNAcodeWebCore.CURRENT_WORK_DIR_TEMPLATE.format(JOB_ID)))
+        # Several regions can come from the same accession
+        num_seqs = len(
+            set(
+                region_accession(region)
+                for region in collect_sequences(
+                    iteration + 1, current_work_dir=RNAcodeWebCore.CURRENT_WORK_DIR_TEMPLATE.format(JOB_ID)
+                )
+            )
+        )
         vprint(f"{num_seqs} sequences found.")
         if num_seqs >= DB_SIZE:
             break
@@ -264,6 +591,25 @@ def main():
 
     concat_sequences_fasta(iteration)
     build_db()
+    cache_db(num_seqs)
+    return num_seqs
+
+
+def main():
+    """Build custom blast DB for parent jobs."""
+    get_arguments()
+    vprint("Initializing work directory")
+    init_work_dir()
+
+    num_seqs = take_cached_db()
+    if num_seqs is None:
+        num_seqs = select_and_build()
+    if SEARCH_CHILDREN:
+        vprint("Blast children")
+        try:
+            search_children()
+        except RNAcodeWebCore.PipelineError:
+            eprint("Blast of children failed, children search the custom db themselves")
     # Wait sometime. For reason beyond my comprehension some files seem to be
     # not written to disk when the process ended. Might cause error in child
     # processes.
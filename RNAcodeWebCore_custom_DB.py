@@ -5,7 +5,6 @@ Handles all computation etc.
 import sys
 import os
 import re
-import json
 from shutil import rmtree, copyfile
 
 import RNAcodeWebCore
@@ -17,23 +16,28 @@ from RNAcodeWebCore import get_version
 from RNAcodeWebCore import render_jinja
 from RNAcodeWebCore import notify_frontend
 from RNAcodeWebCore import check_num_seq
-from RNAcodeWebCore import clustalo
+from RNAcodeWebCore import align
+from RNAcodeWebCore import aligners
+from RNAcodeWebCore import ALIGNER_NAMES
 from RNAcodeWebCore import convert_to_maf
 from RNAcodeWebCore import rnacode
 from RNAcodeWebCore import plot_alignment
 from RNAcodeWebCore import concat_sequences_fasta
 
+import JobStatusLog
 from SeqSelection import DB_SIZE
 
 RNAcodeWebCore.VERBOSE = True
 
 E_VALUE_CUTOFF = 0.01
+WORD_SIZE = 5
 
 # Will be set in get_arguments()
 JOB_ID = None
 MIN_PAIR_DIST = None
 MAX_PAIR_DIST = None
 INPUT_SEQ_NUC = None
+PARENT_JOB_ID = None
 CUSTOM_DB_PATH = None
 
 BLAST_WRAPPER_TEMPLATE = (
@@ -41,7 +45,7 @@ BLAST_WRAPPER_TEMPLATE = (
     "set -e\n\n"
     f"blastn -db {{}} -query {{}} -max_target_seqs {DB_SIZE} "
     f'-outfmt "{RNAcodeWebCore.OUTFMT}" -out {{}} -evalue {E_VALUE_CUTOFF} '
-    "-num_threads {} -max_hsps 1 -task blastn -word_size 5\n"
+    f"-num_threads {{}} -max_hsps 1 -task blastn -word_size {WORD_SIZE}\n"
 )
 
 SEQSEL_WRAPPER_TEMPLATE = (
@@ -58,8 +62,9 @@ def make_readme():
     context = {}
     context["blast_version"] = get_version("blastn")
 
-    context["name_aligner"] = "Clustal Omega"
-    context["aligner_version"] = get_version("clustalo")
+    # The aligner is chosen when the sequences are known
+    context["name_aligner"] = " or ".join(ALIGNER_NAMES[aligner] for aligner in aligners())
+    context["aligner_version"] = ", ".join(get_version(aligner) for aligner in aligners())
 
     context["rnacode_version"] = get_version("RNAcode")
 
@@ -81,6 +86,8 @@ def init_work_dir():
     if not os.path.isdir(current_work_dir):
         os.mkdir(current_work_dir)
         os.mkdir(eps_path)
+    elif RNAcodeWebCore.RESUME:
+        vprint("Resume in existing work directory")
     else:
         rmtree(current_work_dir)
         os.mkdir(current_work_dir)
@@ -99,8 +106,7 @@ def init_work_dir():
         "fullJob": ["R", 0],
     }
 
-    with open(job_status_file, "w", encoding="UTF-8") as file_handle:
-        json.dump(job_status, file_handle, indent=4)
+    JobStatusLog.reset(job_status_file, job_status)
 
     make_readme()
 
@@ -111,8 +117,9 @@ def init_work_dir():
 
 def get_arguments():
     """Get arguments from sys."""
-    global JOB_ID, MIN_PAIR_DIST, MAX_PAIR_DIST, INPUT_SEQ_NUC, CUSTOM_DB_PATH
+    global JOB_ID, MIN_PAIR_DIST, MAX_PAIR_DIST, INPUT_SEQ_NUC, PARENT_JOB_ID, CUSTOM_DB_PATH
 
+    RNAcodeWebCore.take_resume_flag()
     JOB_ID = sys.argv[1]
     RNAcodeWebCore.JOB_ID = JOB_ID
     RNAcodeWebCore.STDOUT_FILE_PATH = RNAcodeWebCore.STDOUT_FILE_PATH.format(JOB_ID)
@@ -131,9 +138,26 @@ def get_arguments():
     MAX_PAIR_DIST = float(sys.argv[3])
     RNAcodeWebCore.GENOME_START = int(sys.argv[4])
     INPUT_SEQ_NUC = sys.argv[5]
+    RNAcodeWebCore.INPUT_SEQ_LEN = len(INPUT_SEQ_NUC)
 
-    parent_job_id = "-".join(JOB_ID.split("-")[:-1])
-    CUSTOM_DB_PATH = f"../{parent_job_id}/{RNAcodeWebCore.CUSTOM_DB_PATH}/{parent_job_id}"
+    PARENT_JOB_ID = "-".join(JOB_ID.split("-")[:-1])
+    custom_db_name = RNAcodeWebCore.custom_db_name(PARENT_JOB_ID, RNAcodeWebCore.GENOME_START)
+    CUSTOM_DB_PATH = f"../{PARENT_JOB_ID}/{RNAcodeWebCore.CUSTOM_DB_PATH}/{custom_db_name}"
+
+
+def take_parent_blast():
+    """Take blast result from the search of all children by the parent.
+
+    Returns False if there is none, see RNAcodeWebCore_build_DB.search_children().
+    """
+    child_result_path = RNAcodeWebCore.CHILD_BLAST_RESULT_PATH_TEMPLATE.format(
+        PARENT_JOB_ID, JOB_ID
+    )
+    if not os.path.isfile(child_result_path):
+        return False
+    copyfile(child_result_path, RNAcodeWebCore.BLAST_RESULT_PATH_TEMPLATE.format(JOB_ID, 1))
+    write_status_file(f"blastn_1.{JOB_ID}", ["CD", 0])
+    return True
 
 
 def blastn():
@@ -144,8 +168,8 @@ def blastn():
     blast_wrapper_path = RNAcodeWebCore.BLAST_WRAPPER_PATH_TEMPLATE.format(JOB_ID, 1)
 
     error_file = RNAcodeWebCore.SLURM_ERROR_TEMPLATE.format(JOB_ID, job_type)
-    idle_cores = RNAcodeWebCore.get_number_idles_cpus()
-    cores = [v for k, v in RNAcodeWebCore.CORE_USE_DIC.items() if idle_cores in k][0]
+    cost = RNAcodeWebCore.blast_cost(WORD_SIZE, "custom")
+    cores = RNAcodeWebCore.get_blast_cores(cost)
 
     blast_wrapper = BLAST_WRAPPER_TEMPLATE.format(
         CUSTOM_DB_PATH,
@@ -157,11 +181,20 @@ def blastn():
     with open(blast_wrapper_path, "w", encoding="UTF-8") as file_handle:
         file_handle.write(blast_wrapper)
 
-    if not RNAcodeWebCore.slurm_batch(blast_wrapper_path, job_type, cores=cores):
+    if RNAcodeWebCore.step_done(job_type, blast_wrapper_path, [input_file_path], [blast_result_path]):
+        return
+    if not RNAcodeWebCore.slurm_batch(
+        blast_wrapper_path,
+        job_type,
+        cores=cores,
+        cost=cost,
+        features={"word_size": WORD_SIZE},
+    ):
         eprint("Blast exited with error!")
         with open(error_file, "r", encoding="UTF-8") as file_handle:
             eprint(file_handle.read())
         raise RNAcodeWebCore.PipelineError
+    RNAcodeWebCore.mark_step_done(job_type, blast_wrapper_path, [input_file_path], [blast_result_path])
 
 
 def seq_selection():
@@ -173,11 +206,16 @@ def seq_selection():
     with open(seqsel_wrapper_path, "w", encoding="UTF-8") as file_handle:
         file_handle.write(SEQSEL_WRAPPER_TEMPLATE.format(MIN_PAIR_DIST, MAX_PAIR_DIST, CUSTOM_DB_PATH))
 
+    blast_result_path = RNAcodeWebCore.BLAST_RESULT_PATH_TEMPLATE.format(JOB_ID, 1)
+    selected_sequences_path = RNAcodeWebCore.SELECTED_SEQUENCES_PATH_TEMPLATE.format(JOB_ID, 1)
+    if RNAcodeWebCore.step_done(job_type, seqsel_wrapper_path, [blast_result_path], [selected_sequences_path]):
+        return
     if not RNAcodeWebCore.slurm_batch(seqsel_wrapper_path, job_type):
         eprint("Region selection exited with error!")
         with open(error_file, "r", encoding="UTF-8") as file_handle:
             eprint(file_handle.read())
         raise RNAcodeWebCore.PipelineError
+    RNAcodeWebCore.mark_step_done(job_type, seqsel_wrapper_path, [blast_result_path], [selected_sequences_path])
 
 
 def main():
@@ -186,15 +224,18 @@ def main():
 
     vprint("Initializing work directory")
     init_work_dir()
-    vprint("Blast")
-    blastn()
+    if take_parent_blast():
+        vprint("Blast result from parent")
+    else:
+        vprint("Blast")
+        blastn()
     vprint("Sequence selection")
     seq_selection()
     # checks if enough candidates had been found
     check_num_seq(1)
     concat_sequences_fasta(1)
     vprint("Aligne sequences")
-    clustalo()
+    align()
     vprint("Plot tree")
     plot_alignment()
     vprint("Make MAF")
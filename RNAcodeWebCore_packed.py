@@ -0,0 +1,260 @@
+"""Back end service for RNAcode web which runs the children of a parent packed.
+
+Without packing every child runs its own pipeline and every step of it is a
+SLURM job. With packing the children of one parent are run inside a job array.
+Each array task gets a slice of the children and runs them as sub processes,
+which execute their steps locally (RNACODE_WEB_EXECUTION=local) instead of
+submitting them to SLURM.
+
+Submit the children of a parent, started on the head node:
+
+    python3 RNAcodeWebCore_packed.py submit <parent_job_id> <spec_path>
+
+Run one array task, started by the pack job:
+
+    python3 RNAcodeWebCore_packed.py run <parent_job_id>
+
+Every line of the spec is one child. The pipeline (custom_DB or NCBI_DB)
+followed by the arguments for this pipeline, separated by tabs.
+"""
+import sys
+import os
+import traceback
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+from shutil import rmtree, copyfile
+
+import RNAcodeWebCore
+from RNAcodeWebCore import eprint
+from RNAcodeWebCore import vprint
+from RNAcodeWebCore import write_status_file
+from RNAcodeWebCore import notify_frontend
+
+import JobStatusLog
+
+RNAcodeWebCore.VERBOSE = True
+
+PIPELINES = ["custom_DB", "NCBI_DB"]
+# Number of children in one array task.
+CHILDREN_PER_TASK = 40
+# Number of children running at the same time in one array task.
+WORKERS_PER_TASK = 8
+# Cores of one array task. Shared evenly by the workers.
+CORES_PER_TASK = 16
+
+# Will be set in get_arguments()
+MODE = None
+JOB_ID = None
+PARENT_JOB_ID = None
+
+REPO_PATH = os.path.dirname(os.path.abspath(__file__))
+# Logs of the children, their stdout and stderr are appended
+CHILD_LOG_TEMPLATES = [RNAcodeWebCore.STDOUT_FILE_PATH, RNAcodeWebCore.STDERR_FILE_PATH]
+SPEC_PATH_TEMPLATE = RNAcodeWebCore.CURRENT_WORK_DIR_TEMPLATE + "/children.tsv"
+PACK_WRAPPER_PATH_TEMPLATE = RNAcodeWebCore.CURRENT_WORK_DIR_TEMPLATE + "/pack.sh"
+
+PACK_WRAPPER_TEMPLATE = (
+    "#!/bin/bash\n\n"
+    "set -e\n\n"
+    f"cd {REPO_PATH}\n\n"
+    f"{sys.executable} {REPO_PATH}/RNAcodeWebCore_packed.py run {{}}\n"
+)
+
+FINISHED_STATES = ["CD", "F", "E"]
+
+
+def get_arguments():
+    """Get arguments from sys."""
+    global MODE, JOB_ID, PARENT_JOB_ID
+
+    MODE = sys.argv[1]
+    PARENT_JOB_ID = sys.argv[2]
+    JOB_ID = PARENT_JOB_ID + "-pack"
+    RNAcodeWebCore.JOB_ID = JOB_ID
+
+    if MODE == "run":
+        # Array tasks log into the SLURM output of the pack job
+        RNAcodeWebCore.STDOUT_FILE_PATH = None
+        RNAcodeWebCore.STDERR_FILE_PATH = None
+        return
+    if MODE != "submit":
+        eprint("Unknown mode: " + MODE)
+        sys.exit(1)
+
+    # The children must exist before the logs are written. The frontend waits
+    # for the log to appear and will ask for the status of the children.
+    init_work_dir(sys.argv[3])
+
+    RNAcodeWebCore.STDOUT_FILE_PATH = RNAcodeWebCore.STDOUT_FILE_PATH.format(JOB_ID)
+    RNAcodeWebCore.STDERR_FILE_PATH = RNAcodeWebCore.STDERR_FILE_PATH.format(JOB_ID)
+
+    with open(RNAcodeWebCore.STDOUT_FILE_PATH, "w", encoding="UTF-8") as file_handle:
+        file_handle.write(" ".join(sys.argv) + "\n")
+    with open(RNAcodeWebCore.STDERR_FILE_PATH, "w", encoding="UTF-8") as file_handle:
+        file_handle.write("")
+
+
+def read_spec():
+    """Return children of the pack as list of [pipeline, arguments]."""
+    spec_path = SPEC_PATH_TEMPLATE.format(JOB_ID)
+    children = []
+    with open(spec_path, "r", encoding="UTF-8") as file_handle:
+        for line in file_handle:
+            if line.strip() == "":
+                continue
+            pipeline, *arguments = line.strip().split("\t")
+            if pipeline not in PIPELINES:
+                raise RNAcodeWebCore.PipelineError(f"Unknown pipeline {pipeline}")
+            children.append([pipeline, arguments])
+    return children
+
+
+def init_work_dir(spec_path):
+    """Initialize work directory of the pack and of each child.
+
+    The children get a status file with all steps pending. The pipeline of the
+    child overwrites it once it starts.
+    """
+    current_work_dir = RNAcodeWebCore.CURRENT_WORK_DIR_TEMPLATE.format(JOB_ID)
+    job_status_file = RNAcodeWebCore.JOB_STATUS_FILE_TEMPLATE.format(JOB_ID)
+
+    if os.path.isdir(current_work_dir):
+        rmtree(current_work_dir)
+    os.mkdir(current_work_dir)
+    copyfile(spec_path, SPEC_PATH_TEMPLATE.format(JOB_ID))
+
+    JobStatusLog.reset(job_status_file, {"pack": ["NS", 0], "fullJob": ["R", 0]})
+
+    for _pipeline, arguments in read_spec():
+        child_job_id = arguments[0]
+        child_work_dir = RNAcodeWebCore.CURRENT_WORK_DIR_TEMPLATE.format(child_job_id)
+        if os.path.isdir(child_work_dir):
+            rmtree(child_work_dir)
+        os.mkdir(child_work_dir)
+        job_status = {
+            "blastn_1": ["NS", 0],
+            "seqSel_1": ["NS", 0],
+            "alignment": ["NS", 0],
+            "RNAcode": ["NS", 0],
+            "fullJob": ["PD", 0],
+        }
+        JobStatusLog.reset(RNAcodeWebCore.JOB_STATUS_FILE_TEMPLATE.format(child_job_id), job_status)
+        for log_template in CHILD_LOG_TEMPLATES:
+            with open(log_template.format(child_job_id), "w", encoding="UTF-8") as file_handle:
+                file_handle.write("")
+
+
+def pack():
+    """Submit the children as job array and wait for it."""
+    job_type = "pack"
+    pack_wrapper_path = PACK_WRAPPER_PATH_TEMPLATE.format(JOB_ID)
+    error_file = RNAcodeWebCore.SLURM_ERROR_TEMPLATE.format(JOB_ID, job_type)
+
+    num_children = len(read_spec())
+    num_tasks = -(-num_children // CHILDREN_PER_TASK)
+
+    with open(pack_wrapper_path, "w", encoding="UTF-8") as file_handle:
+        file_handle.write(PACK_WRAPPER_TEMPLATE.format(PARENT_JOB_ID))
+
+    vprint(f"{num_children} children in {num_tasks} array tasks")
+    if not RNAcodeWebCore.slurm_batch(
+        pack_wrapper_path, job_type, cores=CORES_PER_TASK, array=num_tasks
+    ):
+        eprint("Pack exited with error!")
+        with open(error_file, "r", encoding="UTF-8") as file_handle:
+            eprint(file_handle.read())
+        raise RNAcodeWebCore.PipelineError
+
+
+def run_child(pipeline, arguments, cores):
+    """Run pipeline of one child with local execution of its steps.
+
+    Output of the child, e.g. a traceback before its logging is set up, goes
+    to its logs.
+    """
+    child_env = os.environ.copy()
+    child_env["RNACODE_WEB_EXECUTION"] = "local"
+    child_env["RNACODE_WEB_LOCAL_CORES"] = str(cores)
+    stdout_path, stderr_path = [
+        os.path.join(REPO_PATH, log_template.format(arguments[0])) for log_template in CHILD_LOG_TEMPLATES
+    ]
+    with open(stdout_path, "a", encoding="UTF-8") as out_handle, open(
+        stderr_path, "a", encoding="UTF-8"
+    ) as err_handle:
+        completed_process = subprocess.run(
+            [sys.executable, f"{REPO_PATH}/RNAcodeWebCore_{pipeline}.py", *arguments],
+            cwd=REPO_PATH,
+            env=child_env,
+            stdout=out_handle,
+            stderr=err_handle,
+            check=False,
+        )
+    vprint(f"Child {arguments[0]} exited with {completed_process.returncode}")
+
+
+def run_children():
+    """Run the slice of children of this array task.
+
+    A child that could not be run is reported on stderr, which fails the pack
+    step, and is marked broken by close_children().
+    """
+    task_id = int(os.environ.get("SLURM_ARRAY_TASK_ID", "0"))
+    children = read_spec()[task_id * CHILDREN_PER_TASK:(task_id + 1) * CHILDREN_PER_TASK]
+    cores = max(1, CORES_PER_TASK // WORKERS_PER_TASK)
+    with ThreadPoolExecutor(max_workers=WORKERS_PER_TASK) as executor:
+        futures = {
+            arguments[0]: executor.submit(run_child, pipeline, arguments, cores)
+            for pipeline, arguments in children
+        }
+        for child_job_id, future in futures.items():
+            try:
+                future.result()
+            except Exception:
+                eprint(f"Could not run child {child_job_id}")
+                eprint(traceback.format_exc())
+
+
+def close_children():
+    """Mark children as broken which did not finish, e.g. pack was killed."""
+    for _pipeline, arguments in read_spec():
+        child_job_id = arguments[0]
+        job_status_file = RNAcodeWebCore.JOB_STATUS_FILE_TEMPLATE.format(child_job_id)
+        try:
+            state = JobStatusLog.read(job_status_file)["fullJob"][0]
+        except (FileNotFoundError, KeyError):
+            state = None
+        if state in FINISHED_STATES:
+            continue
+        eprint(f"Child {child_job_id} did not finish")
+        if state is not None:
+            write_status_file(f"fullJob.{child_job_id}", ["E", "pipe_broken"], job_id=child_job_id)
+        try:
+            notify_frontend(child_job_id)
+        except OSError:
+            # The other children are still closed
+            eprint(f"Could not notify frontend of child {child_job_id}")
+
+
+def main():
+    """Back end service for packed children of RNAcode web."""
+    get_arguments()
+    if MODE == "run":
+        run_children()
+        return
+
+    try:
+        vprint("Submit pack")
+        pack()
+        write_status_file(f"fullJob.{JOB_ID}", ["CD", 0])
+    except Exception:
+        eprint("Pack unexpected error.")
+        eprint(traceback.format_exc())
+        write_status_file(f"fullJob.{JOB_ID}", ["E", "pipe_broken"])
+    finally:
+        vprint("Close children")
+        close_children()
+    vprint("Finished")
+
+
+if __name__ == "__main__":
+    main()
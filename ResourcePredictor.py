@@ -0,0 +1,205 @@
+"""Predict run time and memory of pipeline steps from earlier steps.
+
+After each SLURM job its wall time, peak memory and state are taken from
+sacct and appended, together with the features of the step (step type, query
+length, iteration, word size, db type, number of hits, ...), to a history
+file with one json record per line.
+
+The prediction for a new step uses the finished records with the same step
+type, db type, iteration, blast task, word size and aligner. If there are too
+few of them, the last of these features are dropped in turn, down to step type
+and db type. Run time is assumed to grow linearly with the size of the step
+(its cost if given, else the number of hits it selects from, else the query
+length) and to shrink linearly with its cores. Core seconds per size and
+memory are taken at a high quantile and multiplied by a safety factor, which gives tight
+but safe requests for --time and --mem.
+
+A pipeline keeps the parsed history in memory and only reads the records
+appended since its last prediction. Above HISTORY_MAX_RECORDS records the
+history is cut to the last HISTORY_KEEP records of every step and db type.
+"""
+
+import os
+import json
+import fcntl
+import subprocess
+import collections
+
+# sacct states of finished jobs which are used for predictions
+COMPLETED_STATES = ["COMPLETED"]
+MEMORY_UNITS = {"K": 1 / 1024, "M": 1, "G": 1024, "T": 1024 * 1024}
+# Features of comparable records, most specific last, see comparable()
+MATCH_FEATURES = ["step", "db_type", "iteration", "task", "word_size", "aligner"]
+HISTORY_MAX_RECORDS = 50000
+HISTORY_KEEP = 2000
+LOCK_SUFFIX = ".lock"
+
+# history path -> [inode, bytes read, records]
+_HISTORY = {}
+
+
+def _parse_memory(memory):
+    """Return memory from sacct (e.g. 1234K) in MB or None."""
+    memory = memory.strip()
+    if memory == "":
+        return None
+    if memory[-1] in MEMORY_UNITS:
+        return float(memory[:-1]) * MEMORY_UNITS[memory[-1]]
+    # Plain bytes
+    return float(memory) / 1024 / 1024
+
+
+def query_sacct(slurm_job_id):
+    """Return wall time in seconds, peak memory in MB and state of job.
+
+    A job array or a job with several steps has several lines. The longest
+    time and the largest memory are taken, out of memory wins over other
+    states. Returns None if sacct does not know the job (yet).
+    """
+    call_str = f"sacct -j {slurm_job_id} -n -P --format=ElapsedRaw,MaxRSS,State"
+    try:
+        completed_process = subprocess.run(
+            call_str.split(), capture_output=True, text=True, check=True
+        )
+    except (subprocess.CalledProcessError, FileNotFoundError):
+        return None
+    usage = None
+    for line in completed_process.stdout.split("\n"):
+        if line.strip() == "":
+            continue
+        elapsed, max_rss, state = line.split("|")[:3]
+        # "CANCELLED by 123" -> "CANCELLED"
+        state = state.split(" ")[0]
+        max_rss = _parse_memory(max_rss)
+        if usage is None:
+            usage = {"elapsed": int(elapsed or 0), "max_rss": max_rss, "state": state}
+            continue
+        usage["elapsed"] = max(usage["elapsed"], int(elapsed or 0))
+        if max_rss is not None:
+            usage["max_rss"] = max(usage["max_rss"] or 0, max_rss)
+        if state == "OUT_OF_MEMORY":
+            usage["state"] = state
+    return usage
+
+
+def _history_lock(history_path):
+    lock_handle = open(history_path + LOCK_SUFFIX, "a", encoding="UTF-8")
+    fcntl.flock(lock_handle, fcntl.LOCK_EX)
+    return lock_handle
+
+
+def record(history_path, entry):
+    """Append entry to the history."""
+    with _history_lock(history_path):
+        with open(history_path, "a", encoding="UTF-8") as f_handle:
+            f_handle.write(json.dumps(entry) + "\n")
+
+
+def _parse(lines):
+    entries = []
+    for line in lines:
+        try:
+            entries.append(json.loads(line))
+        except json.decoder.JSONDecodeError:
+            # Half written line of a killed pipeline
+            continue
+    return entries
+
+
+def _compact(history_path):
+    """Keep the last HISTORY_KEEP records of every step and db type."""
+    with _history_lock(history_path):
+        with open(history_path, "r", encoding="UTF-8") as f_handle:
+            entries = _parse(f_handle)
+        counts = collections.Counter()
+        kept = []
+        for entry in reversed(entries):
+            key = (entry.get("step"), entry.get("db_type"))
+            counts[key] += 1
+            if counts[key] <= HISTORY_KEEP:
+                kept.append(entry)
+        tmp_path = f"{history_path}.{os.getpid()}.tmp"
+        with open(tmp_path, "w", encoding="UTF-8") as f_handle:
+            f_handle.write("".join(json.dumps(entry) + "\n" for entry in reversed(kept)))
+        os.replace(tmp_path, history_path)
+
+
+def read_history(history_path):
+    """Return all records of the history.
+
+    Records read before are kept in memory, only the lines appended since are
+    parsed. A history over HISTORY_MAX_RECORDS records is compacted first.
+    """
+    try:
+        stat = os.stat(history_path)
+    except FileNotFoundError:
+        return []
+    inode, offset, entries = _HISTORY.get(history_path, [None, 0, []])
+    if inode != stat.st_ino or stat.st_size < offset:
+        # Compacted by another pipeline
+        offset, entries = 0, []
+    with open(history_path, "rb") as f_handle:
+        f_handle.seek(offset)
+        content = f_handle.read()
+    # Leave a line in writing for the next read
+    complete = content[:content.rfind(b"\n") + 1]
+    entries = entries + _parse(complete.decode("UTF-8").split("\n"))
+    _HISTORY[history_path] = [stat.st_ino, offset + len(complete), entries]
+    if len(entries) > HISTORY_MAX_RECORDS:
+        _compact(history_path)
+        _HISTORY.pop(history_path)
+        return read_history(history_path)
+    return entries
+
+
+def _quantile(values, quantile):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(quantile * len(values)))]
+
+
+def _size(entry):
+    return entry.get("cost") or entry.get("hits") or entry.get("query_len") or 1
+
+
+def _cores(entry):
+    return entry.get("cores") or 1
+
+
+def comparable(history, features, min_records):
+    """Return the finished records most similar to features.
+
+    Records must match the first n MATCH_FEATURES, n as large as possible with
+    at least min_records records, at least step and db type.
+    """
+    finished = [entry for entry in history if entry.get("state") in COMPLETED_STATES]
+    for num_features in range(len(MATCH_FEATURES), 1, -1):
+        keys = MATCH_FEATURES[:num_features]
+        similar = [
+            entry
+            for entry in finished
+            if all(entry.get(key) == features.get(key) for key in keys)
+        ]
+        if len(similar) >= min_records:
+            return similar
+    return similar
+
+
+def predict(history_path, features, quantile, safety_factor, min_records):
+    """Return predicted [time in seconds, memory in MB] for a step.
+
+    Either value is None if there are less than min_records comparable
+    finished steps.
+    """
+    similar = comparable(read_history(history_path), features, min_records)
+    if len(similar) < min_records:
+        return [None, None]
+
+    time_rate = _quantile(
+        [entry["elapsed"] * _cores(entry) / _size(entry) for entry in similar], quantile
+    )
+    max_time = time_rate * _size(features) / _cores(features) * safety_factor
+
+    memory = [entry["max_rss"] for entry in similar if entry.get("max_rss") is not None]
+    if len(memory) < min_records:
+        return [max_time, None]
+    return [max_time, _quantile(memory, quantile) * safety_factor]
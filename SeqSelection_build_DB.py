@@ -1,6 +1,8 @@
 """Select an optimal set of sequence to build blastdb."""
 
 import sys
+import re
+from collections import defaultdict
 
 from Bio import SeqIO
 
@@ -12,7 +14,10 @@ from SeqSelection import collect_sequences
 SeqSelection.VERBOSE = True
 
 TAXIDMAPFILE_PATH = "TaxIDMapFile"
+# Region id and the part of the input (query) each region covers
+REGION_QUERY_RANGES_PATH = "region_query_ranges.tsv"
 # Factor for the input sequence which expanse the target sequence to both sides.
+# Only used if no padding is given.
 EXPANSION_FACTOR = 5
 
 
@@ -21,11 +26,12 @@ ITERATION = None
 SELECTED_SEQUENCES_PATH = None
 SELECTED_SPECIES = None
 FOUND_REGIONS = None
+REGION_PADDING = None
 
 
 def get_arguments():
     """Get arguments from system."""
-    global INPUT_SEQ, ITERATION, SELECTED_SEQUENCES_PATH, SELECTED_SPECIES
+    global INPUT_SEQ, ITERATION, SELECTED_SEQUENCES_PATH, SELECTED_SPECIES, REGION_PADDING
 
     # Iteration is last blast call.
     ITERATION = int(sys.argv[1])
@@ -35,6 +41,11 @@ def get_arguments():
     SeqSelection.NCBI = SeqSelection.load_ncbi()
 
     INPUT_SEQ = list(SeqIO.parse(SeqSelection.INPUT_FILE_PATH, "fasta"))[0].seq
+    # Padding of the hits, the length of a child window
+    if len(sys.argv) > 3:
+        REGION_PADDING = int(sys.argv[3])
+    else:
+        REGION_PADDING = len(INPUT_SEQ) * EXPANSION_FACTOR
     SELECTED_SEQUENCES_PATH = SeqSelection.SELECTED_SEQUENCES_PATH.format(ITERATION)
 
     with open(SeqSelection.SELECTED_SPECIES_FILE_PATH, "r", encoding="UTF-8") as file_handle:
@@ -44,35 +55,111 @@ def get_arguments():
             SELECTED_SPECIES = []
 
 
+def region_id(accession, strand, start, stop):
+    """Return id of a region in the custom db."""
+    return f"{accession}_{strand}_{start}_{stop}"
+
+
+def region_accession(region):
+    """Return accession of a region id."""
+    return region.rsplit("_", 3)[0]
+
+
+def padded_interval(blast_result, query_length, padding):
+    """Return [start, stop, query start, query stop] of the region of a hit.
+
+    The hit is extended on the subject by the part of the query it does not
+    cover, so the region can hold the homolog of the whole query, and by
+    padding on both sides. On the minus strand the start of the query lies
+    behind the hit.
+    """
+    start, stop = sorted([blast_result.sstart, blast_result.send])
+    before = blast_result.qstart - 1
+    after = query_length - blast_result.qend
+    if blast_result.sframe != 1:
+        before, after = after, before
+    return [
+        max(1, start - before - padding),
+        min(blast_result.slen, stop + after + padding),
+        blast_result.qstart,
+        blast_result.qend,
+    ]
+
+
+def merge_intervals(intervals):
+    """Merge overlapping [start, stop, query start, query stop] intervals."""
+    merged = []
+    for interval in sorted(intervals):
+        if merged and interval[0] <= merged[-1][1]:
+            merged[-1][1] = max(merged[-1][1], interval[1])
+            merged[-1][2] = min(merged[-1][2], interval[2])
+            merged[-1][3] = max(merged[-1][3], interval[3])
+        else:
+            merged.append(list(interval))
+    return merged
+
+
+def rename_regions(fasta_path):
+    """Replace the ids of blastdbcmd (accession:start-stop) by region ids."""
+    with open(fasta_path, "r", encoding="UTF-8") as file_handle:
+        lines = file_handle.readlines()
+    with open(fasta_path, "w", encoding="UTF-8") as file_handle:
+        for line in lines:
+            match = re.match(r">(\S+):(c?)([0-9]+)-([0-9]+)(.*)", line)
+            if match:
+                accession, minus, start, stop, description = match.groups()
+                start, stop = sorted([int(start), int(stop)])
+                strand = "minus" if minus else "plus"
+                line = f">{region_id(accession, strand, start, stop)}{description}\n"
+            file_handle.write(line)
+
+
 def select_regions(blast_results):
-    """Make a list of postion for which sequences can be retrieved by blastdbcmd."""
-    position_list = []
-    taxidmapfile = []
+    """Make a list of postion for which sequences can be retrieved by blastdbcmd.
+
+    One accession is taken per species. Every hit on it is padded by the part
+    of the input it does not cover and REGION_PADDING, overlapping hits on the
+    same strand are merged into one region.
+    """
+    found_accessions = set(region_accession(region) for region in FOUND_REGIONS)
+    # accession -> taxid
+    accessions = {}
+    # [accession, strand] -> intervals
+    intervals = defaultdict(list)
     for blast_result in blast_results:
         accession = blast_result.sacc
-        if accession in FOUND_REGIONS:
-            continue
-        species_taxid = SeqSelection.get_species_taxid(blast_result.staxid)
-        if species_taxid in SELECTED_SPECIES:
+        if accession in found_accessions:
             continue
-        # species taxid can be None, do not add None to list
-        if species_taxid:
-            SELECTED_SPECIES.append(species_taxid)
-        taxidmapfile.append(f"{accession} {blast_result.staxid}")
-
-        if blast_result.sframe == 1:
-            full_sstart = blast_result.sstart - len(INPUT_SEQ) * EXPANSION_FACTOR
-            full_send = blast_result.send + len(INPUT_SEQ) * EXPANSION_FACTOR
-            strand = "plus"
-        else:
-            full_sstart = blast_result.send - len(INPUT_SEQ) * EXPANSION_FACTOR
-            full_send = blast_result.sstart + len(INPUT_SEQ) * EXPANSION_FACTOR
-            strand = "minus"
+        if accession not in accessions:
+            if len(found_accessions) + len(accessions) >= DB_SIZE:
+                continue
+            species_taxid = SeqSelection.get_species_taxid(blast_result.staxid)
+            if species_taxid in SELECTED_SPECIES:
+                continue
+            # species taxid can be None, do not add None to list
+            if species_taxid:
+                SELECTED_SPECIES.append(species_taxid)
+            accessions[accession] = blast_result.staxid
+
+        strand = "plus" if blast_result.sframe == 1 else "minus"
+        intervals[(accession, strand)].append(
+            padded_interval(blast_result, len(INPUT_SEQ), REGION_PADDING)
+        )
 
-        position_list.append(f"{accession} {full_sstart}-{full_send} {strand}")
-        FOUND_REGIONS[accession] = ""
-        if len(FOUND_REGIONS) >= DB_SIZE:
-            break
+    position_list = []
+    taxidmapfile = []
+    query_ranges = []
+    for (accession, strand), accession_intervals in intervals.items():
+        for start, stop, query_start, query_stop in merge_intervals(accession_intervals):
+            region = region_id(accession, strand, start, stop)
+            position_list.append(f"{accession} {start}-{stop} {strand}")
+            taxidmapfile.append(f"{region} {accessions[accession]}")
+            # The input the hits cover and a padding, the rest of the region
+            # has no hit and is left out for the segment dbs.
+            query_ranges.append(
+                f"{region}\t{max(1, query_start - REGION_PADDING)}\t{query_stop + REGION_PADDING}"
+            )
+            FOUND_REGIONS[region] = ""
 
     if len(position_list) == 0:
         print("No possible regions found.")
@@ -80,8 +167,11 @@ def select_regions(blast_results):
 
     with open(TAXIDMAPFILE_PATH, "a", encoding="UTF-8") as f_handle:
         f_handle.write("\n".join(taxidmapfile) + "\n")
+    with open(REGION_QUERY_RANGES_PATH, "a", encoding="UTF-8") as f_handle:
+        f_handle.write("\n".join(query_ranges) + "\n")
 
     SeqSelection.call_blastdbcmd(position_list, SELECTED_SEQUENCES_PATH)
+    rename_regions(SELECTED_SEQUENCES_PATH)
 
 
 def main():
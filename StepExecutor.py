@@ -0,0 +1,271 @@
+"""Executors which run the steps of the pipeline.
+
+An executor runs the wrapper script of a step (blast, sequence selection,
+alignment, RNAcode, ...) and reports the state of the step in SLURM notation:
+"PD" pending, "R" running and None if the step is gone, because it finished or
+was never submitted. Steps are identified by their job name. Output and error
+of the script are written to the given files. A step over its time limit gets
+the same message in its error file as SLURM writes.
+
+    SlurmExecutor   every step is a SLURM job
+    LocalExecutor   steps run as sub processes on this machine
+    PilotExecutor   steps are send to the pilot queue, see PilotPool.py
+
+All executors can run a step as array with a given number of tasks. Each task
+gets its index in SLURM_ARRAY_TASK_ID and appends to the output and error file.
+Time limits are given in seconds, memory in MB. Only SLURM enforces memory and
+reports the used resources.
+"""
+
+import os
+import re
+import math
+import time
+import signal
+import threading
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+
+import PilotPool
+import ResourcePredictor
+
+
+def _empty_files(*file_paths):
+    for file_path in file_paths:
+        with open(file_path, "w", encoding="UTF-8") as f_handle:
+            f_handle.write("")
+
+
+class SlurmExecutor:
+    """Submit every step with sbatch."""
+
+    name = "slurm"
+    # Seconds between two looks at squeue
+    poll_interval = 30
+    # Seconds to wait for the shared file system after a job left squeue
+    settle_time = 4
+
+    def __init__(self, partition):
+        """Set up executor for partition."""
+        self.partition = partition
+        # job_name -> SLURM job id
+        self.job_ids = {}
+
+    def submit(self, job_name, script_path, work_dir, output, error, env, cores=1, max_time=36000, array=None, mem=None):
+        """Submit step to SLURM. Return stdout of sbatch."""
+        export = ",".join(f"{k}={v}" for k, v in env.items())
+        call = [
+            "sbatch",
+            f"--job-name={job_name}",
+            f"--output={output}",
+            f"--error={error}",
+            f"--time={math.ceil(max_time / 60)}",
+            f"--partition={self.partition}",
+            f"--chdir={work_dir}",
+            f"--cpus-per-task={cores}",
+            f"--export=ALL,{export}",
+        ]
+        if mem is not None:
+            call.append(f"--mem={math.ceil(mem)}M")
+        if array is not None:
+            call.append(f"--array=0-{array - 1}")
+            call.append("--open-mode=append")
+            # Appending needs empty files
+            _empty_files(output, error)
+        call.append(script_path)
+        completed_process = subprocess.run(call, capture_output=True, text=True, check=True)
+        # "Submitted batch job <id>"
+        self.job_ids[job_name] = completed_process.stdout.split()[-1]
+        # SLURM needs a moment until the job is listed
+        time.sleep(3)
+        return completed_process.stdout
+
+    def state(self, job_name):
+        """Return state of step from squeue."""
+        call_str = f"squeue --name={job_name} -h"
+        completed_process = subprocess.run(
+            call_str.split(), capture_output=True, text=True, check=True
+        )
+        if completed_process.stdout == "":
+            return None
+        return re.split(" +", completed_process.stdout)[5]
+
+    def cancel(self, job_name):
+        """Cancel step."""
+        subprocess.run(["scancel", f"--name={job_name}"], capture_output=True, check=False)
+
+    def usage(self, job_name):
+        """Return used resources of finished step from sacct or None."""
+        if job_name not in self.job_ids:
+            return None
+        return ResourcePredictor.query_sacct(self.job_ids[job_name])
+
+
+class LocalExecutor:
+    """Run steps as sub processes on this machine.
+
+    At most cores cores are used at the same time, a step waits until enough
+    cores are free.
+    """
+
+    name = "local"
+    poll_interval = 2
+    settle_time = 0
+
+    def __init__(self, cores):
+        """Set up executor with cores cores."""
+        self.cores = max(1, cores)
+        self.free_cores = self.cores
+        self.condition = threading.Condition()
+        self.pool = ThreadPoolExecutor(max_workers=self.cores)
+        # job_name -> future
+        self.futures = {}
+        # job_name -> running Popen
+        self.processes = {}
+        self.running = set()
+        self.cancelled = set()
+
+    def submit(self, job_name, script_path, work_dir, output, error, env, cores=1, max_time=36000, array=None, mem=None):
+        """Queue step in the process pool."""
+        cores = min(max(1, cores), self.cores)
+        step_env = os.environ.copy()
+        step_env.update(env)
+        _empty_files(output, error)
+        self.cancelled.discard(job_name)
+        self.futures[job_name] = self.pool.submit(
+            self._run, job_name, script_path, work_dir, output, error, step_env, cores, max_time, array
+        )
+        return f"Submitted local job {job_name}"
+
+    def _run(self, job_name, script_path, work_dir, output, error, env, cores, max_time, array):
+        with self.condition:
+            self.condition.wait_for(lambda: self.free_cores >= cores)
+            self.free_cores -= cores
+        self.running.add(job_name)
+        try:
+            for task_id in range(array or 1):
+                if job_name in self.cancelled:
+                    break
+                if array is not None:
+                    env["SLURM_ARRAY_TASK_ID"] = str(task_id)
+                self._run_task(job_name, script_path, work_dir, output, error, env, max_time)
+        finally:
+            self.running.discard(job_name)
+            with self.condition:
+                self.free_cores += cores
+                self.condition.notify_all()
+
+    def _run_task(self, job_name, script_path, work_dir, output, error, env, max_time):
+        with open(output, "a", encoding="UTF-8") as out_handle, open(
+            error, "a", encoding="UTF-8"
+        ) as err_handle:
+            process = subprocess.Popen(
+                ["bash", script_path],
+                cwd=work_dir,
+                stdout=out_handle,
+                stderr=err_handle,
+                env=env,
+                start_new_session=True,
+            )
+            self.processes[job_name] = process
+            try:
+                process.wait(timeout=max_time)
+            except subprocess.TimeoutExpired:
+                os.killpg(process.pid, signal.SIGKILL)
+                process.wait()
+                err_handle.flush()
+                # Same message as SLURM, so the pipeline handles it the same way
+                err_handle.write(f"*** JOB {job_name} CANCELLED DUE TO TIME LIMIT ***\n")
+            finally:
+                self.processes.pop(job_name, None)
+
+    def state(self, job_name):
+        """Return state of step in the process pool."""
+        future = self.futures.get(job_name)
+        if future is None:
+            return None
+        if future.done():
+            del self.futures[job_name]
+            # Raise errors of the executor itself, e.g. script not found
+            future.result()
+            return None
+        if job_name in self.running:
+            return "R"
+        return "PD"
+
+    def usage(self, job_name):
+        """Used resources are not measured."""
+        return None
+
+    def cancel(self, job_name):
+        """Cancel step, kills it if it is running."""
+        self.cancelled.add(job_name)
+        future = self.futures.get(job_name)
+        if future is not None:
+            future.cancel()
+        process = self.processes.get(job_name)
+        if process is not None:
+            try:
+                os.killpg(process.pid, signal.SIGKILL)
+            except ProcessLookupError:
+                pass
+
+
+class PilotExecutor:
+    """Send steps to the pilot queue.
+
+    start_pilots is called after submitting and every few looks at the queue,
+    because pilots might end while a step waits.
+    """
+
+    name = "pilot"
+    poll_interval = 5
+    settle_time = 0
+    # Number of looks at the queue until pilots are checked again
+    pilot_check_interval = 6
+
+    def __init__(self, queue_dir, start_pilots):
+        """Set up executor for queue in queue_dir."""
+        self.queue_dir = queue_dir
+        self.start_pilots = start_pilots
+        self.num_polls = 0
+        # job_name -> error file of steps not yet seen finished
+        self.errors = {}
+
+    def submit(self, job_name, script_path, work_dir, output, error, env, cores=1, max_time=36000, array=None, mem=None):
+        """Put step in the pilot queue."""
+        if array is not None:
+            raise ValueError("pilots do not run arrays")
+        PilotPool.submit_task(
+            self.queue_dir, job_name, script_path, work_dir, output, error, env, max_time, cores
+        )
+        self.errors[job_name] = error
+        self.start_pilots()
+        return f"Submitted {job_name} to pilot queue"
+
+    def state(self, job_name):
+        """Return state of step in the pilot queue.
+
+        A script that failed without writing to stderr gets its exit code in
+        the error file, so the pipeline does not take it as done.
+        """
+        self.num_polls += 1
+        if self.num_polls % self.pilot_check_interval == 0:
+            self.start_pilots()
+        state = PilotPool.task_state(self.queue_dir, job_name)
+        if state is None and job_name in self.errors:
+            error = self.errors.pop(job_name)
+            exit_code = PilotPool.task_exit_code(self.queue_dir, job_name)
+            if exit_code not in (None, 0) and os.path.getsize(error) == 0:
+                with open(error, "a", encoding="UTF-8") as f_handle:
+                    f_handle.write(f"Pilot task {job_name} exited with code {exit_code}\n")
+        return state
+
+    def usage(self, job_name):
+        """Used resources are not measured."""
+        return None
+
+    def cancel(self, job_name):
+        """Remove step from queue if not yet running."""
+        self.errors.pop(job_name, None)
+        PilotPool.cancel_task(self.queue_dir, job_name)
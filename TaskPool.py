@@ -0,0 +1,126 @@
+"""Bounded pool for the background tasks of the frontend.
+
+Routes used to fork a multiprocessing.Process for every status check and
+submission, so a bulk page forked the whole app once per job and view. Now
+tasks run in MAX_WORKERS threads of the process:
+
+- A task has a kind and a key, e.g. "checkStatus" and the job id. While the
+  same task is queued or running, submitting it again does nothing.
+- A task is not submitted again within min_interval seconds of its last
+  submission.
+- At most MAX_PENDING tasks are queued or running, more raise PoolFull at
+  once. The route can answer with 503 instead of piling up work.
+- A forced task, e.g. on a notification that the job finished, ignores
+  min_interval and MAX_PENDING. If the same task is queued or running, it
+  runs once more afterwards, the running one may have read the state before
+  the change.
+
+Tasks must handle their own errors, an exception only ends the task. Threads
+do not survive a fork, a forked process starts with an empty pool.
+"""
+
+import os
+import time
+import weakref
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+MAX_WORKERS = 4
+MAX_PENDING = 32
+
+# Results of TaskPool.submit()
+STARTED = "started"
+RUNNING = "running"
+RECENT = "recent"
+
+_POOLS = weakref.WeakSet()
+
+
+class PoolFull(Exception):
+    """Too many tasks are queued or running."""
+
+
+class TaskPool:
+    """Threads that run tasks, see module doc."""
+
+    def __init__(self, max_workers=MAX_WORKERS, max_pending=MAX_PENDING):
+        self.max_workers = max_workers
+        self.max_pending = max_pending
+        self._reset()
+        _POOLS.add(self)
+
+    def _reset(self):
+        self._lock = threading.Lock()
+        # Started lazily, a pool made before a fork has no threads to lose
+        self._executor = None
+        # (kind, key) -> future
+        self._in_flight = {}
+        # (kind, key) -> monotonic time before which it is not submitted again
+        self._not_before = {}
+        # (kind, key) -> [function, args, kwargs] to run after the running task
+        self._rerun = {}
+
+    def submit(self, kind, key, function, *args, min_interval=0, force=False, **kwargs):
+        """Run function(*args, **kwargs) as task kind of key.
+
+        Returns STARTED if the task was queued, RUNNING if the same task is
+        queued or running and RECENT if it was submitted less than
+        min_interval seconds ago. A forced task is never RECENT, if it is
+        RUNNING this call runs after it. Raises PoolFull if max_pending tasks
+        are queued or running, never for a forced task.
+        """
+        task = (kind, key)
+        now = time.monotonic()
+        with self._lock:
+            if task in self._in_flight:
+                if force:
+                    self._rerun[task] = [function, args, kwargs]
+                return RUNNING
+            if now < self._not_before.get(task, now) and not force:
+                return RECENT
+            if len(self._in_flight) >= self.max_pending and not force:
+                raise PoolFull(f"{len(self._in_flight)} tasks queued or running")
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(
+                    self.max_workers, thread_name_prefix="TaskPool"
+                )
+            self._not_before = {
+                other: not_before
+                for other, not_before in self._not_before.items()
+                if not_before > now
+            }
+            if min_interval > 0:
+                self._not_before[task] = now + min_interval
+            # _run() waits for the lock, so the future is stored before it ends
+            self._in_flight[task] = self._executor.submit(self._run, task, function, args, kwargs)
+        return STARTED
+
+    def _run(self, task, function, args, kwargs):
+        while True:
+            error = None
+            try:
+                function(*args, **kwargs)
+            except Exception as exc:
+                error = exc
+            with self._lock:
+                rerun = self._rerun.pop(task, None)
+                if rerun is None:
+                    self._in_flight.pop(task, None)
+            if rerun is None:
+                if error is not None:
+                    raise error
+                return
+            function, args, kwargs = rerun
+
+    def in_flight(self):
+        """Return the number of queued and running tasks."""
+        with self._lock:
+            return len(self._in_flight)
+
+
+def _after_fork():
+    for pool in list(_POOLS):
+        pool._reset()
+
+
+os.register_at_fork(after_in_child=_after_fork)
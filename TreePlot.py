@@ -0,0 +1,196 @@
+"""Plot newick trees as SVG.
+
+The guide tree of the alignment used to be rendered with ete3, which needs Qt
+and so an X server (xvfb-run) for every pipeline. This draws the same
+rectangular tree, branch lengths to scale and leaf names to the right, as plain
+SVG without any dependency.
+
+    python3 TreePlot.py <tree.newick> <plot.svg>
+"""
+
+import sys
+from xml.sax.saxutils import escape
+
+ROW_HEIGHT = 18
+TREE_WIDTH = 400
+MARGIN = 10
+FONT_SIZE = 12
+# Approximate width of a character of the font
+CHAR_WIDTH = 7.5
+
+
+def _tokens(text):
+    """Yield the tokens of a newick string: ( ) , : ; and labels."""
+    i = 0
+    while i < len(text):
+        char = text[i]
+        if char.isspace():
+            i += 1
+        elif char == "[":
+            # comment
+            i = text.index("]", i) + 1
+        elif char in "(),:;":
+            yield char
+            i += 1
+        elif char == "'":
+            end = i + 1
+            label = ""
+            while True:
+                quote = text.index("'", end)
+                label += text[end:quote]
+                # '' is a quote in a quoted label
+                if text[quote + 1:quote + 2] == "'":
+                    label += "'"
+                    end = quote + 2
+                    continue
+                break
+            yield label
+            i = quote + 1
+        else:
+            end = i
+            while end < len(text) and text[end] not in "(),:;[" and not text[end].isspace():
+                end += 1
+            yield text[i:end]
+            i = end
+
+
+def parse_newick(text):
+    """Return the root of a newick tree.
+
+    Nodes are dicts with name, length (0 if missing) and children.
+    """
+    root = {"name": "", "length": 0.0, "children": []}
+    stack = []
+    node = root
+    after_colon = False
+    for token in _tokens(text):
+        if token == "(":
+            child = {"name": "", "length": 0.0, "children": []}
+            node["children"].append(child)
+            stack.append(node)
+            node = child
+        elif token == ",":
+            child = {"name": "", "length": 0.0, "children": []}
+            stack[-1]["children"].append(child)
+            node = child
+        elif token == ")":
+            node = stack.pop()
+        elif token == ":":
+            after_colon = True
+            continue
+        elif token == ";":
+            break
+        elif after_colon:
+            node["length"] = float(token)
+        else:
+            node["name"] = token
+        after_colon = False
+    return root
+
+
+def _preorder(tree):
+    """Return the nodes of a tree, parents first and children top to bottom.
+
+    Guide trees can be deeper than the recursion limit, so no recursion.
+    """
+    nodes = []
+    stack = [tree]
+    while stack:
+        node = stack.pop()
+        nodes.append(node)
+        stack += reversed(node["children"])
+    return nodes
+
+
+def leaves(tree):
+    """Return the leaves of a tree from top to bottom."""
+    return [node for node in _preorder(tree) if not node["children"]]
+
+
+def _layout(tree):
+    """Return [leaves, id of node -> [branch length from the root, row]].
+
+    The branch of the root is not drawn.
+    """
+    nodes = _preorder(tree)
+    depths = {id(tree): 0.0}
+    for node in nodes:
+        for child in node["children"]:
+            depths[id(child)] = depths[id(node)] + child["length"]
+    rows = [node for node in nodes if not node["children"]]
+    positions = {id(leaf): [depths[id(leaf)], row] for row, leaf in enumerate(rows)}
+    for node in reversed(nodes):
+        if node["children"]:
+            child_rows = [positions[id(child)][1] for child in node["children"]]
+            positions[id(node)] = [depths[id(node)], (child_rows[0] + child_rows[-1]) / 2]
+    return [rows, positions]
+
+
+def render_svg(tree):
+    """Return the SVG of a tree."""
+    rows, positions = _layout(tree)
+    max_depth = max(positions[id(leaf)][0] for leaf in rows)
+    scale = TREE_WIDTH / max_depth if max_depth > 0 else 0
+    label_width = max((len(leaf["name"]) for leaf in rows), default=0) * CHAR_WIDTH
+    width = 2 * MARGIN + TREE_WIDTH + 5 + label_width
+    height = 2 * MARGIN + len(rows) * ROW_HEIGHT
+
+    def point(node):
+        depth, row = positions[id(node)]
+        return [MARGIN + depth * scale, MARGIN + (row + 0.5) * ROW_HEIGHT]
+
+    lines = []
+    labels = []
+    stack = [tree]
+    while stack:
+        node = stack.pop()
+        x_node, y_node = point(node)
+        if node["children"]:
+            y_first = point(node["children"][0])[1]
+            y_last = point(node["children"][-1])[1]
+            lines.append([x_node, y_first, x_node, y_last])
+        for child in node["children"]:
+            x_child, y_child = point(child)
+            lines.append([x_node, y_child, x_child, y_child])
+            stack.append(child)
+        if not node["children"]:
+            labels.append([x_node + 5, y_node + FONT_SIZE / 3, node["name"]])
+
+    svg = [
+        '<?xml version="1.0" encoding="UTF-8"?>',
+        f'<svg xmlns="http://www.w3.org/2000/svg" width="{width:.0f}" height="{height:.0f}" '
+        f'viewBox="0 0 {width:.0f} {height:.0f}">',
+        '<g stroke="black" stroke-width="1">',
+    ]
+    for x_1, y_1, x_2, y_2 in lines:
+        svg.append(f'<line x1="{x_1:.1f}" y1="{y_1:.1f}" x2="{x_2:.1f}" y2="{y_2:.1f}"/>')
+    svg.append("</g>")
+    svg.append(f'<g font-family="sans-serif" font-size="{FONT_SIZE}">')
+    for x_label, y_label, name in labels:
+        svg.append(f'<text x="{x_label:.1f}" y="{y_label:.1f}">{escape(name)}</text>')
+    svg.append("</g>")
+    svg.append("</svg>")
+    return "\n".join(svg) + "\n"
+
+
+def plot_tree(tree_path, plot_path, rename=None):
+    """Plot the newick tree in tree_path as SVG to plot_path.
+
+    rename maps the name of a leaf to its label.
+    """
+    with open(tree_path, "r", encoding="UTF-8") as f_handle:
+        tree = parse_newick(f_handle.read())
+    if rename is not None:
+        for leaf in leaves(tree):
+            leaf["name"] = rename(leaf["name"])
+    with open(plot_path, "w", encoding="UTF-8") as f_handle:
+        f_handle.write(render_svg(tree))
+
+
+def main():
+    """Command line interface."""
+    plot_tree(sys.argv[1], sys.argv[2])
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,193 @@
+"""Buffered logging of the backend pipelines and the frontend.
+
+vprint and eprint used to open, append to and close their log file for every
+message. Now a message is a log record, put into a queue by the caller and
+written by a background thread (QueueHandler, QueueListener). Records carry the
+job id, the step and the duration of the step if known:
+
+    2024-05-02 10:11:12,123 INFO job=<job_id> step=blastn_1 duration=12.3 <message>
+
+Log files rotate at MAX_BYTES with BACKUP_COUNT old files. Levels can be
+sampled, only every n-th record of the level is written, e.g. the lock
+messages of the frontend. The last RING_SIZE records of all levels stay in
+memory for error reports, see recent().
+
+A forked process gets its own queue, listener and files, the thread of the
+listener does not survive fork. Records queued in the parent before the fork
+are written by the parent.
+"""
+
+import os
+import sys
+import queue
+import atexit
+import logging
+import threading
+import collections
+import logging.handlers
+import multiprocessing.util
+
+MAX_BYTES = 50 * 1024**2
+BACKUP_COUNT = 3
+RING_SIZE = 200
+FORMAT = "%(asctime)s %(levelname)s job=%(job_id)s step=%(step)s%(duration_str)s %(message)s"
+
+# name -> [arguments of setup(), listener]
+_LOGGERS = {}
+_RINGS = {}
+_LOCK = threading.Lock()
+
+
+class RecordFields(logging.Filter):
+    """Give every record job_id, step and duration."""
+
+    def __init__(self, job_id):
+        super().__init__()
+        self.job_id = job_id
+
+    def filter(self, record):
+        if not hasattr(record, "job_id"):
+            record.job_id = self.job_id
+        if not hasattr(record, "step"):
+            record.step = "-"
+        duration = getattr(record, "duration", None)
+        record.duration_str = "" if duration is None else f" duration={duration:.1f}"
+        return True
+
+
+class Sampler(logging.Filter):
+    """Pass every n-th record of a level, rates maps level to n."""
+
+    def __init__(self, rates):
+        super().__init__()
+        self.rates = rates
+        self.counts = collections.Counter()
+
+    def filter(self, record):
+        rate = self.rates.get(record.levelno, 1)
+        self.counts[record.levelno] += 1
+        return (self.counts[record.levelno] - 1) % rate == 0
+
+
+class RingHandler(logging.Handler):
+    """Keep the last formatted records in memory."""
+
+    def __init__(self, size):
+        super().__init__()
+        self.records = collections.deque(maxlen=size)
+
+    def emit(self, record):
+        self.records.append(self.format(record))
+
+
+class BelowError(logging.Filter):
+    """Keep errors out of the normal log if they have their own."""
+
+    def filter(self, record):
+        return record.levelno < logging.ERROR
+
+
+def _file_handler(path, level):
+    if path is None:
+        handler = logging.StreamHandler(sys.stderr if level >= logging.ERROR else sys.stdout)
+    else:
+        handler = logging.handlers.RotatingFileHandler(
+            path, maxBytes=MAX_BYTES, backupCount=BACKUP_COUNT, encoding="UTF-8"
+        )
+    handler.setLevel(level)
+    handler.setFormatter(logging.Formatter(FORMAT))
+    return handler
+
+
+def setup(name, out_path, err_path=None, job_id="-", level=logging.INFO, rates=None):
+    """Configure logger name, returns it.
+
+    Records of level go to out_path, errors to err_path if given. A path of None
+    is stdout or stderr. A path may contain {pid}, which is filled in again
+    after a fork. Setting up a logger again replaces its files. rates maps a
+    level to n, only every n-th record of it is written.
+    """
+    with _LOCK:
+        if name in _LOGGERS:
+            _stop(_LOGGERS.pop(name)[1])
+        logger = logging.getLogger(name)
+        logger.propagate = False
+        logger.setLevel(level)
+        for handler in list(logger.handlers):
+            logger.removeHandler(handler)
+        for log_filter in list(logger.filters):
+            logger.removeFilter(log_filter)
+        logger.addFilter(RecordFields(job_id))
+
+        pid = str(os.getpid())
+        handlers = [_file_handler(out_path and out_path.replace("{pid}", pid), level)]
+        if err_path is not None or out_path is None:
+            handlers[0].addFilter(BelowError())
+            handlers.append(_file_handler(err_path and err_path.replace("{pid}", pid), logging.ERROR))
+        if rates:
+            for handler in handlers:
+                handler.addFilter(Sampler(rates))
+        log_queue = queue.SimpleQueue()
+        listener = logging.handlers.QueueListener(log_queue, *handlers, respect_handler_level=True)
+        listener.start()
+        logger.addHandler(logging.handlers.QueueHandler(log_queue))
+
+        ring = RingHandler(RING_SIZE)
+        ring.setFormatter(logging.Formatter(FORMAT))
+        logger.addHandler(ring)
+        _RINGS[name] = ring
+        _LOGGERS[name] = [[out_path, err_path, job_id, level, rates], listener]
+    return logger
+
+
+def flush(name=None):
+    """Write the queued records of a logger, of all loggers without name."""
+    with _LOCK:
+        listeners = [_LOGGERS[name][1]] if name else [entry[1] for entry in _LOGGERS.values()]
+    for listener in listeners:
+        # stop() writes all queued records, the listener starts again
+        listener.stop()
+        listener.start()
+
+
+def recent(name):
+    """Return the last records of logger name."""
+    if name not in _RINGS:
+        return []
+    return list(_RINGS[name].records)
+
+
+def _stop(listener):
+    listener.stop()
+    for handler in listener.handlers:
+        handler.close()
+
+
+def _stop_all():
+    with _LOCK:
+        while _LOGGERS:
+            _stop(_LOGGERS.popitem()[1][1])
+
+
+def _after_fork():
+    global _LOCK
+    _LOCK = threading.Lock()
+    loggers = dict(_LOGGERS)
+    _LOGGERS.clear()
+    for name, [arguments, _listener] in loggers.items():
+        setup(name, *arguments)
+
+
+class _ForkHook:
+    """Owner of the after fork hook of multiprocessing."""
+
+
+def _register_finalizer(_owner):
+    # Children of multiprocessing end with os._exit and skip atexit
+    multiprocessing.util.Finalize(None, _stop_all, exitpriority=100)
+
+
+_FORK_HOOK = _ForkHook()
+atexit.register(_stop_all)
+os.register_at_fork(after_in_child=_after_fork)
+multiprocessing.util.register_after_fork(_FORK_HOOK, _register_finalizer)
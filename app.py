@@ -8,7 +8,6 @@ import random
 import string
 from datetime import datetime
 from ipaddress import ip_network, ip_address
-import multiprocessing
 import traceback
 import functools
 
@@ -19,6 +18,7 @@ import smtplib
 # Flask
 from flask import Flask, render_template, request, redirect, url_for, Response
 from flask import send_file, send_from_directory, abort
+from flask import copy_current_request_context
 from werkzeug.exceptions import NotFound
 
 # Limiting access of users
@@ -30,7 +30,7 @@ from apscheduler.schedulers.background import BackgroundScheduler
 from apscheduler.triggers.interval import IntervalTrigger
 
 from JobSubmission import vprint
-from JobSubmission import LOG_DIR
+from JobSubmission import LOGGER_NAME
 from JobSubmission import RESULT_DIR
 from JobSubmission import JobSubmission
 from JobSubmission import JobNotFoundException
@@ -43,6 +43,9 @@ from JobSubmission import generate_bulk_submission_example
 
 from RNAcodeWebCore import P_THRESHOLD
 
+import WebLog
+import TaskPool
+
 
 # Parameters
 with open("./parameters_frontend_local.json", "r", encoding="UTF-8") as file_handle:
@@ -71,7 +74,7 @@ def handle_internal_exception(route_function):
     Send an email to the admin or print the log to console if in debug mode.
     If an internal error is handled handle_exception() must be called from the
     same process that caused the error. Or else not the correct log will be
-    found.
+    found, the recent log messages are kept in memory per process.
     """
     @functools.wraps(route_function)
     def wrapper(*args, **kwargs):
@@ -80,9 +83,7 @@ def handle_internal_exception(route_function):
         except Exception:
             vprint("Handle exception", verbose_level=2)
             error = traceback.format_exc()
-            with open(f"{LOG_DIR}/{os.getpid()}.log", "r", encoding="UTF-8") as f_handle:
-                logs = f_handle.read()
-                logs = "\n".join(logs.split("\n")[-200:])
+            logs = "\n".join(WebLog.recent(LOGGER_NAME))
 
             content = (
                 f"Unexpected error in {route_function.__name__}:\n"
@@ -188,6 +189,11 @@ def service_unavailable_handler(error):
 
 # Delay in seconds when a result page should be reloaded.
 RELOAD_DELAY = 240
+# Seconds before the status of a job is checked again, views in between show
+# the last status.
+STATUS_CHECK_INTERVAL = 60
+# Status checks, submissions and clean ups run in this pool, not in forks.
+TASK_POOL = TaskPool.TaskPool()
 UNI_NETS = [ip_network(server_parameters_frontend["uni_net_space"])]
 # LIMITER = Limiter(get_remote_address, app=app, default_limits=["200 per day", "50 per hour"])
 LIMITER = Limiter(
@@ -316,11 +322,27 @@ def check_under_maintenance():
         abort(503)
 
 
+def start_task(kind, key, function, *args, min_interval=0, force=False, **kwargs):
+    """Run function in TASK_POOL with the context of the current request.
+
+    Returns the result of TaskPool.submit(), raises TaskPool.PoolFull.
+    """
+    return TASK_POOL.submit(
+        kind,
+        key,
+        copy_current_request_context(function),
+        *args,
+        min_interval=min_interval,
+        force=force,
+        **kwargs,
+    )
+
+
 @handle_internal_exception
 def submit_job(job_id, notification=True):
     """Start job submission in background.
 
-    Should be started in a new thread. If the job is building a custom DB
+    Should be started with start_task(). If the job is building a custom DB
     submit_job() becomes the check_status() function for the build until the
     child jobs are submitted.
     """
@@ -343,7 +365,7 @@ def submit_job(job_id, notification=True):
 def check_status(job_id):
     """Check status of job and if job finished send notifications.
 
-    Should be started in a new thread.
+    Should be started with start_task().
     """
     vprint(f"Check status for job {job_id} and send notifications.", verbose_level=1)
     parent_job_id = None
@@ -375,10 +397,14 @@ def show_bulk(job_id_list):
 
     for job_id in job_id_list:
         job_submission = JobSubmission(job_id=job_id)
-        thread = multiprocessing.Process(
-            target=check_status, args=(job_submission.job_id,)
-        )
-        thread.start()
+        try:
+            start_task(
+                "checkStatus", job_id, check_status, job_id,
+                min_interval=STATUS_CHECK_INTERVAL
+            )
+        except TaskPool.PoolFull:
+            # The page is reloaded and shows the last status until then
+            vprint(f"Task pool full, status of {job_id} not checked.", verbose_level=1)
         status = job_submission.status_dic["jobStatus"][0]
 
         job_info_list.append([job_id, status])
@@ -388,17 +414,21 @@ def show_bulk(job_id_list):
 
 
 def submit_bulk_jobs(job_id_list):
-    """Submit bulk jobs and send bulk notification."""
+    """Submit bulk jobs and send bulk notification.
+
+    Returns False if the task pool is full and nothing was submitted.
+    """
+    job_id_key = job_id_list
     job_id_list = job_id_list.split(";")
     email_list = []
     for job_id in job_id_list:
         try:
             job_submission = JobSubmission(job_id=job_id)
         except JobNotFoundException:
-            return
+            return True
         email_list.append(job_submission.email)
         if job_submission.submitted:
-            return
+            return True
 
     # Checks if all emails are the same. If so only send one notification
     # instead of multiples.
@@ -409,17 +439,19 @@ def submit_bulk_jobs(job_id_list):
         notification = True
         send_bulk_notification = False
 
-    for job_id in job_id_list:
-        job_submission = JobSubmission(job_id=job_id)
-        k_arg_dic = {}
-        k_arg_dic["notification"] = notification
-        thread = multiprocessing.Process(
-            target=submit_job, args=(job_submission.job_id,), kwargs=k_arg_dic
-        )
-        thread.start()
+    def submit_jobs():
+        # One task for all jobs, a bulk submission takes one worker of the pool
+        for job_id in job_id_list:
+            submit_job(job_id, notification=notification)
+
+    try:
+        start_task("submitBulk", job_id_key, submit_jobs)
+    except TaskPool.PoolFull:
+        return False
 
     if send_bulk_notification:
         bulk_notification(email_list[0], job_id_list)
+    return True
 
 
 def set_context_child_status(status_dic):
@@ -715,7 +747,8 @@ def submit_bulk(job_id_list):
     vprint(
         f"Visiting /submit_bulk/{job_id_list} routing to submit_bulk()", verbose_level=1
     )
-    submit_bulk_jobs(job_id_list)
+    if not submit_bulk_jobs(job_id_list):
+        return render_template("html/errors/server_busy.html"), 503
     return redirect(url_for("list_bulk", job_id_list=job_id_list))
 
 
@@ -910,16 +943,28 @@ def submission_by_url(job_id):
     if not job_submission.input_check_dic["no_error"]:
         return redirect(url_for("single_submission_edit", job_id=job_id))
 
+    # Notifications of the backend (notify_frontend()) are never dropped or
+    # refused, e.g. the end of the build of a custom db parent, which stays
+    # unsubmitted until its children are submitted. A job has at most one task
+    # running and one waiting, forcing does not pile up work.
+    notified = request.args.get("notify") == "1"
     if not job_submission.submitted:
-        thread = multiprocessing.Process(
-            target=submit_job, args=(job_submission.job_id,)
-        )
-        thread.start()
+        try:
+            start_task(
+                "submit", job_id, submit_job, job_id,
+                min_interval=STATUS_CHECK_INTERVAL, force=notified
+            )
+        except TaskPool.PoolFull:
+            return render_template("html/errors/server_busy.html"), 503
     else:
-        thread = multiprocessing.Process(
-            target=check_status, args=(job_submission.job_id,)
-        )
-        thread.start()
+        try:
+            start_task(
+                "checkStatus", job_id, check_status, job_id,
+                min_interval=STATUS_CHECK_INTERVAL, force=notified
+            )
+        except TaskPool.PoolFull:
+            # The page is reloaded and shows the last status until then
+            vprint(f"Task pool full, status of {job_id} not checked.", verbose_level=1)
 
     return build_result_webpage(job_submission, request.form)
 
@@ -973,10 +1018,10 @@ def test_error_admin():
 @handle_internal_exception
 def start_clean_up_manually():
     """Trigger clean up not by appscheduler."""
-    thread = multiprocessing.Process(
-        target=clean_up
-    )
-    thread.start()
+    try:
+        start_task("cleanUp", None, clean_up)
+    except TaskPool.PoolFull:
+        return render_template("html/errors/server_busy.html"), 503
     return "Putzen!"
 
 
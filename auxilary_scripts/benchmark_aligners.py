@@ -0,0 +1,84 @@
+#!/usr/bin/python3
+"""Time the aligners of the alignment step.
+
+Aligns random subsets of the sequences of an alignment.fasta of a job with
+every aligner and thread count and prints the wall time as table. The fastest
+setting per size backs the choice of MAFFT_MIN_SEQS, MAFFT_MIN_LEN and
+ALIGN_SEQS_PER_THREAD in RNAcodeWebCore.py.
+
+    python3 benchmark_aligners.py <alignment.fasta> <sizes> <threads> [repeats]
+
+sizes and threads are comma separated, e.g. 50,200,800 1,4,8.
+"""
+
+import os
+import sys
+import time
+import random
+import tempfile
+import subprocess
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from RNAcodeWebCore import ALIGN_WRAPPER_TEMPLATES  # noqa: E402
+
+
+def read_fasta(fasta_path):
+    """Return [name, sequence] of the records of a fasta file."""
+    records = []
+    with open(fasta_path, "r", encoding="UTF-8") as f_handle:
+        for line in f_handle:
+            if line[0] == ">":
+                records.append([line[1:].strip(), ""])
+            elif records:
+                records[-1][1] += line.strip()
+    return records
+
+
+def time_aligner(aligner, records, threads):
+    """Return seconds aligner takes for records, None if it failed."""
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        with open(os.path.join(tmp_dir, "alignment.fasta"), "w", encoding="UTF-8") as f_handle:
+            for name, sequence in records:
+                f_handle.write(f">{name}\n{sequence}\n")
+        with open(os.path.join(tmp_dir, "alignment.sh"), "w", encoding="UTF-8") as f_handle:
+            f_handle.write(
+                ALIGN_WRAPPER_TEMPLATES[aligner].format(
+                    "alignment.fasta", "alignment.aln", "alignment.tree", threads
+                )
+            )
+        start = time.time()
+        completed_process = subprocess.run(
+            ["bash", "alignment.sh"], cwd=tmp_dir, capture_output=True, text=True, check=False
+        )
+        if completed_process.returncode != 0:
+            print(completed_process.stderr, file=sys.stderr)
+            return None
+        return time.time() - start
+
+
+def main():
+    """Print wall time per aligner, threads and number of sequences."""
+    records = read_fasta(sys.argv[1])
+    sizes = [int(size) for size in sys.argv[2].split(",")]
+    thread_counts = [int(threads) for threads in sys.argv[3].split(",")]
+    repeats = int(sys.argv[4]) if len(sys.argv) > 4 else 3
+    # The query stays in every subset like in the pipeline
+    target = [record for record in records if record[0] == "Target"]
+    others = [record for record in records if record[0] != "Target"]
+    random.seed(0)
+
+    print("seqs\tmax_len\taligner\tthreads\tseconds")
+    for size in sizes:
+        subset = target + random.sample(others, min(len(others), size - len(target)))
+        max_len = max(len(sequence) for _name, sequence in subset)
+        for aligner in ALIGN_WRAPPER_TEMPLATES:
+            for threads in thread_counts:
+                times = [time_aligner(aligner, subset, threads) for _i in range(repeats)]
+                if None in times:
+                    print(f"{len(subset)}\t{max_len}\t{aligner}\t{threads}\tfailed")
+                    continue
+                print(f"{len(subset)}\t{max_len}\t{aligner}\t{threads}\t{min(times):.2f}")
+
+
+if __name__ == "__main__":
+    main()
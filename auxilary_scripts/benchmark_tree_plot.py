@@ -0,0 +1,73 @@
+#!/usr/bin/python3
+"""Compare the guide tree plot of TreePlot.py with the ete3 plot under Xvfb.
+
+Runs both plots of a newick tree in fresh processes, like a pipeline does, and
+prints wall time and peak memory (max RSS of the process and its children,
+e.g. the X server) per run.
+
+    python3 benchmark_tree_plot.py <alignment.tree> [repeats]
+"""
+
+import os
+import sys
+import time
+import tempfile
+import subprocess
+
+REPO_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+
+ETE3_PLOT = (
+    "import sys\n"
+    "from ete3 import Tree\n"
+    "tree = Tree(open(sys.argv[1]).read())\n"
+    "for node in tree:\n"
+    "    node.name = node.name.split('-')[0]\n"
+    "tree.render(sys.argv[2])\n"
+)
+
+TREE_PLOT = (
+    "import sys\n"
+    f"sys.path.append({REPO_PATH!r})\n"
+    "import TreePlot\n"
+    "TreePlot.plot_tree(sys.argv[1], sys.argv[2], rename=lambda name: name.split('-')[0])\n"
+)
+
+
+def measure(command):
+    """Return [seconds, max RSS in MB] of command, None if it failed."""
+    start = time.time()
+    try:
+        process = subprocess.Popen(command, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+    except FileNotFoundError as exc:
+        print(exc, file=sys.stderr)
+        return None
+    _pid, status, rusage = os.wait4(process.pid, 0)
+    seconds = time.time() - start
+    if os.waitstatus_to_exitcode(status) != 0:
+        print(process.stderr.read().decode(), file=sys.stderr)
+        return None
+    return [seconds, rusage.ru_maxrss / 1024]
+
+
+def main():
+    """Print time and memory of both plots."""
+    tree_path = sys.argv[1]
+    repeats = int(sys.argv[2]) if len(sys.argv) > 2 else 5
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        plot_path = os.path.join(tmp_dir, "alignment.svg")
+        commands = {
+            "ete3+xvfb": ["xvfb-run", "-a", sys.executable, "-c", ETE3_PLOT, tree_path, plot_path],
+            "TreePlot": [sys.executable, "-c", TREE_PLOT, tree_path, plot_path],
+        }
+        print("renderer\trun\tseconds\tmax_rss_mb")
+        for name, command in commands.items():
+            for i in range(repeats):
+                result = measure(command)
+                if result is None:
+                    print(f"{name}\t{i}\tfailed\tfailed")
+                    continue
+                print(f"{name}\t{i}\t{result[0]:.2f}\t{result[1]:.1f}")
+
+
+if __name__ == "__main__":
+    main()
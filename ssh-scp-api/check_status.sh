@@ -3,6 +3,8 @@
 set -e
 
 job_status_file="$1"
+# Optional, last seq of the status log the frontend has seen
+status_seq="${2:-}"
 
 user="$(python3 -c "import sys, json;\
 	print(json.load(sys.stdin)['user'])" \
@@ -10,6 +12,14 @@ user="$(python3 -c "import sys, json;\
 machine_name="$(python3 -c "import sys, json;\
 	print(json.load(sys.stdin)['machine_name'])" \
 	< "./parameters_backend_local.json")"
+RNAcode_web_repo_backend="$(python3 -c "import sys, json;\
+	print(json.load(sys.stdin)['RNAcode_web_repo_backend'])" \
+	< "./parameters_backend_local.json")"
 
-# shellcheck disable=SC2029
-ssh "$user"@"$machine_name" cat "$job_status_file"
+if [[ -z "$status_seq" ]]; then
+	# shellcheck disable=SC2029
+	ssh "$user"@"$machine_name" cat "$job_status_file"
+else
+	# shellcheck disable=SC2029
+	ssh "$user"@"$machine_name" python3 "$RNAcode_web_repo_backend/JobStatusLog.py" since "$job_status_file" "$status_seq"
+fi
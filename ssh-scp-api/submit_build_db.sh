@@ -25,7 +25,7 @@ db_type=$3
 # shellcheck disable=SC2029
 ssh "$user"@"$machine_name" "source $python_env_path/bin/activate &&\
     cd $RNAcode_web_repo_backend &&\
-    nohup xvfb-run -d python3 $RNAcode_web_repo_backend/RNAcodeWebCore_build_DB.py \
+    nohup python3 $RNAcode_web_repo_backend/RNAcodeWebCore_build_DB.py \
     $job_id $input_seq_nuc $db_type\
     &> /dev/null </dev/null " &
 ssh_pid=$!
@@ -41,7 +41,7 @@ for i in $(seq 1 6); do
         >&2 echo "ssh $user@$machine_name"
         >&2 echo "source $python_env_path/bin/activate"
         >&2 echo "cd $RNAcode_web_repo_backend"
-        >&2 echo "nohup xvfb-run -d python3 $RNAcode_web_repo_backend/RNAcodeWebCore_build_DB.py $job_id $input_seq_nuc $db_type"
+        >&2 echo "nohup python3 $RNAcode_web_repo_backend/RNAcodeWebCore_build_DB.py $job_id $input_seq_nuc $db_type"
         exit 1
     fi
 done
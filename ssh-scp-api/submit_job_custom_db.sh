@@ -28,7 +28,7 @@ input_seq_nuc=$5
 # shellcheck disable=SC2029
 ssh "$user"@"$machine_name" "source $python_env_path/bin/activate &&\
     cd $RNAcode_web_repo_backend &&\
-    nohup xvfb-run -d python3 $RNAcode_web_repo_backend/RNAcodeWebCore_custom_DB.py  \
+    nohup python3 $RNAcode_web_repo_backend/RNAcodeWebCore_custom_DB.py  \
     $job_id $min_pair_dist $max_pair_dist $genome_start $input_seq_nuc \
     &> /dev/null </dev/null " &
 ssh_pid=$!
@@ -46,7 +46,7 @@ for i in $(seq 1 6); do
         >&2 echo "ssh $user@$machine_name"
         >&2 echo "source $python_env_path/bin/activate"
         >&2 echo "cd $RNAcode_web_repo_backend"
-        >&2 echo "nohup xvfb-run -d python3 $RNAcode_web_repo_backend/RNAcodeWebCore_custom_DB.py $job_id $min_pair_dist $max_pair_dist $genome_start $input_seq_nuc"
+        >&2 echo "nohup python3 $RNAcode_web_repo_backend/RNAcodeWebCore_custom_DB.py $job_id $min_pair_dist $max_pair_dist $genome_start $input_seq_nuc"
         exit 1
     fi
 done
@@ -24,12 +24,14 @@ max_pair_dist=$3
 genome_start=$4
 db_type=$5
 input_seq_nuc=$6
+# Optional, sequence of the parent for the parent level search
+parent_seq_nuc=${7:-}
 
 # shellcheck disable=SC2029
 ssh "$user"@"$machine_name" "source $python_env_path/bin/activate &&\
     cd $RNAcode_web_repo_backend &&\
-    nohup xvfb-run -d python3 $RNAcode_web_repo_backend/RNAcodeWebCore_NCBI_DB.py  \
-    $job_id $min_pair_dist $max_pair_dist $genome_start $db_type $input_seq_nuc \
+    nohup python3 $RNAcode_web_repo_backend/RNAcodeWebCore_NCBI_DB.py  \
+    $job_id $min_pair_dist $max_pair_dist $genome_start $db_type $input_seq_nuc $parent_seq_nuc \
     &> /dev/null </dev/null " &
 ssh_pid=$!
 for i in $(seq 1 6); do
@@ -44,7 +46,7 @@ for i in $(seq 1 6); do
         >&2 echo "ssh $user@$machine_name"
         >&2 echo "source $python_env_path/bin/activate"
         >&2 echo "cd $RNAcode_web_repo_backend"
-        >&2 echo "nohup xvfb-run -d python3 $RNAcode_web_repo_backend/RNAcodeWebCore_NCBI_DB.py $job_id $min_pair_dist $max_pair_dist $genome_start $db_type $input_seq_nuc"
+        >&2 echo "nohup python3 $RNAcode_web_repo_backend/RNAcodeWebCore_NCBI_DB.py $job_id $min_pair_dist $max_pair_dist $genome_start $db_type $input_seq_nuc $parent_seq_nuc"
         exit 1
     fi
 done
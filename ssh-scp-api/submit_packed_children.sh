@@ -0,0 +1,53 @@
+#!/bin/bash
+
+set -e
+
+
+python_env_path="$(python3 -c "import sys, json;\
+	print(json.load(sys.stdin)['python_env_backend_path'])" \
+	< "./parameters_backend_local.json")"
+
+user="$(python3 -c "import sys, json;\
+	print(json.load(sys.stdin)['user'])" \
+	< "./parameters_backend_local.json")"
+
+machine_name="$(python3 -c "import sys, json;\
+	print(json.load(sys.stdin)['machine_name'])" \
+	< "./parameters_backend_local.json")"
+
+RNAcode_web_repo_backend="$(python3 -c "import sys, json;\
+	print(json.load(sys.stdin)['RNAcode_web_repo_backend'])" \
+	< "./parameters_backend_local.json")"
+
+job_id=$1
+spec_path=$2
+spec_path_backend="$RNAcode_web_repo_backend/logs/${job_id}_children.tsv"
+
+scp "$spec_path" "$user"@"$machine_name":"$spec_path_backend"
+
+# shellcheck disable=SC2029
+ssh "$user"@"$machine_name" "source $python_env_path/bin/activate &&\
+    cd $RNAcode_web_repo_backend &&\
+    nohup python3 $RNAcode_web_repo_backend/RNAcodeWebCore_packed.py  \
+    submit $job_id $spec_path_backend \
+    &> /dev/null </dev/null " &
+ssh_pid=$!
+echo "Job send. SSH pid is $ssh_pid"
+for i in $(seq 1 6); do
+    echo "See if job started"
+    if ssh -q "$user"@"$machine_name" [[ -f "$RNAcode_web_repo_backend/logs/$job_id-pack.out" ]]; then
+        break
+    fi
+    sleep 4
+    if [[ $i -gt 5 ]]; then
+        kill -9 "$ssh_pid" || true
+        >&2 echo "Can not start job backend!"
+        >&2 echo "Commands:"
+        >&2 echo "ssh $user@$machine_name"
+        >&2 echo "source $python_env_path/bin/activate"
+        >&2 echo "cd $RNAcode_web_repo_backend"
+        >&2 echo "nohup python3 $RNAcode_web_repo_backend/RNAcodeWebCore_packed.py submit $job_id $spec_path_backend"
+        exit 1
+    fi
+done
+kill -9 "$ssh_pid" || true
@@ -1,8 +1,19 @@
 #!/bin/bash
 
+# Updates the blast databases without disturbing running jobs.
+#
+# Every update is downloaded into a new version directory next to the blast_db
+# path of parameters_backend_local.json, together with the taxid lists. The
+# blast_db path is a symlink to the active version and is swapped atomically
+# once the new version is complete. Running jobs keep the version they
+# started with, old versions are removed if no pipeline uses them anymore.
+#
+#   <blast_db>_versions/<version>/      one complete db
+#   <blast_db> -> <blast_db>_versions/<version>
+
 set -e
 
-shellcheck disable=SC1091
+# shellcheck disable=SC1091
 source ./auxilary_scripts/activate_env_backend.sh
 python ./system_setup/update_ete3_ncbi_db.py
 
@@ -23,23 +34,97 @@ if [ -z "$blast_db" ]; then
 	exit 1
 fi
 
-if [ ! -d "$blast_db" ]; then
-	mkdir "$blast_db"
+blast_db="${blast_db%/}"
+versions_dir="${blast_db}_versions"
+version="$(date +%Y-%m-%d_%H%M%S)"
+version_dir="$versions_dir/$version"
+# Number of old versions which are kept even if unused
+keep_versions=1
+# Markers of pipelines on other hosts older than this many minutes are taken
+# as left over of a crashed pipeline
+marker_max_age=$((3 * 24 * 60))
+
+mkdir -p "$versions_dir"
+
+# First run on an old installation. Move the db into a version, the db is
+# missing for the time of the move.
+if [ -d "$blast_db" ] && [ ! -L "$blast_db" ]; then
+	echo "Move unversioned blast db into $versions_dir/unversioned"
+	mv "$blast_db" "$versions_dir/unversioned"
+	echo "unversioned" > "$versions_dir/unversioned/VERSION"
+	ln -s "$versions_dir/unversioned" "$blast_db"
+fi
+
+mkdir "$version_dir"
+# Remove half finished version if anything fails
+trap 'rm -rf "$version_dir"' ERR
+
+# Start from hard links of the active version, update_blastdb.pl then only
+# downloads the volumes which changed. Extracting a volume replaces its files
+# by new ones, the files of the active version stay untouched.
+if [ -d "$blast_db" ]; then
+	cp -al "$(readlink -f "$blast_db")/." "$version_dir"
+	rm -rf "$version_dir/.in_use" "$version_dir/VERSION"
 fi
 
 # shellcheck disable=SC2164
-cd "$blast_db"
-
-update_blastdb.pl --decompress ref_euk_rep_genomes --quiet
-update_blastdb.pl --decompress ref_prok_rep_genomes --quiet
-update_blastdb.pl --decompress ref_viroids_rep_genomes --quiet
-update_blastdb.pl --decompress ref_viruses_rep_genomes --quiet
-update_blastdb.pl --decompress nt --quiet
-
-blastdbcmd -db ref_euk_rep_genomes -entry all -outfmt %T > ref_euk_rep_genomes.taxidlist
-blastdbcmd -db ref_prok_rep_genomes -entry all -outfmt %T > ref_prok_rep_genomes.taxidlist
-blastdbcmd -db ref_viroids_rep_genomes -entry all -outfmt %T > ref_viroids_rep_genomes.taxidlist
-blastdbcmd -db ref_viruses_rep_genomes -entry all -outfmt %T > ref_viruses_rep_genomes.taxidlist
-blastdbcmd -db nt -entry all -outfmt %T > nt.taxidlist
+cd "$version_dir"
+
+dbs="ref_euk_rep_genomes ref_prok_rep_genomes ref_viroids_rep_genomes ref_viruses_rep_genomes nt"
+
+for db in $dbs; do
+	update_blastdb.pl --decompress "$db" --quiet
+done
+
+# Taxid lists. -tax_info only reads the taxonomy index of the db, which is
+# much faster than listing every entry. Old blast versions do not know it.
+for db in $dbs; do
+	# Hard link of the old version, must not be written through
+	rm -f "$db.taxidlist"
+	if ! blastdbcmd -db "$db" -tax_info -outfmt %T > "$db.taxidlist" 2> /dev/null; then
+		blastdbcmd -db "$db" -entry all -outfmt %T | sort -u > "$db.taxidlist"
+	fi
+done
+
+echo "$version" > VERSION
+mkdir .in_use
+
+# Activate new version atomically
+ln -s "$version_dir" "$blast_db.new"
+mv -T "$blast_db.new" "$blast_db"
+trap - ERR
+echo "Activated blast db version $version"
+
+# Remove old versions which are not used by a pipeline anymore. Each pipeline
+# marks its version with <pid>@<host> in .in_use. On this host the process is
+# checked, markers of other hosts count until they are marker_max_age old.
+active_dir="$(readlink -f "$blast_db")"
+# shellcheck disable=SC2012
+for old_dir in $(ls -dt "$versions_dir"/*/ | tail -n +$((keep_versions + 2))); do
+	old_dir="${old_dir%/}"
+	if [ "$old_dir" == "$active_dir" ]; then
+		continue
+	fi
+	in_use=false
+	for marker in "$old_dir"/.in_use/*; do
+		[ -e "$marker" ] || continue
+		marker="$(basename "$marker")"
+		pid="${marker%%@*}"
+		host="${marker#*@}"
+		if [ "$host" == "$(hostname)" ]; then
+			if kill -0 "$pid" 2> /dev/null; then
+				in_use=true
+				break
+			fi
+		elif [ -n "$(find "$old_dir/.in_use/$marker" -mmin -"$marker_max_age")" ]; then
+			in_use=true
+			break
+		fi
+	done
+	if [ "$in_use" == false ]; then
+		echo "Remove old blast db version $old_dir"
+		rm -rf "$old_dir"
+	fi
+done
 
 echo "Finished"
@@ -9,13 +9,14 @@ export BLASTDB=""
 export PYTHON_ENV=""
 path_blast_bin=""
 path_clustal_bin=""
+path_mafft_bin=""
 path_rnacode_bin=""
 # set end
 
 echo "None" > "./reference_species.txt"
 
 path_seqSel_script="$(pwd)"
-export PATH="$path_seqSel_script:$path_blast_bin:$path_rnacode_bin:$path_clustal_bin":$PATH
+export PATH="$path_seqSel_script:$path_blast_bin:$path_rnacode_bin:$path_clustal_bin:$path_mafft_bin":$PATH
 
 if [ -f ./multi.fasta ]; then
 	mv ./multi.fasta ./multi.fasta_dup
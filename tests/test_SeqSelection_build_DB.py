@@ -0,0 +1,46 @@
+"""Regions of the custom db, see SeqSelection_build_DB.select_regions()."""
+
+import os
+import sys
+
+import pytest
+
+pytest.importorskip("Bio")
+pytest.importorskip("ete3")
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import SeqSelection_build_DB  # noqa: E402
+from SeqSelection import BlastResult  # noqa: E402
+
+PARENT_LENGTH = 10000
+PADDING = 1000
+
+
+def blast_result(sstart, send, sframe, qstart, qend):
+    """Return a hit on accession ACC1 of length 50000."""
+    columns = [1e-10, 100, 0.9, "gi|1|gb|ACC1|", 50000, sstart, send, sframe, qstart, qend, 1, "A", "A", 9606]
+    return BlastResult("\t".join(str(column) for column in columns))
+
+
+@pytest.mark.parametrize(
+    "hits",
+    [
+        # plus strand, the start of the parent hits first
+        [[20001, 20500, 1, 1, 500], [29501, 30000, 1, 9501, 10000]],
+        # minus strand, the start of the parent hits last
+        [[30000, 29501, -1, 1, 500], [20500, 20001, -1, 9501, 10000]],
+    ],
+)
+def test_hits_at_both_ends_give_one_region(hits):
+    intervals = [
+        SeqSelection_build_DB.padded_interval(blast_result(*hit), PARENT_LENGTH, PADDING)
+        for hit in hits
+    ]
+    assert SeqSelection_build_DB.merge_intervals(intervals) == [[19001, 31000, 1, 10000]]
+
+
+def test_padding_ends_at_subject():
+    interval = SeqSelection_build_DB.padded_interval(
+        blast_result(101, 600, 1, 5001, 5500), PARENT_LENGTH, PADDING
+    )
+    assert interval == [1, 6100, 5001, 5500]